@@ -0,0 +1,93 @@
+"""Shared setup for the benchmark suite.
+
+Benchmarks use `pytest-benchmark` and aren't collected with the normal tests. Run with:
+
+    pytest benchmarks --benchmark-only
+
+Use `--exchanges=100,1000000` to choose the database sizes (number of exchanges), and
+`--co-products=2,10` to choose the number of functional edges per multifunctional process. Each
+benchmark records the peak Python memory use in `extra_info`.
+
+`test_scaling.py` contains plain tests which fail if an operation scales worse than linearly."""
+
+import tracemalloc
+from typing import Callable, Dict, Optional
+
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase
+from multifunctional.synthetic import SyntheticInventory
+
+DEFAULT_EXCHANGES = "100,1000"
+DEFAULT_CO_PRODUCTS = "2,5"
+DATABASE = "synthetic"
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("multifunctional benchmarks")
+    group.addoption(
+        "--exchanges",
+        default=DEFAULT_EXCHANGES,
+        help=f"Comma-separated database sizes in exchanges (default {DEFAULT_EXCHANGES})",
+    )
+    group.addoption(
+        "--co-products",
+        default=DEFAULT_CO_PRODUCTS,
+        help=f"Comma-separated functional edges per process (default {DEFAULT_CO_PRODUCTS})",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    for name, option in (("exchanges", "--exchanges"), ("co_products", "--co-products")):
+        if name in metafunc.fixturenames:
+            values = [int(value) for value in metafunc.config.getoption(option).split(",")]
+            metafunc.parametrize(name, values, ids=[f"{name}={value}" for value in values])
+
+
+def inventory(exchanges: int, co_products: int) -> SyntheticInventory:
+    """Multifunctional processes with `co_products` functional edges each, and about `exchanges`
+    exchanges in total."""
+    return SyntheticInventory.with_exchanges(
+        exchanges, database=DATABASE, functional_edges={co_products: 1}
+    )
+
+
+def synthetic_data(exchanges: int, co_products: int) -> Dict[tuple, dict]:
+    return inventory(exchanges, co_products).data()
+
+
+@bw2test
+def new_database(
+    data: Optional[Dict[tuple, dict]] = None, process: bool = False, **metadata
+) -> MultifunctionalDatabase:
+    """Create a database in a new, empty project, and write `data` if given."""
+    db = MultifunctionalDatabase(DATABASE)
+    db.register(**metadata)
+    if data is not None:
+        db.write(data, process=process)
+    return db
+
+
+def peak_memory(func: Callable, *args, **kwargs) -> float:
+    """Peak memory allocated by Python while running `func`, in MB."""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture
+def run(benchmark):
+    """Benchmark `func` once per round on fresh state from `setup`, and record peak memory.
+
+    `setup` returns the positional arguments for `func`. Memory is measured on a separate, untimed
+    run, as tracing slows down allocation considerably."""
+
+    def runner(func: Callable, setup: Callable[[], tuple] = tuple, rounds: int = 1):
+        benchmark.extra_info["peak_memory_mb"] = peak_memory(func, *setup())
+        return benchmark.pedantic(func, setup=lambda: (setup(), {}), rounds=rounds, iterations=1)
+
+    return runner
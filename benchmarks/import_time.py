@@ -0,0 +1,26 @@
+"""Time `import multifunctional` in fresh interpreters.
+
+Run with `python benchmarks/import_time.py [repeats]`. Reports the median wall time of importing
+`bw2data` alone and `multifunctional`, so the difference is the cost of this library."""
+
+import statistics
+import subprocess
+import sys
+import time
+
+
+def import_time(module: str, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    baseline = import_time("bw2data", repeats)
+    total = import_time("multifunctional", repeats)
+    print(f"bw2data:         {baseline:.3f} s")
+    print(f"multifunctional: {total:.3f} s (+{total - baseline:.3f} s)")
@@ -0,0 +1,43 @@
+from copy import deepcopy
+
+from conftest import DATABASE, new_database, synthetic_data
+
+from multifunctional import allocation_strategies, generic_allocation
+from multifunctional.synthetic import SyntheticInventory
+from multifunctional.utils import purge_expired_linked_readonly_processes
+
+
+def test_generic_allocation_in_memory(run, co_products):
+    """Allocation of data dictionaries, without any database access."""
+    datasets = [
+        ds
+        for ds in SyntheticInventory.with_exchanges(
+            10_000, database=DATABASE, functional_edges={co_products: 1}, product_properties=0
+        ).datasets()
+        if ds.get("type") == "multifunctional"
+    ]
+    for i, ds in enumerate(datasets):
+        ds["id"] = i
+
+    def allocate(datasets):
+        for ds in datasets:
+            generic_allocation(
+                ds,
+                func=allocation_strategies.defaults["price"].keywords["func"],
+                product_properties=False,
+            )
+
+    run(allocate, setup=lambda: (deepcopy(datasets),), rounds=3)
+
+
+def test_purge_expired_linked_readonly_processes(run, exchanges, co_products):
+    """Called on every save of a multifunctional process."""
+    from bw2data import get_node
+
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        new_database(data, process=True, default_allocation="price")
+        return (get_node(database=DATABASE, code="process-0"),)
+
+    run(purge_expired_linked_readonly_processes, setup=setup)
@@ -0,0 +1,106 @@
+from bw2data.backends.schema import ActivityDataset
+from conftest import DATABASE, inventory, new_database, synthetic_data
+
+from multifunctional import MultifunctionalDatabase
+from multifunctional.property_index import BATCH_SIZE
+from multifunctional.supply_chain import clear_supply_chain_cache
+from multifunctional.synthetic import write_synthetic_database
+
+
+def test_write(run, exchanges, co_products):
+    data = synthetic_data(exchanges, co_products)
+    run(lambda data: new_database(data), setup=lambda: (dict(data),))
+
+
+def test_write_streaming(run, exchanges, co_products, monkeypatch):
+    """Generate and write without holding the inventory in memory."""
+
+    def setup():
+        new_database()
+        return (inventory(exchanges, co_products),)
+
+    run(write_synthetic_database, setup=setup)
+
+    # One bounded batch of datasets at a time
+    batches, insert_many = [], ActivityDataset.insert_many
+    monkeypatch.setattr(
+        ActivityDataset, "insert_many", lambda rows: batches.append(len(rows)) or insert_many(rows)
+    )
+    write_synthetic_database(*setup())
+    datasets = sum(1 for _ in inventory(exchanges, co_products).datasets())
+    assert sum(batches) == datasets
+    assert len(batches) == -(-datasets // BATCH_SIZE)
+
+
+def test_process(run, exchanges, co_products):
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        return (new_database(data, default_allocation="price"),)
+
+    run(MultifunctionalDatabase.process, setup=setup)
+
+
+def test_process_chunked(run, exchanges, co_products):
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        return (new_database(data, default_allocation="price"),)
+
+    run(lambda db: db.process(chunk_size=100), setup=setup)
+
+
+def test_process_bulk(run, exchanges, co_products):
+    """Compare with `test_process` for the throughput gained by the bulk-load session."""
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        return (new_database(data, default_allocation="price"),)
+
+    run(lambda db: db.process(bulk=True), setup=setup)
+
+
+def test_process_for_demand(run, exchanges, co_products):
+    """Compare with `test_process` for allocating only the supply chain of one process."""
+    data = synthetic_data(exchanges, co_products)
+    demand = {next(key for key, ds in data.items() if ds.get("type") == "multifunctional"): 1}
+
+    def setup():
+        clear_supply_chain_cache()
+        return (new_database(data, default_allocation="price"),)
+
+    run(lambda db: db.process_for_demand(demand), setup=setup)
+
+
+def test_reallocate(run, exchanges, co_products):
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        return (new_database(data, process=True, default_allocation="price"),)
+
+    run(MultifunctionalDatabase.process, setup=setup)
+
+
+def test_strategy_switch(run, exchanges, co_products):
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        db = new_database(data, process=True, default_allocation="price")
+        db.metadata["default_allocation"] = "mass"
+        db._metadata.flush()
+        return (db,)
+
+    run(MultifunctionalDatabase.process, setup=setup)
+
+
+def test_allocate_single_process_in_large_database(run, exchanges, co_products):
+    """Should be independent of database size."""
+    from bw2data import get_node
+
+    data = synthetic_data(exchanges, co_products)
+
+    def setup():
+        new_database(data, process=True, default_allocation="price")
+        return (get_node(database=DATABASE, code="process-0"),)
+
+    run(lambda node: node.allocate(strategy_label="mass"), setup=setup)
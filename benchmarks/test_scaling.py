@@ -0,0 +1,67 @@
+"""Catch superlinear behaviour by timing the same operation at two database sizes.
+
+These are plain tests (no `benchmark` fixture), and run with `pytest benchmarks`. An operation
+which is linear in database size should take about `FACTOR` times longer on the larger database;
+quadratic behaviour takes about `FACTOR ** 2` times longer."""
+
+import time
+from typing import Callable
+
+from bw2data import get_node
+from conftest import DATABASE, new_database, synthetic_data
+
+from multifunctional import MultifunctionalDatabase, check_properties_for_allocation
+from multifunctional.utils import purge_expired_linked_readonly_processes
+
+SMALL = 200
+FACTOR = 4
+# Generous, as timings of small databases include fixed costs and are noisy
+MAX_RATIO = FACTOR * 2
+
+
+def best_time(func: Callable, setup: Callable[[], tuple], repeats: int = 3) -> float:
+    timings = []
+    for _ in range(repeats):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def scaling_ratio(func: Callable, setup: Callable[[int], tuple]) -> float:
+    small = best_time(func, lambda: setup(SMALL))
+    large = best_time(func, lambda: setup(SMALL * FACTOR))
+    return large / small
+
+
+def allocated_database(exchanges: int) -> tuple:
+    return (new_database(synthetic_data(exchanges, 2), process=True, default_allocation="price"),)
+
+
+def test_process_scales_linearly():
+    def setup(exchanges):
+        return (new_database(synthetic_data(exchanges, 2), default_allocation="price"),)
+
+    assert scaling_ratio(MultifunctionalDatabase.process, setup) < MAX_RATIO
+
+
+def test_reallocate_scales_linearly():
+    assert scaling_ratio(MultifunctionalDatabase.process, allocated_database) < MAX_RATIO
+
+
+def test_purge_scales_linearly():
+    # Iterates over the whole database to find the read-only processes of the parent
+    def setup(exchanges):
+        allocated_database(exchanges)
+        return (get_node(database=DATABASE, code="process-0"),)
+
+    assert scaling_ratio(purge_expired_linked_readonly_processes, setup) < MAX_RATIO
+
+
+def test_check_properties_scales_linearly():
+    def setup(exchanges):
+        new_database(synthetic_data(exchanges, 2))
+        return (DATABASE, ["price", "mass"])
+
+    assert scaling_ratio(check_properties_for_allocation, setup) < MAX_RATIO
@@ -0,0 +1,29 @@
+import pytest
+from conftest import DATABASE, new_database, synthetic_data
+
+from multifunctional import (
+    build_property_index,
+    check_properties_for_allocation,
+    check_property_for_allocation,
+    list_available_properties,
+)
+
+
+@pytest.fixture(params=[False, True], ids=["scan", "index"])
+def database(request, exchanges, co_products):
+    db = new_database(synthetic_data(exchanges, co_products))
+    if request.param:
+        build_property_index(DATABASE)
+    return db
+
+
+def test_check_property_for_allocation(run, database):
+    run(lambda: check_property_for_allocation(DATABASE, "price"), rounds=3)
+
+
+def test_check_properties_for_allocation(run, database):
+    run(lambda: check_properties_for_allocation(DATABASE, ["price", "mass", "missing"]), rounds=3)
+
+
+def test_list_available_properties(run, database):
+    run(lambda: list_available_properties(DATABASE), rounds=3)
@@ -1,14 +1,30 @@
 __all__ = (
     "__version__",
+    "add_custom_expression_allocation_to_project",
     "add_custom_property_allocation_to_project",
     "allocation_before_writing",
+    "allocation_sensitivity",
     "allocation_strategies",
+    "build_property_index",
+    "bulk_load",
+    "check_properties_for_allocation",
     "check_property_for_allocation",
     "check_property_for_process_allocation",
+    "deferred_side_effects",
+    "drop_property_index",
+    "export_allocation_results",
+    "expression_allocation",
+    "FunctionalEdgeClassifier",
+    "FunctionalEdgeRule",
     "generic_allocation",
+    "import_manual_allocation_factors",
+    "instrument",
     "list_available_properties",
+    "low_rank_allocation_update",
     "MaybeMultifunctionalProcess",
     "MultifunctionalDatabase",
+    "on_allocation_changes",
+    "process_multifunctional_databases",
     "property_allocation",
     "ReadOnlyProcessWithReferenceProduct",
 )
@@ -25,17 +41,9 @@ logger.disable("multifunctional")
 from bw2data import labels
 from bw2data.subclass_mapping import DATABASE_BACKEND_MAPPING, NODE_PROCESS_CLASS_MAPPING
 
-from .allocation import allocation_strategies, generic_allocation, property_allocation
-from .custom_allocation import (
-    add_custom_property_allocation_to_project,
-    check_property_for_allocation,
-    check_property_for_process_allocation,
-    list_available_properties,
-)
 from .database import MultifunctionalDatabase
 from .node_classes import MaybeMultifunctionalProcess, ReadOnlyProcessWithReferenceProduct
 from .node_dispatch import multifunctional_node_dispatcher
-from .utils import allocation_before_writing
 
 DATABASE_BACKEND_MAPPING["multifunctional"] = MultifunctionalDatabase
 NODE_PROCESS_CLASS_MAPPING["multifunctional"] = multifunctional_node_dispatcher
@@ -45,3 +53,45 @@ if "readonly_process" not in labels.process_node_types:
     labels.process_node_types.append("readonly_process")
 if "readonly_process" not in labels.node_types:
     labels.lci_node_types.append("readonly_process")
+
+# Loaded on first access to keep `import multifunctional` fast
+_LAZY_ATTRIBUTES = {
+    "add_custom_expression_allocation_to_project": "custom_allocation",
+    "add_custom_property_allocation_to_project": "custom_allocation",
+    "allocation_before_writing": "utils",
+    "allocation_sensitivity": "sensitivity",
+    "allocation_strategies": "allocation",
+    "build_property_index": "property_index",
+    "bulk_load": "bulk_load",
+    "check_properties_for_allocation": "custom_allocation",
+    "check_property_for_allocation": "custom_allocation",
+    "check_property_for_process_allocation": "custom_allocation",
+    "deferred_side_effects": "deferred",
+    "drop_property_index": "property_index",
+    "export_allocation_results": "export",
+    "expression_allocation": "allocation",
+    "FunctionalEdgeClassifier": "classification",
+    "FunctionalEdgeRule": "classification",
+    "generic_allocation": "allocation",
+    "import_manual_allocation_factors": "manual_factors",
+    "instrument": "instrumentation",
+    "list_available_properties": "custom_allocation",
+    "low_rank_allocation_update": "low_rank",
+    "on_allocation_changes": "deferred",
+    "process_multifunctional_databases": "parallel",
+    "property_allocation": "allocation",
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+
+    value = getattr(import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
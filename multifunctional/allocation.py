@@ -1,15 +1,23 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from copy import deepcopy
 from functools import partial
-from typing import Callable, List, Optional, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Protocol, Union
 from uuid import uuid4
 
-from bw2data import get_node
+import numpy as np
+from blinker import signal
+from bw2data import databases, get_node
 from bw2data.backends.proxies import Activity
 from bw2data.errors import UnknownObject
-from bw2io.utils import rescale_exchange
+from bw2data.project import ProjectDataset
 from loguru import logger
 
-from .supplemental import add_product_node_properties_to_exchange
+from .columnar import FunctionalEdgeTable
+from .expressions import AllocationExpression
+from .instrumentation import count, phase
+from .registry import StrategyRegistry
+from .supplemental import edge_with_product_properties, product_node_properties
 
 
 def remove_output(d: dict) -> dict:
@@ -18,57 +26,139 @@ def remove_output(d: dict) -> dict:
     return d
 
 
+class AllocationFactor(Protocol):
+    """Unnormalized allocation factor of one functional edge of `node`."""
+
+    def __call__(self, edge_data: dict, node: dict) -> float: ...
+
+
+class BatchAllocationFactor(AllocationFactor, Protocol):
+    """Allocation factor function which can also evaluate many functional edges at once.
+
+    `batch` gets a `FunctionalEdgeTable` with the functional edges of one or many multifunctional
+    processes (`process_id`, `amount`, and the edge and product properties), and returns an array
+    with one unnormalized factor per row. It must give the same values as calling the function
+    for each edge, and raise if any edge can't be evaluated. If a call for many processes fails,
+    each process is evaluated separately, so the error is raised for the right process."""
+
+    def batch(self, table: FunctionalEdgeTable) -> np.ndarray: ...
+
+
+# `{factor function: {edge id: value}}`, filled by `batch_allocation_factors`
+_precomputed_factors: ContextVar[Optional[Dict[Callable, Dict[int, float]]]] = ContextVar(
+    "multifunctional_precomputed_factors", default=None
+)
+
+
+def allocation_factor_values(
+    func: Callable,
+    act: dict,
+    functional_edges: List[Mapping],
+    edge_ids: Optional[List[Optional[int]]] = None,
+    product_properties: Optional[Dict[int, Mapping]] = None,
+) -> List[float]:
+    """Unnormalized allocation factor for each functional edge.
+
+    Uses values computed in advance by `batch_allocation_factors` if available for all
+    `edge_ids`, then `func.batch` to evaluate all edges at once if available, otherwise calls
+    `func` for each edge. `product_properties` is passed to `FunctionalEdgeTable.from_dataset`."""
+    precomputed = (_precomputed_factors.get() or {}).get(func)
+    if precomputed and edge_ids and all(edge_id in precomputed for edge_id in edge_ids):
+        count("precomputed_factors", len(edge_ids))
+        return [precomputed[edge_id] for edge_id in edge_ids]
+    batch = getattr(func, "batch", None)
+    if batch is not None:
+        table = FunctionalEdgeTable.from_dataset(act, product_properties)
+        return [float(value) for value in batch(table)]
+    return [func(exc, act) for exc in functional_edges]
+
+
 def generic_allocation(
     act: Union[dict, Activity],
     func: Callable,
     strategy_label: Optional[str] = None,
-    supplemental_functions: Optional[List[Callable]] = [add_product_node_properties_to_exchange],
+    supplemental_functions: Optional[List[Callable]] = None,
+    zero_allocation_stubs: Optional[bool] = None,
+    tolerance: Optional[float] = None,
+    product_properties: bool = True,
 ) -> List[dict]:
     """Allocation by single allocation factor generated by `func`.
 
     Allocation amount is edge amount times function(edge_data, act) divided by sum of all edge
     amounts times function(edge_data, act).
 
-    **No longer** skips functional edges with zero allocation values."""
+    With `product_properties`, `func` gets a read-only view of each functional edge, whose
+    `properties` are layered over the properties of its product node (see
+    `product_node_properties`); the edges themselves are not changed. `supplemental_functions`
+    can change `act` before allocation.
+
+    **No longer** skips functional edges with zero allocation values. With `zero_allocation_stubs`,
+    the read-only process for a zero allocation factor only has its functional edge, so links to
+    it still resolve. Non-functional edges whose rescaled amount is below `tolerance` (in absolute
+    value) are left out. Both default to the `zero_allocation_stubs` and `allocation_tolerance`
+    values in the database metadata; by default, nothing is left out."""
+    edge_ids = {}
     if isinstance(act, Activity):
         act_data = act._data
-        act_data["exchanges"] = [exc._data for exc in act.exchanges()]
+        edges = list(act.exchanges())
+        act_data["exchanges"] = [exc._data for exc in edges]
+        # Edge data doesn't include the id, which is needed for precomputed factors
+        edge_ids = {id(exc._data): exc.id for exc in edges}
         act = act_data
 
-    if supplemental_functions:
-        for sf in supplemental_functions:
-            act = sf(act)
+    for sf in supplemental_functions or []:
+        act = sf(act)
 
+    functional_positions = [
+        position for position, exc in enumerate(act.get("exchanges", [])) if exc.get("functional")
+    ]
+    functional_edges = [act["exchanges"][position] for position in functional_positions]
     if act.get("type") == "readonly_process":
         return []
-    elif sum(1 for exc in act.get("exchanges", []) if exc.get("functional")) < 2:
+    elif len(functional_edges) < 2:
         return []
 
-    total = 0
-    for exc in filter(lambda x: x.get("functional"), act.get("exchanges", [])):
-        total += func(exc, act)
+    # `bw2io` is slow to import, and only needed here
+    from bw2io.utils import rescale_exchange
+
+    with phase("supplemental"):
+        products = product_node_properties(act) if product_properties else {}
+    with phase("allocation_factors"):
+        values = allocation_factor_values(
+            func,
+            act,
+            [
+                (
+                    edge_with_product_properties(act["exchanges"][position], products[position])
+                    if position in products
+                    else act["exchanges"][position]
+                )
+                for position in functional_positions
+            ],
+            [edge_ids.get(id(exc)) for exc in functional_edges],
+            products,
+        )
+    total = sum(values)
 
     if not total:
         raise ZeroDivisionError("Sum of allocation factors is zero")
 
+    metadata = databases.get(act.get("database"), {})
+    if zero_allocation_stubs is None:
+        zero_allocation_stubs = bool(metadata.get("zero_allocation_stubs"))
+    if tolerance is None:
+        tolerance = metadata.get("allocation_tolerance")
+
     act["mf_allocation_run_uuid"] = uuid4().hex
     processes = [act]
 
-    for original_exc in filter(lambda x: x.get("functional"), act.get("exchanges", [])):
-        new_exc = remove_output(deepcopy(original_exc))
+    for original_exc, value in zip(functional_edges, values):
+        with phase("copy"):
+            new_exc = remove_output(deepcopy(original_exc))
 
-        factor = func(original_exc, act) / total
+        factor = value / total
         original_exc["mf_allocation_factor"] = factor
 
-        if "__mf__properties_from_product" in new_exc:
-            for key in new_exc["__mf__properties_from_product"]:
-                del new_exc["properties"][key]
-            del new_exc["__mf__properties_from_product"]
-        if "__mf__properties_from_product" in original_exc:
-            for key in original_exc["__mf__properties_from_product"]:
-                del original_exc["properties"][key]
-            del original_exc["__mf__properties_from_product"]
-
         logger.debug(
             "Using allocation factor {f} for functional edge {e} on activity {a}",
             f=factor,
@@ -144,13 +234,22 @@ def generic_allocation(
             allocated_process["unit"] = new_exc.get("unit") or act.get("unit", "(unknown)")
         allocated_process["exchanges"] = [new_exc]
 
-        for other in filter(lambda x: not x.get("functional"), act["exchanges"]):
-            allocated_process["exchanges"].append(
-                remove_output(rescale_exchange(deepcopy(other), factor))
-            )
+        with phase("copy"):
+            others = [exc for exc in act["exchanges"] if not exc.get("functional")]
+            if zero_allocation_stubs and not factor:
+                # Stub with only the functional edge
+                count("pruned_edges", len(others))
+                others = []
+            for other in others:
+                edge = rescale_exchange(deepcopy(other), factor)
+                if tolerance and abs(edge.get("amount", 0)) < tolerance:
+                    count("pruned_edges")
+                    continue
+                allocated_process["exchanges"].append(remove_output(edge))
 
         processes.append(allocated_process)
 
+    count("allocated_processes", len(processes) - 1)
     # Useful for other functions like purging expired links in future
     act["mf_was_once_allocated"] = True
 
@@ -178,13 +277,53 @@ def get_allocation_factor_from_property(
         ) from err
 
 
+class PropertyAllocationFactor:
+    """Allocation factor from the property `property_label` of each functional edge, optionally
+    multiplied by the edge amount. Implements `BatchAllocationFactor`."""
+
+    def __init__(self, property_label: str, normalize_by_production_amount: bool = True):
+        self.property_label = property_label
+        self.normalize_by_production_amount = normalize_by_production_amount
+
+    def __repr__(self) -> str:
+        return (
+            f"PropertyAllocationFactor({self.property_label!r}, "
+            f"normalize_by_production_amount={self.normalize_by_production_amount})"
+        )
+
+    def __call__(self, edge_data: dict, node: dict) -> float:
+        return get_allocation_factor_from_property(
+            edge_data,
+            node,
+            property_label=self.property_label,
+            normalize_by_production_amount=self.normalize_by_production_amount,
+        )
+
+    def batch(self, table: FunctionalEdgeTable) -> np.ndarray:
+        column = table.property_column(self.property_label)
+        if not column.present.all():
+            index = np.flatnonzero(~column.present)[0]
+            raise KeyError(
+                f"Functional edge {table.edge_id[index]} of process {table.process_id[index]} "
+                f"missing property {self.property_label}"
+            )
+        if not column.numeric.all():
+            index = np.flatnonzero(~column.numeric)[0]
+            raise ValueError(
+                f"Functional edge {table.edge_id[index]} of process {table.process_id[index]} "
+                f"has non-numeric property {self.property_label}: {column.raw[index]}"
+            )
+        if self.normalize_by_production_amount:
+            return table.amount * column.values
+        return column.values
+
+
 def property_allocation(
     property_label: str, normalize_by_production_amount: bool = True
 ) -> Callable:
     return partial(
         generic_allocation,
-        func=partial(
-            get_allocation_factor_from_property,
+        func=PropertyAllocationFactor(
             property_label=property_label,
             normalize_by_production_amount=normalize_by_production_amount,
         ),
@@ -192,11 +331,115 @@ def property_allocation(
     )
 
 
-allocation_strategies = {
-    "price": property_allocation("price"),
-    "manual_allocation": property_allocation(
-        "manual_allocation", normalize_by_production_amount=False
-    ),
-    "mass": property_allocation("mass"),
-    "equal": partial(generic_allocation, func=lambda x, y: 1.0, strategy_label="equal_allocation"),
-}
+def equal_allocation_factor(edge_data: dict, node: dict) -> float:
+    return 1.0
+
+
+equal_allocation_factor.batch = lambda table: np.ones(len(table))
+
+
+def expression_allocation(expression: str) -> Callable:
+    """Allocation by an arithmetic expression over functional edge properties, e.g. `price * mass`.
+
+    The expression gives the unnormalized allocation factor; include `amount` in the expression to
+    scale by the edge amount. See `AllocationExpression`."""
+    return partial(
+        generic_allocation,
+        func=AllocationExpression(expression),
+        strategy_label=f"expression allocation by '{expression}'",
+    )
+
+
+def strategy_from_specification(specification: dict) -> Callable:
+    """Create an allocation strategy from its persisted specification."""
+    if "expression" in specification:
+        return expression_allocation(**specification)
+    return property_allocation(**specification)
+
+
+allocation_strategies = StrategyRegistry(
+    defaults={
+        "price": property_allocation("price"),
+        "manual_allocation": property_allocation(
+            "manual_allocation", normalize_by_production_amount=False
+        ),
+        "mass": property_allocation("mass"),
+        "equal": partial(
+            generic_allocation, func=equal_allocation_factor, strategy_label="equal_allocation"
+        ),
+    },
+    builder=strategy_from_specification,
+)
+
+
+def _batch_function(strategy: Callable) -> Optional[BatchAllocationFactor]:
+    """Factor function of a `generic_allocation` strategy, if it implements
+    `BatchAllocationFactor` and the strategy uses product properties without supplemental
+    functions."""
+    if not isinstance(strategy, partial) or strategy.func is not generic_allocation:
+        return None
+    func = strategy.keywords.get("func")
+    if strategy.args or getattr(func, "batch", None) is None:
+        return None
+    if strategy.keywords.get("supplemental_functions") or not strategy.keywords.get(
+        "product_properties", True
+    ):
+        return None
+    return func
+
+
+@contextmanager
+def batch_allocation_factors(nodes: Iterable[Activity]) -> Iterator[int]:
+    """Evaluate the allocation factors of many multifunctional processes with one `batch` call per
+    database and factor function, and use these values when the processes are allocated inside
+    the block. Yields the number of functional edges evaluated.
+
+    Only applies to `generic_allocation` strategies whose factor function implements
+    `BatchAllocationFactor`. Processes whose strategy can't be resolved, and groups whose `batch`
+    call fails, are left to the normal allocation path, which reports any errors."""
+    groups: Dict[tuple, List[int]] = {}
+    for node in nodes:
+        if node.get("type") != "multifunctional" or node.get("skip_allocation"):
+            continue
+        try:
+            _, strategy = node.allocation_strategy()
+        except (KeyError, ValueError):
+            continue
+        func = _batch_function(strategy)
+        if func is not None:
+            groups.setdefault((node["database"], func), []).append(node.id)
+
+    precomputed: Dict[Callable, Dict[int, float]] = {}
+    with phase("batch_factors"):
+        for (database, func), process_ids in groups.items():
+            table = FunctionalEdgeTable.from_database(database, process_ids)
+            # Like `product_node_properties`, links to the process itself don't
+            # add product properties
+            table.product_properties = [
+                {} if product_id == process_id else properties
+                for product_id, process_id, properties in zip(
+                    table.product_id.tolist(), table.process_id.tolist(), table.product_properties
+                )
+            ]
+            try:
+                values = np.asarray(func.batch(table), dtype=float)
+            except Exception as err:
+                logger.debug("Batch allocation factors failed for {f}: {e}", f=func, e=err)
+                continue
+            if values.shape != (len(table),):
+                continue
+            precomputed.setdefault(func, {}).update(zip(table.edge_id.tolist(), values.tolist()))
+
+    token = _precomputed_factors.set(precomputed)
+    try:
+        yield sum(len(values) for values in precomputed.values())
+    finally:
+        _precomputed_factors.reset(token)
+
+
+def forget_allocation_strategies_on_project_created(project_dataset: ProjectDataset) -> None:
+    """A new project can reuse the name of a deleted one; don't keep its cached strategies."""
+    allocation_strategies.invalidate(project_dataset.name)
+
+
+signal("bw2data.project_created").connect(forget_allocation_strategies_on_project_created)
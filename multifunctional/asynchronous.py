@@ -0,0 +1,211 @@
+"""Allocation and processing for use in `asyncio` applications.
+
+Allocation strategies run in an executor (by default the thread pool of the event loop), and all
+writes to the SQLite database run in one dedicated thread, so the event loop stays responsive.
+Progress is reported with an optional callback, which is called in the event loop thread.
+
+Cancelling the task cancels the work cooperatively: nothing is written for a process whose
+strategy was still running, and processes which were already written keep their new allocation.
+The strategy itself can't be interrupted and runs to completion in the background; its result is
+discarded. Writes are atomic per process, and a write which has started is finished before the
+cancellation is raised."""
+
+import asyncio
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Union
+
+from bw2data import projects
+from bw2data.backends import SQLiteBackend, sqlite3_lci_db
+from loguru import logger
+
+from .errors import NoAllocationNeeded
+from .property_index import BATCH_SIZE
+from .utils import product_as_process_name, update_datasets_from_allocation_results
+
+_DATABASE_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_LOCK = threading.Lock()
+
+
+@dataclass
+class Progress:
+    """Progress update given to the `progress` callback.
+
+    `stage` is one of `discovery`, `allocate`, `matrix`, and `done`. `done` and `total` count
+    multifunctional processes."""
+
+    stage: str
+    done: int
+    total: int
+
+
+def database_executor() -> ThreadPoolExecutor:
+    """The single thread used for all SQLite writes."""
+    global _DATABASE_EXECUTOR
+    with _LOCK:
+        if _DATABASE_EXECUTOR is None:
+            _DATABASE_EXECUTOR = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="multifunctional-sqlite"
+            )
+        return _DATABASE_EXECUTOR
+
+
+async def _in_database_thread(func: Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(database_executor(), func, *args)
+
+
+def _report(progress: Optional[Callable], stage: str, done: int, total: int) -> None:
+    if progress is not None:
+        progress(Progress(stage, done, total))
+
+
+def _needs_allocation(node) -> bool:
+    if node.get("skip_allocation"):
+        return False
+    if not node.multifunctional:
+        # Same as `allocate`: the process type may have to change
+        node.save()
+        return False
+    return True
+
+
+def _write(project: str, allocated_data: List[dict]) -> None:
+    if projects.current != project:
+        raise RuntimeError(
+            f"Current project changed from {project} to {projects.current} during allocation"
+        )
+    with sqlite3_lci_db.transaction():
+        update_datasets_from_allocation_results(allocated_data)
+
+
+def _run_strategy(strategy: Callable, node, products_as_process: bool) -> List[dict]:
+    allocated_data = strategy(node)
+    if products_as_process:
+        product_as_process_name(allocated_data)
+    return allocated_data
+
+
+async def _allocate(
+    node,
+    strategy_label: Optional[str],
+    products_as_process: bool,
+    executor: Optional[Executor],
+) -> Union[None, NoAllocationNeeded]:
+    if not await _in_database_thread(_needs_allocation, node):
+        return NoAllocationNeeded
+    project = projects.current
+    strategy_label, strategy = node.allocation_strategy(strategy_label)
+    logger.debug(
+        "Allocating {p} (id: {i}) with strategy {s} asynchronously",
+        p=repr(node),
+        i=node.id,
+        s=strategy_label,
+    )
+
+    loop = asyncio.get_running_loop()
+    allocated_data = await loop.run_in_executor(
+        executor, _run_strategy, strategy, node, products_as_process
+    )
+
+    write = asyncio.ensure_future(_in_database_thread(_write, project, allocated_data))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # Don't return while the database is still being changed
+        await write
+        raise
+
+
+async def allocate(
+    node,
+    strategy_label: Optional[str] = None,
+    products_as_process: bool = False,
+    progress: Optional[Callable[[Progress], None]] = None,
+    executor: Optional[Executor] = None,
+) -> Union[None, NoAllocationNeeded]:
+    """Allocate the `MaybeMultifunctionalProcess` `node` like `node.allocate()`, without blocking
+    the event loop.
+
+    The strategy runs in `executor` (default: the default executor of the event loop) and gets the
+    node object, as in `allocate`. This needs a thread pool, as nodes and most strategies can't be
+    pickled."""
+    _report(progress, "allocate", 0, 1)
+    result = await _allocate(node, strategy_label, products_as_process, executor)
+    _report(progress, "done", 1, 1)
+    return result
+
+
+async def process(
+    database: SQLiteBackend,
+    csv: bool = False,
+    allocate: bool = True,
+    progress: Optional[Callable[[Progress], None]] = None,
+    executor: Optional[Executor] = None,
+) -> None:
+    """Allocate all multifunctional processes in the `MultifunctionalDatabase` `database`, and then
+    build the processed arrays, like `database.process()`, without blocking the event loop.
+
+    Processes are allocated one at a time. Each process is written in its own transaction, so
+    cancelling leaves a consistent database, in which some processes have the new allocation.
+    The processed arrays are only built if all processes were allocated."""
+    done = 0
+    if allocate:
+        _report(progress, "discovery", 0, 0)
+        codes = await _in_database_thread(database.multifunctional_codes)
+        is_simapro = database._is_simapro
+        _report(progress, "allocate", done, len(codes))
+        for start in range(0, len(codes), BATCH_SIZE):
+            nodes = await _in_database_thread(
+                lambda chunk: list(database.nodes_by_code(chunk)), codes[start : start + BATCH_SIZE]
+            )
+            for node in nodes:
+                await _allocate(node, None, is_simapro, executor)
+                done += 1
+                _report(progress, "allocate", done, len(codes))
+
+    _report(progress, "matrix", done, done)
+    await _in_database_thread(lambda: SQLiteBackend.process(database, csv=csv))
+    _report(progress, "done", done, done)
+
+
+class ReallocationScheduler:
+    """Run at most one asynchronous allocation per process; newer requests win.
+
+    `submit` cancels the pending allocation of the same process, and starts the new one once the
+    cancelled one has stopped. Useful to reallocate processes after each edit, without applying
+    stale results."""
+
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def submit(self, node, strategy_label: Optional[str] = None, **kwargs) -> asyncio.Task:
+        """Schedule allocation of `node`; arguments as in `allocate`. Must be called from a
+        running event loop."""
+        previous = self._tasks.get(node.id)
+        if previous is not None:
+            previous.cancel()
+        kwargs.setdefault("executor", self.executor)
+        task = asyncio.ensure_future(self._run(previous, node, strategy_label, kwargs))
+        self._tasks[node.id] = task
+        task.add_done_callback(lambda done: self._forget(node.id, done))
+        return task
+
+    def _forget(self, node_id: int, task: asyncio.Task) -> None:
+        if self._tasks.get(node_id) is task:
+            del self._tasks[node_id]
+
+    async def _run(self, previous: Optional[asyncio.Task], node, strategy_label, kwargs):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        return await allocate(node, strategy_label, **kwargs)
+
+    def pending(self) -> List[int]:
+        """Ids of processes with unfinished allocations."""
+        return list(self._tasks)
+
+    async def wait(self) -> None:
+        """Wait until all scheduled allocations are finished or cancelled."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
@@ -0,0 +1,135 @@
+"""Bulk-load session for the inventory SQLite database, for writing and allocating many datasets."""
+
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional, Union
+
+from bw2data.backends import sqlite3_lci_db
+from loguru import logger
+
+# WAL with `synchronous=NORMAL` can lose the last transactions on power loss, but can't corrupt
+# the database
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64_000,  # In KiB
+    "temp_store": "MEMORY",
+}
+# Need to be set outside of a transaction
+OUTSIDE_TRANSACTION = ("journal_mode", "synchronous")
+EXCHANGE_INDEXES = ("exchangedataset_input", "exchangedataset_output")
+
+_active: ContextVar[bool] = ContextVar("multifunctional_bulk_load", default=False)
+
+
+@dataclass
+class BulkLoadReport:
+    """Result of a `bulk_load` session, filled in when the session ends."""
+
+    seconds: float = 0.0
+    rows_changed: int = 0  # Rows inserted, updated, or deleted in the inventory database
+    pragmas: Dict[str, Any] = field(default_factory=dict)  # Settings during the session
+    restored: Dict[str, Any] = field(default_factory=dict)  # Previous settings, restored at the end
+    reindexed: bool = False
+    nested: bool = False  # Inside another session, which manages the settings
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_changed / self.seconds if self.seconds else 0.0
+
+
+def _pragma(name: str, value: Optional[Any] = None) -> Any:
+    if value is None:
+        return sqlite3_lci_db.execute_sql(f"PRAGMA {name}").fetchone()[0]
+    return sqlite3_lci_db.execute_sql(f"PRAGMA {name} = {value}").fetchone()
+
+
+def _set_pragmas(pragmas: Dict[str, Any]) -> Dict[str, Any]:
+    """Set `pragmas`, and return the previous values of those which could be set."""
+    in_transaction = sqlite3_lci_db.db.in_transaction()
+    previous = {}
+    for name, value in pragmas.items():
+        if value is None:
+            continue
+        if in_transaction and name in OUTSIDE_TRANSACTION:
+            logger.warning("Can't set `{n}` inside a transaction; unchanged", n=name)
+            continue
+        before = _pragma(name)
+        try:
+            _pragma(name, value)
+        except sqlite3.OperationalError as err:
+            # E.g. another connection prevents changing the journal mode
+            logger.warning("Can't set `{n}` to {v}: {e}", n=name, v=value, e=err)
+            continue
+        previous[name] = before
+    return previous
+
+
+def _restore_pragmas(previous: Dict[str, Any]) -> None:
+    for name, value in reversed(list(previous.items())):
+        try:
+            _pragma(name, value)
+        except sqlite3.OperationalError as err:
+            logger.warning("Can't restore `{n}` to {v}: {e}", n=name, v=value, e=err)
+
+
+def reindex_exchanges() -> None:
+    """Rebuild the secondary indexes of the exchange table from scratch."""
+    existing = {
+        name
+        for (name,) in sqlite3_lci_db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'exchangedataset'"
+        )
+    }
+    for name in EXCHANGE_INDEXES:
+        if name in existing:
+            sqlite3_lci_db.execute_sql(f'REINDEX "{name}"')
+
+
+@contextmanager
+def bulk_load(
+    transaction: bool = True,
+    reindex: bool = False,
+    **pragmas: Union[str, int, None],
+) -> Iterator[BulkLoadReport]:
+    """Session for writing many rows to the inventory database.
+
+    Sets `journal_mode`, `synchronous`, `cache_size`, and `temp_store` (see `DEFAULT_PRAGMAS`;
+    pass e.g. `synchronous="OFF"` to change them, or `None` to leave a setting unchanged) for the
+    duration of the session, and restores the previous values afterwards, also after errors. With
+    `transaction`, everything inside the session is one transaction, so individual saves don't
+    commit. With `reindex`, the exchange indexes are rebuilt at the end, which compacts them after
+    many deletions and insertions.
+
+    Yields a `BulkLoadReport`. Sessions inside a session only add the transaction."""
+    unknown = set(pragmas).difference(DEFAULT_PRAGMAS)
+    if unknown:
+        raise ValueError(f"Unknown pragmas {sorted(unknown)}; use {sorted(DEFAULT_PRAGMAS)}")
+
+    report = BulkLoadReport()
+    if _active.get():
+        report.nested = True
+        with sqlite3_lci_db.transaction() if transaction else nullcontext():
+            yield report
+        return
+
+    connection = sqlite3_lci_db.db.connection()
+    report.restored = _set_pragmas({**DEFAULT_PRAGMAS, **pragmas})
+    report.pragmas = {name: _pragma(name) for name in report.restored}
+    token = _active.set(True)
+    changes, start = connection.total_changes, time.perf_counter()
+    try:
+        with sqlite3_lci_db.transaction() if transaction else nullcontext():
+            yield report
+        if reindex:
+            reindex_exchanges()
+            report.reindexed = True
+    finally:
+        report.seconds = time.perf_counter() - start
+        report.rows_changed = connection.total_changes - changes
+        _active.reset(token)
+        _restore_pragmas(report.restored)
+        logger.info("Bulk load session: {r}", r=report)
@@ -0,0 +1,295 @@
+"""Rule-based labelling of functional edges, for import data and existing databases."""
+
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from bw2data import databases, get_node, labels
+from bw2data.backends import sqlite3_lci_db
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+
+from .property_index import BATCH_SIZE, build_property_index, has_property_index
+
+Key = Tuple[str, str]
+# Type and name of the node an edge links to
+NodeInfo = Tuple[Optional[str], Optional[str]]
+
+
+@dataclass
+class FunctionalEdgeRule:
+    """Edges which match all the given conditions get `functional`; conditions which are `None`
+    always match.
+
+    * `types`: edge types, e.g. `["production"]`
+    * `input_databases`: databases of the edge input
+    * `product_types`: types of the node the edge links to, e.g. `["product"]`
+    * `amount_sign`: `1` for positive, `-1` for negative, and `0` for zero amounts
+    * `units`: edge units
+    * `name`: regular expression searched in the edge name, or if the edge has no name, in the
+        name of the node it links to"""
+
+    functional: bool = True
+    types: Optional[Sequence[str]] = None
+    input_databases: Optional[Sequence[str]] = None
+    product_types: Optional[Sequence[str]] = None
+    amount_sign: Optional[int] = None
+    units: Optional[Sequence[str]] = None
+    name: Optional[str] = None
+
+
+@dataclass
+class ClassificationReport:
+    edges: int = 0  # Edges checked
+    changed_edges: int = 0  # Edges whose functional label changed
+    functional_edges: int = 0  # Functional edges afterwards
+    changed_nodes: int = 0  # Nodes which changed from or to `multifunctional`
+    multifunctional_nodes: List[Key] = field(default_factory=list)  # Afterwards
+
+
+def _sign(value: float) -> int:
+    return (value > 0) - (value < 0)
+
+
+class FunctionalEdgeClassifier:
+    """Decide which edges are functional with an ordered list of rules; the first matching rule
+    wins. Edges which match no rule get `default`, or keep their current label if `default` is
+    `None`.
+
+    Rules can be `FunctionalEdgeRule` instances or dictionaries with the same fields. They are
+    compiled once to a list of checks, so the classifier can be applied to millions of edges::
+
+        classifier = FunctionalEdgeClassifier(
+            [
+                {"types": ["production"], "amount_sign": 1},
+                {"types": ["technosphere"], "name": "^waste", "amount_sign": -1},
+            ],
+            default=False,
+        )
+        classifier.label_data(data)  # Before `MultifunctionalDatabase.write`
+        classifier.label_database("existing")
+    """
+
+    def __init__(
+        self,
+        rules: Iterable[Union[FunctionalEdgeRule, dict]],
+        default: Optional[bool] = None,
+    ):
+        self.rules = [
+            rule if isinstance(rule, FunctionalEdgeRule) else FunctionalEdgeRule(**rule)
+            for rule in rules
+        ]
+        self.default = default
+        self._compiled = [(self._compile(rule), rule.functional) for rule in self.rules]
+        self.needs_nodes = any(
+            rule.product_types is not None or rule.name is not None for rule in self.rules
+        )
+
+    @staticmethod
+    def _compile(rule: FunctionalEdgeRule) -> list:
+        """List of `check(edge, node info) -> bool`"""
+        checks = []
+        if rule.types is not None:
+            types = frozenset(rule.types)
+            checks.append(lambda edge, node: edge.get("type") in types)
+        if rule.input_databases is not None:
+            input_databases = frozenset(rule.input_databases)
+            checks.append(
+                lambda edge, node: bool(edge.get("input")) and edge["input"][0] in input_databases
+            )
+        if rule.product_types is not None:
+            product_types = frozenset(rule.product_types)
+            checks.append(lambda edge, node: node[0] in product_types)
+        if rule.amount_sign is not None:
+            if rule.amount_sign not in (-1, 0, 1):
+                raise ValueError(f"`amount_sign` must be -1, 0, or 1, but got {rule.amount_sign}")
+            sign = rule.amount_sign
+            checks.append(lambda edge, node: _sign(edge.get("amount", 0)) == sign)
+        if rule.units is not None:
+            units = frozenset(rule.units)
+            checks.append(lambda edge, node: edge.get("unit") in units)
+        if rule.name is not None:
+            pattern = re.compile(rule.name)
+            checks.append(
+                lambda edge, node: pattern.search(edge.get("name") or node[1] or "") is not None
+            )
+        return checks
+
+    def classify(self, edge: dict, node: NodeInfo = (None, None)) -> Optional[bool]:
+        """Functional label for `edge`, or `None` to keep it. `node` is `(type, name)` of the node
+        the edge links to."""
+        for checks, functional in self._compiled:
+            if all(check(edge, node) for check in checks):
+                return functional
+        return self.default
+
+    def _label(
+        self, edges: Iterable[Tuple[dict, NodeInfo]], report: ClassificationReport
+    ) -> List[int]:
+        """Label `edges` in place, and return the positions of the changed edges."""
+        changed = []
+        for position, (edge, node) in enumerate(edges):
+            report.edges += 1
+            label = self.classify(edge, node)
+            if label is not None and label != bool(edge.get("functional")):
+                if label:
+                    edge["functional"] = True
+                else:
+                    del edge["functional"]
+                changed.append(position)
+            report.functional_edges += bool(edge.get("functional"))
+        report.changed_edges += len(changed)
+        return changed
+
+    def label_data(self, data: Dict[Key, dict]) -> ClassificationReport:
+        """Label the edges of import data (`{key: dataset}`, as given to `write`) in place, and
+        set the type of datasets which gain or lose more than one functional edge. Input nodes
+        are looked up in `data`, then in the database."""
+        nodes = {}
+        if self.needs_nodes:
+            nodes = {key: (ds.get("type"), ds.get("name")) for key, ds in data.items()}
+            nodes.update(
+                _node_info(
+                    tuple(exc["input"])
+                    for ds in data.values()
+                    for exc in ds.get("exchanges", [])
+                    if exc.get("input") and tuple(exc["input"]) not in nodes
+                )
+            )
+
+        report = ClassificationReport()
+        for key, ds in data.items():
+            if ds.get("type") == "readonly_process":
+                continue
+            exchanges = ds.get("exchanges", [])
+            self._label(
+                (
+                    (exc, nodes.get(tuple(exc.get("input") or ()), (None, None)))
+                    for exc in exchanges
+                ),
+                report,
+            )
+            functional = sum(1 for exc in exchanges if exc.get("functional"))
+            if functional > 1:
+                report.multifunctional_nodes.append(key)
+                if ds.get("type") != "multifunctional":
+                    ds["type"] = "multifunctional"
+                    report.changed_nodes += 1
+            elif ds.get("type") == "multifunctional":
+                ds["type"] = labels.process_node_default
+                report.changed_nodes += 1
+        return report
+
+    def label_database(self, database_label: str) -> ClassificationReport:
+        """Label the edges of an existing database in one transaction, directly in SQLite and
+        without save signals.
+
+        Processes with more than one functional edge get the type `multifunctional`. Processes
+        which lose their second functional edge are saved normally, which removes their
+        allocated processes. The database is marked as dirty, and the property index is rebuilt
+        if present; call `process()` to allocate the new multifunctional processes."""
+        if database_label not in databases:
+            raise ValueError(f"Database `{database_label}` not defined in this project")
+
+        report = ClassificationReport()
+        with sqlite3_lci_db.transaction():
+            types = dict(
+                ActivityDataset.select(ActivityDataset.code, ActivityDataset.type)
+                .where(ActivityDataset.database == database_label)
+                .tuples()
+            )
+            query = (
+                ExchangeDataset.select(
+                    ExchangeDataset.id,
+                    ExchangeDataset.output_code,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.data,
+                )
+                .where(ExchangeDataset.output_database == database_label)
+                .tuples()
+            )
+            # Edges of allocated processes are allocation results
+            rows = [
+                (edge_id, output_code, (input_database, input_code), data)
+                for edge_id, output_code, input_database, input_code, data in query.iterator()
+                if types.get(output_code) != "readonly_process"
+            ]
+            nodes = _node_info({key for _, _, key, _ in rows}) if self.needs_nodes else {}
+            changed = self._label(
+                ((data, nodes.get(key, (None, None))) for _, _, key, data in rows), report
+            )
+            cursor = sqlite3_lci_db.db.cursor()
+            cursor.executemany(
+                f"UPDATE {ExchangeDataset._meta.table_name} SET data = ? WHERE id = ?",
+                [(ExchangeDataset.data.db_value(rows[i][3]), rows[i][0]) for i in changed],
+            )
+
+            functional: Dict[str, int] = {}
+            for _, output_code, _, data in rows:
+                functional[output_code] = functional.get(output_code, 0) + bool(
+                    data.get("functional")
+                )
+            promoted = sorted(
+                code
+                for code, number in functional.items()
+                if number > 1 and types.get(code) != "multifunctional"
+            )
+            demoted = sorted(
+                code
+                for code, kind in types.items()
+                if kind == "multifunctional" and functional.get(code, 0) < 2
+            )
+            updates = []
+            for start in range(0, len(promoted), BATCH_SIZE):
+                for node_id, data in (
+                    ActivityDataset.select(ActivityDataset.id, ActivityDataset.data)
+                    .where(
+                        ActivityDataset.database == database_label,
+                        ActivityDataset.code << promoted[start : start + BATCH_SIZE],
+                    )
+                    .tuples()
+                ):
+                    data["type"] = "multifunctional"
+                    updates.append((ActivityDataset.data.db_value(data), node_id))
+            cursor.executemany(
+                f"UPDATE {ActivityDataset._meta.table_name} SET type = 'multifunctional', "
+                "data = ? WHERE id = ?",
+                updates,
+            )
+            for code in demoted:
+                node = get_node(database=database_label, code=code)
+                node["type"] = labels.process_node_default
+                node.save()
+
+            report.changed_nodes = len(promoted) + len(demoted)
+            report.multifunctional_nodes = [
+                (database_label, code) for code, number in sorted(functional.items()) if number > 1
+            ]
+            if has_property_index(database_label):
+                build_property_index(database_label)
+
+        databases.set_dirty(database_label)
+        return report
+
+
+def _node_info(keys: Iterable[Key]) -> Dict[Key, NodeInfo]:
+    """`{key: (type, name)}` of existing nodes, with one query per `BATCH_SIZE` keys."""
+    by_database: Dict[str, List[str]] = {}
+    for database, code in sorted(set(keys)):
+        by_database.setdefault(database, []).append(code)
+
+    nodes = {}
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            for code, kind, name in (
+                ActivityDataset.select(
+                    ActivityDataset.code, ActivityDataset.type, ActivityDataset.name
+                )
+                .where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                )
+                .tuples()
+            ):
+                nodes[(database, code)] = (kind, name)
+    return nodes
@@ -0,0 +1,261 @@
+from dataclasses import dataclass
+from numbers import Number
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+from bw2data import databases
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+
+from .property_index import (
+    BATCH_SIZE,
+    FunctionalEdgeIndex,
+    PropertyIndex,
+    has_property_index,
+    is_numeric,
+)
+from .supplemental import EMPTY
+from .utils import ensure_tables
+
+
+@dataclass
+class PropertyColumn:
+    """Values of one property label for every edge in a `FunctionalEdgeTable`."""
+
+    values: np.ndarray  # float, `nan` where missing or non-numeric
+    raw: List  # Values as given, `None` where missing
+    present: np.ndarray  # bool
+    numeric: np.ndarray  # bool; numbers but not booleans
+    number: np.ndarray  # bool; instances of `numbers.Number`, including booleans
+
+
+@dataclass
+class FunctionalEdgeTable:
+    """Columnar view of functional edges and the properties of the nodes they link to.
+
+    Property dictionaries are shared with the source data and should not be modified. Edge
+    properties take precedence over product properties, as in `layered_properties`."""
+
+    process_id: np.ndarray  # int64
+    edge_id: np.ndarray  # int64, -1 if not saved yet
+    product_id: np.ndarray  # int64, -1 if the input node doesn't exist
+    product_type: np.ndarray  # object, `None` if the input node doesn't exist
+    amount: np.ndarray  # float
+    edge_properties: List[Mapping]
+    product_properties: List[Mapping]
+
+    def __len__(self) -> int:
+        return len(self.edge_id)
+
+    @property
+    def input_is_readonly(self) -> np.ndarray:
+        return self.product_type == "readonly_process"
+
+    def property_column(self, label: str) -> PropertyColumn:
+        raw, present = [], np.zeros(len(self), dtype=bool)
+        for i, (edge, product) in enumerate(zip(self.edge_properties, self.product_properties)):
+            if label in edge:
+                raw.append(edge[label])
+                present[i] = True
+            elif label in product:
+                raw.append(product[label])
+                present[i] = True
+            else:
+                raw.append(None)
+        numeric = np.fromiter((is_numeric(x) for x in raw), dtype=bool, count=len(raw))
+        number = np.fromiter((isinstance(x, Number) for x in raw), dtype=bool, count=len(raw))
+        values = np.full(len(self), np.nan)
+        for i in np.flatnonzero(numeric):
+            try:
+                values[i] = raw[i]
+            except TypeError:
+                # E.g. complex numbers
+                pass
+        return PropertyColumn(
+            values=values, raw=raw, present=present, numeric=numeric, number=number
+        )
+
+    def subset(self, mask: np.ndarray) -> "FunctionalEdgeTable":
+        indices = np.flatnonzero(mask)
+        return FunctionalEdgeTable(
+            process_id=self.process_id[indices],
+            edge_id=self.edge_id[indices],
+            product_id=self.product_id[indices],
+            product_type=self.product_type[indices],
+            amount=self.amount[indices],
+            edge_properties=[self.edge_properties[i] for i in indices],
+            product_properties=[self.product_properties[i] for i in indices],
+        )
+
+    def labels(self) -> set:
+        labels = set()
+        for properties in self.edge_properties + self.product_properties:
+            labels.update(properties)
+        return labels
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: Iterable[Tuple[int, int, Optional[int], Optional[str], float, dict, dict]],
+    ) -> "FunctionalEdgeTable":
+        """Build from `(process_id, edge_id, product_id, product_type, amount, edge_properties,
+        product_properties)` rows."""
+        rows = list(rows)
+        return cls(
+            process_id=np.array([row[0] for row in rows], dtype=np.int64),
+            edge_id=np.array([row[1] for row in rows], dtype=np.int64),
+            product_id=np.array([-1 if row[2] is None else row[2] for row in rows], dtype=np.int64),
+            product_type=np.array([row[3] for row in rows], dtype=object),
+            amount=np.array([np.nan if row[4] is None else row[4] for row in rows], dtype=float),
+            edge_properties=[row[5] for row in rows],
+            product_properties=[row[6] for row in rows],
+        )
+
+    @classmethod
+    def from_dataset(
+        cls, dataset: dict, product_properties: Optional[Dict[int, Mapping]] = None
+    ) -> "FunctionalEdgeTable":
+        """Functional edges of a dataset dictionary, as used during allocation.
+
+        Properties of linked product nodes are not looked up; they can be given as `{position in
+        dataset['exchanges']: properties}` (see `product_node_properties`)."""
+        process_id = dataset.get("id") or -1
+        product_properties = product_properties or EMPTY
+        return cls.from_rows(
+            (
+                process_id,
+                exc.get("id") or -1,
+                None,
+                None,
+                exc.get("amount"),
+                exc.get("properties") or EMPTY,
+                product_properties.get(position) or EMPTY,
+            )
+            for position, exc in enumerate(dataset.get("exchanges", []))
+            if exc.get("functional")
+        )
+
+    @classmethod
+    def from_database(
+        cls, database_label: str, process_ids: Optional[Iterable[int]] = None
+    ) -> "FunctionalEdgeTable":
+        """Load all functional edges of `multifunctional` processes in a database.
+
+        Uses the property index if available; otherwise loads edges with one query and the linked
+        nodes with one query per batch of codes."""
+        if database_label not in databases:
+            raise ValueError(f"Database `{database_label}` not defined in this project")
+        if process_ids is not None:
+            process_ids = set(process_ids)
+        if has_property_index(database_label):
+            return cls.from_rows(_rows_from_index(database_label, process_ids))
+        return cls.from_rows(_rows_from_database(database_label, process_ids))
+
+
+def _load_nodes(keys: Iterable[Tuple[str, str]]) -> dict:
+    by_database = {}
+    for database, code in keys:
+        by_database.setdefault(database, set()).add(code)
+
+    nodes = {}
+    for database, codes in by_database.items():
+        codes = sorted(codes)
+        for start in range(0, len(codes), BATCH_SIZE):
+            for code, node_id, node_type, data in (
+                ActivityDataset.select(
+                    ActivityDataset.code,
+                    ActivityDataset.id,
+                    ActivityDataset.type,
+                    ActivityDataset.data,
+                )
+                .where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                )
+                .tuples()
+            ):
+                nodes[(database, code)] = (node_id, node_type, data.get("properties") or EMPTY)
+    return nodes
+
+
+def _rows_from_database(database_label: str, process_ids: Optional[set]) -> List[tuple]:
+    processes = {
+        code: node_id
+        for code, node_id in ActivityDataset.select(ActivityDataset.code, ActivityDataset.id)
+        .where(
+            ActivityDataset.database == database_label,
+            ActivityDataset.type == "multifunctional",
+        )
+        .tuples()
+        if process_ids is None or node_id in process_ids
+    }
+    edges = [
+        (processes[output_code], edge_id, (input_database, input_code), data)
+        for edge_id, output_code, input_database, input_code, data in ExchangeDataset.select(
+            ExchangeDataset.id,
+            ExchangeDataset.output_code,
+            ExchangeDataset.input_database,
+            ExchangeDataset.input_code,
+            ExchangeDataset.data,
+        )
+        .where(ExchangeDataset.output_database == database_label)
+        .tuples()
+        .iterator()
+        if output_code in processes and data.get("functional")
+    ]
+    nodes = _load_nodes(key for _, _, key, _ in edges)
+    missing = (None, None, EMPTY)
+    return [
+        (
+            process_id,
+            edge_id,
+            *nodes.get(key, missing)[:2],
+            data.get("amount"),
+            data.get("properties") or EMPTY,
+            nodes.get(key, missing)[2],
+        )
+        for process_id, edge_id, key, data in sorted(edges, key=lambda x: x[:2])
+    ]
+
+
+def _rows_from_index(database_label: str, process_ids: Optional[set]) -> List[tuple]:
+    db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    edges = [
+        row
+        for row in db.execute_sql(
+            f"""
+SELECT fe.process_id, fe.edge_id, a.id, a.type, fe.amount
+FROM {FunctionalEdgeIndex._meta.table_name} AS fe
+LEFT JOIN activitydataset AS a
+    ON a.database = fe.input_database AND a.code = fe.input_code
+WHERE fe.database = ?
+ORDER BY fe.process_id, fe.edge_id""",
+            [database_label],
+        )
+        if process_ids is None or row[0] in process_ids
+    ]
+    properties = {"edge": {}, "product": {}}
+    for source, owner_id, label, raw in db.execute_sql(
+        f"""
+SELECT p.source, p.owner_id, p.label, p.raw
+FROM {FunctionalEdgeIndex._meta.table_name} AS fe
+LEFT JOIN activitydataset AS a
+    ON a.database = fe.input_database AND a.code = fe.input_code
+JOIN {PropertyIndex._meta.table_name} AS p
+    ON (p.source = 'edge' AND p.owner_id = fe.edge_id)
+    OR (p.source = 'product' AND p.owner_id = a.id)
+WHERE fe.database = ?""",
+        [database_label],
+    ):
+        properties[source].setdefault(owner_id, {})[label] = PropertyIndex.raw.python_value(raw)
+    return [
+        (
+            process_id,
+            edge_id,
+            product_id,
+            product_type,
+            amount,
+            properties["edge"].get(edge_id, EMPTY),
+            properties["product"].get(product_id, EMPTY),
+        )
+        for process_id, edge_id, product_id, product_type, amount in edges
+    ]
@@ -1,19 +1,27 @@
 import logging
-from copy import copy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+from functools import cached_property, partial
 from numbers import Number
-from typing import List, Optional, Union
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Tuple, Union
 
-from blinker import signal
-from bw2data import Database, databases
+import numpy as np
+from bw2data import databases, get_node
 from bw2data.backends import Exchange, Node
-from bw2data.project import ProjectDataset, projects
+from bw2data.backends.schema import ExchangeDataset
+from bw2data.project import projects
 
-from . import allocation_strategies
-from .allocation import property_allocation
+from .allocation import allocation_strategies, strategy_from_specification
+from .columnar import FunctionalEdgeTable
+from .property_index import (
+    has_property_index,
+    indexed_property_values,
+    is_numeric,
+)
+from .registry import SPECIFICATIONS
+from .supplemental import layered_properties
 
-DEFAULT_ALLOCATIONS = set(allocation_strategies)
+DEFAULT_ALLOCATIONS = set(allocation_strategies.defaults)
 
 
 class MessageType(Enum):
@@ -26,23 +34,33 @@ class MessageType(Enum):
     ALL_VALID = "All properties found and have correct type"
 
 
+_MESSAGE_LEVELS = {
+    # Problems in the order they are checked, see `_classify_property`
+    MessageType.MISSING_PRODUCT_PROPERTY: logging.WARNING,
+    MessageType.MISSING_EDGE_PROPERTY: logging.WARNING,
+    MessageType.NONNUMERIC_PRODUCT_PROPERTY: logging.CRITICAL,
+    MessageType.NONNUMERIC_EDGE_PROPERTY: logging.CRITICAL,
+}
+_CHECK_ORDER = tuple(_MESSAGE_LEVELS)
+
+
 @dataclass
 class PropertyMessage:
     level: int  # logging levels WARNING and CRITICAL
     process_id: int  # Can get object with bw2data.get_node(id=process_id)
     product_id: int  # Can get object with bw2data.get_node(id=product_id)
     message_type: MessageType  # Computer-readable error message type
-    message: str  # Human-readable error message
+    # Builds the human-readable `message`. Rendering needs node lookups, so only done when needed.
+    render: Callable[[], str] = field(repr=False, compare=False)
+
+    @cached_property
+    def message(self) -> str:
+        """Human-readable error message"""
+        return self.render()
 
 
-def _get_unified_properties(edge: Exchange):
-    try:
-        properties = copy(edge.input["properties"])
-    except KeyError:
-        properties = {}
-    if "properties" in edge:
-        properties.update(edge["properties"])
-    return properties
+def _get_unified_properties(edge: Exchange) -> Mapping:
+    return layered_properties(edge.get("properties"), edge.input.get("properties"))
 
 
 def list_available_properties(database_label: str, target_process: Optional[Node] = None):
@@ -62,28 +80,27 @@ def list_available_properties(database_label: str, target_process: Optional[Node
     if target_process is not None and target_process.get("database") != database_label:
         raise ValueError(f"Target process must be also in database `{database_label}`")
 
-    results = []
-    all_properties = set()
+    table = FunctionalEdgeTable.from_database(database_label)
+    all_properties = table.labels()
+
+    if target_process is not None:
+        if target_process["type"] != "multifunctional":
+            return [(label, MessageType.ALL_VALID) for label in all_properties]
+        table = table.subset(table.process_id == target_process.id)
 
-    for ds in filter(lambda x: x["type"] == "multifunctional", Database(database_label)):
-        for edge in filter(lambda x: x.get("functional"), ds.exchanges()):
-            for key in _get_unified_properties(edge):
-                all_properties.add(key)
+    problems = {}
+    for label, _, message_type, _ in _find_property_problems(table, all_properties):
+        problems.setdefault(label, set()).add(message_type)
 
+    results = []
     for label in all_properties:
-        if target_process is None:
-            check_results = check_property_for_allocation(database_label, label)
-        else:
-            check_results = check_property_for_process_allocation(target_process, label)
-        if check_results is True:
+        if label not in problems:
             results.append((label, MessageType.ALL_VALID))
-        elif any(
-            msg.message_type
-            in (
+        elif problems[label].intersection(
+            (
                 MessageType.NONNUMERIC_PRODUCT_PROPERTY,
                 MessageType.NONNUMERIC_EDGE_PROPERTY,
             )
-            for msg in check_results
         ):
             results.append((label, MessageType.NONNUMERIC_PROPERTY))
         else:
@@ -92,125 +109,320 @@ def list_available_properties(database_label: str, target_process: Optional[Node
     return results
 
 
-def check_property_for_process_allocation(
-    process: Node, property_label: str, messages: Optional[List[PropertyMessage]] = None
-) -> Union[bool, List[PropertyMessage]]:
-    """
-    Check that the given property is present for all functional edges in a given process.
-
-    `process`: Multifunctional process `Node`.
-    `property_label`: String label of the property to be used for allocation.
-
-    If all the needed data is present, returns `True`.
-
-    If there is missing data, returns a list of `PropertyMessage` objects.
-    """
-    if messages is None:
-        messages = []
-
-    if process["type"] != "multifunctional":
-        return True
-
-    for edge in filter(lambda x: x.get("functional"), process.exchanges()):
-        properties = _get_unified_properties(edge)
-        if property_label not in properties and edge.input["type"] != "readonly_process":
-            messages.append(
-                PropertyMessage(
-                    level=logging.WARNING,
-                    process_id=process.id,
-                    product_id=edge.input.id,
-                    message_type=MessageType.MISSING_PRODUCT_PROPERTY,
-                    message=f"""Product is missing a property value for `{property_label}`.
+def _render_property_message(
+    message_type: MessageType,
+    property_label: str,
+    process: Union[Node, int],
+    edge: Union[Exchange, int],
+    product: Union[Node, int],
+    value: Any = None,
+) -> str:
+    """Build the human-readable message. Nodes and edges can be given as ids, and are only loaded
+    when needed."""
+    if isinstance(process, int):
+        process = get_node(id=process)
+    if message_type in (
+        MessageType.MISSING_PRODUCT_PROPERTY,
+        MessageType.NONNUMERIC_PRODUCT_PROPERTY,
+    ):
+        if isinstance(product, int):
+            product = get_node(id=product)
+    elif isinstance(edge, int):
+        edge = Exchange(ExchangeDataset.get_by_id(edge))
+
+    if message_type == MessageType.MISSING_PRODUCT_PROPERTY:
+        return f"""Product is missing a property value for `{property_label}`.
 Please define this property for the product:
-    {edge.input}
+    {product}
 Referenced by multifunctional process:
     {process}
 
-""",
-                )
-            )
-        elif property_label not in properties:
-            messages.append(
-                PropertyMessage(
-                    level=logging.WARNING,
-                    process_id=process.id,
-                    product_id=edge.input.id,
-                    message_type=MessageType.MISSING_EDGE_PROPERTY,
-                    message=f"""Functional edge is missing a property value for `{property_label}`.
+"""
+    elif message_type == MessageType.MISSING_EDGE_PROPERTY:
+        return f"""Functional edge is missing a property value for `{property_label}`.
 Please define this property for the edge:
     {edge}
 Found in multifunctional process:
     {process}
 
-""",
-                )
-            )
-        elif (
-            not isinstance(properties[property_label], Number)
-            or isinstance(properties[property_label], bool)
-            and edge.input["type"] != "readonly_process"
-        ):
-            messages.append(
-                PropertyMessage(
-                    level=logging.CRITICAL,
-                    process_id=process.id,
-                    product_id=edge.input.id,
-                    message_type=MessageType.NONNUMERIC_PRODUCT_PROPERTY,
-                    message=f"""Found non-numeric value `{properties[property_label]}` in property `{property_label}`.
+"""
+    elif message_type == MessageType.NONNUMERIC_PRODUCT_PROPERTY:
+        return f"""Found non-numeric value `{value}` in property `{property_label}`.
 Please redefine this property for the product:
-    {edge.input}
+    {product}
 Referenced by multifunctional process:
     {process}
 
-""",
-                )
-            )
-        elif not isinstance(properties[property_label], Number) or isinstance(
-            properties[property_label], bool
-        ):
-            messages.append(
-                PropertyMessage(
-                    level=logging.CRITICAL,
-                    process_id=process.id,
-                    product_id=edge.input.id,
-                    message_type=MessageType.NONNUMERIC_EDGE_PROPERTY,
-                    message=f"""Found non-numeric value `{properties[property_label]}` in property `{property_label}`.
+"""
+    else:
+        return f"""Found non-numeric value `{value}` in property `{property_label}`.
 Please redefine this property for the edge:
     {edge}
 Found in multifunctional process:
     {process}
 
-""",
-                )
+"""
+
+
+def _property_message(
+    message_type: MessageType,
+    property_label: str,
+    process_id: int,
+    product_id: int,
+    process: Union[Node, int, None] = None,
+    edge: Union[Exchange, int, None] = None,
+    product: Union[Node, int, None] = None,
+    value: Any = None,
+) -> PropertyMessage:
+    return PropertyMessage(
+        level=_MESSAGE_LEVELS[message_type],
+        process_id=process_id,
+        product_id=product_id,
+        message_type=message_type,
+        render=partial(
+            _render_property_message,
+            message_type=message_type,
+            property_label=property_label,
+            process=process_id if process is None else process,
+            edge=edge,
+            product=product_id if product is None else product,
+            value=value,
+        ),
+    )
+
+
+def _classify_property(present: bool, value: Any, input_is_readonly: bool) -> Optional[MessageType]:
+    """Return the problem with a property value, or `None` if the value can be used."""
+    if not present and not input_is_readonly:
+        return MessageType.MISSING_PRODUCT_PROPERTY
+    elif not present:
+        return MessageType.MISSING_EDGE_PROPERTY
+    elif not is_numeric(value) and (not isinstance(value, Number) or not input_is_readonly):
+        return MessageType.NONNUMERIC_PRODUCT_PROPERTY
+    elif not is_numeric(value):
+        return MessageType.NONNUMERIC_EDGE_PROPERTY
+    return None
+
+
+def _check_limit(limit: Optional[int]) -> None:
+    # With no messages, a `limit` of zero would look like valid properties
+    if limit is not None and limit < 1:
+        raise ValueError(f"`limit` must be positive, but got {limit}")
+
+
+def _indexed_property_messages(
+    database_label: str,
+    property_label: str,
+    messages: List[PropertyMessage],
+    process_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> int:
+    """Add messages for problems found in the property index. Returns the number of problems."""
+    count = 0
+    for row in indexed_property_values(database_label, property_label, process_id):
+        message_type = _classify_property(
+            present=row.source is not None,
+            value=row.raw,
+            input_is_readonly=row.product_type == "readonly_process",
+        )
+        if message_type is None:
+            continue
+        count += 1
+        if limit is not None and len(messages) >= limit:
+            continue
+        messages.append(
+            _property_message(
+                message_type=message_type,
+                property_label=property_label,
+                process_id=row.process_id,
+                product_id=row.product_id,
+                edge=row.edge_id,
+                value=row.raw,
             )
+        )
+    return count
 
-    return messages or True
+
+def check_property_for_process_allocation(
+    process: Node,
+    property_label: str,
+    messages: Optional[List[PropertyMessage]] = None,
+    limit: Optional[int] = None,
+    count_only: bool = False,
+) -> Union[bool, int, List[PropertyMessage]]:
+    """
+    Check that the given property is present for all functional edges in a given process.
+
+    `process`: Multifunctional process `Node`.
+    `property_label`: String label of the property to be used for allocation.
+    `limit`: Optional, positive. Stop adding messages once `messages` has this many entries.
+    `count_only`: Optional. Only count the problems found, don't create any messages.
+
+    If all the needed data is present, returns `True`.
+
+    If there is missing data, returns a list of `PropertyMessage` objects.
+
+    If `count_only`, returns the number of problems found instead.
+    """
+    _check_limit(limit)
+    if messages is None:
+        messages = []
+
+    if process["type"] != "multifunctional":
+        return 0 if count_only else True
+
+    if has_property_index(process["database"]):
+        count = _indexed_property_messages(
+            process["database"], property_label, messages, process.id, 0 if count_only else limit
+        )
+        return count if count_only else messages or True
+
+    count = 0
+    for edge in filter(lambda x: x.get("functional"), process.exchanges()):
+        if not count_only and limit is not None and len(messages) >= limit:
+            break
+        properties = _get_unified_properties(edge)
+        message_type = _classify_property(
+            present=property_label in properties,
+            value=properties.get(property_label),
+            input_is_readonly=edge.input["type"] == "readonly_process",
+        )
+        if message_type is None:
+            continue
+        count += 1
+        if count_only:
+            continue
+        messages.append(
+            _property_message(
+                message_type=message_type,
+                property_label=property_label,
+                process_id=process.id,
+                product_id=edge.input.id,
+                process=process,
+                edge=edge,
+                product=edge.input,
+                value=properties.get(property_label),
+            )
+        )
+
+    return count if count_only else messages or True
 
 
 def check_property_for_allocation(
-    database_label: str, property_label: str
-) -> Union[bool, List[PropertyMessage]]:
+    database_label: str,
+    property_label: str,
+    limit: Optional[int] = None,
+    count_only: bool = False,
+) -> Union[bool, int, List[PropertyMessage]]:
     """
     Check that the given property is present for all functional edges in `multifunctional`
     processes.
 
     `database_label`: String label of an existing database.
     `property_label`: String label of the property to be used for allocation.
+    `limit`: Optional, positive. Only return messages for the first `limit` problems found.
+    `count_only`: Optional. Only count the problems found, don't create any messages.
 
     If all the needed data is present, returns `True`.
 
     If there is missing data, returns a list of `PropertyMessage` objects.
+
+    If `count_only`, returns the number of problems found instead.
     """
     if database_label not in databases:
         raise ValueError(f"Database `{database_label}` not defined in this project")
+    _check_limit(limit)
 
-    db = Database(database_label)
-    messages = []
+    if count_only:
+        return check_properties_for_allocation(database_label, [property_label], count_only=True)
+    _, messages = check_properties_for_allocation(
+        database_label, [property_label], messages=True, limit=limit
+    )
+    return messages or True
 
-    for ds in filter(lambda x: x["type"] == "multifunctional", db):
-        check_property_for_process_allocation(ds, property_label, messages)
 
-    return messages or True
+def _find_property_problems(table: FunctionalEdgeTable, labels: Iterable[str]) -> List[tuple]:
+    """Vectorized version of `_classify_property`.
+
+    Returns a list of `(label, row index, MessageType, value)` for each problem."""
+    readonly = table.input_is_readonly
+    found = []
+    for label in labels:
+        column = table.property_column(label)
+        codes = np.select(
+            [
+                ~column.present & ~readonly,
+                ~column.present,
+                ~column.numeric & (~column.number | ~readonly),
+                ~column.numeric,
+            ],
+            np.arange(len(_CHECK_ORDER)),
+            default=-1,
+        )
+        for index in np.flatnonzero(codes >= 0):
+            found.append((label, index, _CHECK_ORDER[codes[index]], column.raw[index]))
+    return found
+
+
+def check_properties_for_allocation(
+    database_label: str,
+    labels: Iterable[str],
+    messages: bool = False,
+    limit: Optional[int] = None,
+    count_only: bool = False,
+) -> Union[int, np.recarray, Tuple[np.recarray, List[PropertyMessage]]]:
+    """
+    Check many properties for all functional edges in `multifunctional` processes at once.
+
+    `database_label`: String label of an existing database.
+    `labels`: Iterable of string labels of the properties to check.
+    `messages`: Also return `PropertyMessage` objects for each problem found.
+    `limit`: Optional, positive. Only return the first `limit` problems found.
+    `count_only`: Optional. Only return the number of problems found.
+
+    Functional edges and product properties are loaded once, and each label is checked for all
+    edges at once. Gives the same results as calling `check_property_for_allocation` for each label.
+
+    Returns a NumPy record array with one row per problem found, with the fields `label`,
+    `process_id`, `edge_id`, `product_id`, `level`, and `message_type` (the name of a
+    `MessageType`). The array is empty if all properties are valid. If `messages` is `True`,
+    returns a tuple of the record array and a list of `PropertyMessage` objects.
+    """
+    _check_limit(limit)
+    labels = list(labels)
+    table = FunctionalEdgeTable.from_database(database_label)
+    found = _find_property_problems(table, labels)
+    if count_only:
+        return len(found)
+    if limit is not None:
+        found = found[:limit]
+
+    indices = [index for _, index, _, _ in found]
+    result = np.rec.fromarrays(
+        [
+            np.array([label for label, *_ in found], dtype=f"U{max(map(len, labels), default=1)}"),
+            table.process_id[indices],
+            table.edge_id[indices],
+            table.product_id[indices],
+            np.array([_MESSAGE_LEVELS[kind] for _, _, kind, _ in found], dtype=np.int16),
+            np.array([kind.name for _, _, kind, _ in found], dtype="U27"),
+        ],
+        names=["label", "process_id", "edge_id", "product_id", "level", "message_type"],
+    )
+    if not messages:
+        return result
+
+    return result, [
+        _property_message(
+            message_type=kind,
+            property_label=label,
+            process_id=int(table.process_id[index]),
+            product_id=int(table.product_id[index]),
+            edge=int(table.edge_id[index]),
+            value=value,
+        )
+        for label, index, kind, value in found
+    ]
 
 
 def add_custom_property_allocation_to_project(
@@ -233,30 +445,43 @@ def add_custom_property_allocation_to_project(
     if property_label in allocation_strategies:
         raise KeyError(f"`{property_label}` already defined in `allocation_strategies`")
 
-    allocation_strategies[property_label] = property_allocation(
-        property_label=property_label,
-        normalize_by_production_amount=normalize_by_production_amount,
-    )
-
-    if "multifunctional.custom_allocations" not in projects.dataset.data:
-        projects.dataset.data["multifunctional.custom_allocations"] = {}
-
-    projects.dataset.data["multifunctional.custom_allocations"][property_label] = {
+    specification = {
         "property_label": property_label,
         "normalize_by_production_amount": normalize_by_production_amount,
     }
+    allocation_strategies.register(
+        property_label, specification, strategy_from_specification(specification)
+    )
+
+    if SPECIFICATIONS not in projects.dataset.data:
+        projects.dataset.data[SPECIFICATIONS] = {}
+
+    projects.dataset.data[SPECIFICATIONS][property_label] = specification
     projects.dataset.save()
 
 
-def update_allocation_strategies_on_project_change(
-    project_dataset: ProjectDataset,
-) -> None:
-    """Fix the single dict `allocation_strategies` to reflect custom data for this project."""
-    for obsolete in set(allocation_strategies).difference(DEFAULT_ALLOCATIONS):
-        del allocation_strategies[obsolete]
+def add_custom_expression_allocation_to_project(label: str, expression: str) -> None:
+    """
+    Add a new expression-based allocation method to `allocation_strategies`, and persist to a
+    project dataset.
+
+    Note that this function **does not** mark the created function as the default allocation
+    anywhere.
+
+    `label` is the string label for the new allocation strategy.
 
-    for key, value in project_dataset.data.get("multifunctional.custom_allocations", {}).items():
-        allocation_strategies[key] = property_allocation(**value)
+    `expression` is an arithmetic expression over functional edge properties, like `price * mass`
+    or `energy_content * amount / density`. See `AllocationExpression` for the allowed syntax. The
+    expression is validated before being added.
+    """
+    if label in allocation_strategies:
+        raise KeyError(f"`{label}` already defined in `allocation_strategies`")
 
+    specification = {"expression": expression}
+    allocation_strategies.register(label, specification, strategy_from_specification(specification))
 
-signal("bw2data.project_changed").connect(update_allocation_strategies_on_project_change)
+    if SPECIFICATIONS not in projects.dataset.data:
+        projects.dataset.data[SPECIFICATIONS] = {}
+
+    projects.dataset.data[SPECIFICATIONS][label] = specification
+    projects.dataset.save()
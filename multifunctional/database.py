@@ -1,10 +1,46 @@
-from typing import Optional
+import gc
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from itertools import chain, islice, takewhile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
 
-from bw2data.backends import SQLiteBackend
-from bw2data.backends.schema import ActivityDataset
+from bw2data import databases
+from bw2data.backends import SQLiteBackend, sqlite3_lci_db
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from loguru import logger
 
+from .bulk_load import BulkLoadReport, bulk_load
+from .deferred import deferred_side_effects
+from .instrumentation import phase
+from .node_classes import BaseMultifunctionalNode
 from .node_dispatch import multifunctional_node_dispatcher
-from .utils import add_exchange_input_if_missing, label_multifunctional_nodes
+from .property_index import BATCH_SIZE, build_property_index, has_property_index
+from .snapshots import (
+    allocation_snapshots,
+    delete_allocation_snapshot,
+    restore_allocation,
+    snapshot_allocation,
+)
+from .supply_chain import (
+    DemandReport,
+    demand_keys,
+    functional_products,
+    supply_chain_cache,
+    walk_supply_chain,
+)
+from .utils import (
+    add_exchange_input_if_missing,
+    current_rss,
+    label_multifunctional_nodes,
+    peak_rss,
+)
+
+DEFAULT_CHUNK_SIZE = 100
+# Database metadata key for the progress of chunked processing
+CHECKPOINT = "mf_process_checkpoint"
 
 
 def multifunctional_dispatcher_method(
@@ -13,6 +49,21 @@ def multifunctional_dispatcher_method(
     return multifunctional_node_dispatcher(document)
 
 
+@dataclass
+class ProcessingReport:
+    """Summary of chunked or bulk processing. Memory values are in bytes."""
+
+    nodes: int = 0
+    chunks: int = 0
+    chunk_size: int = 0  # At the end; reduced if over the memory budget
+    max_chunk_rss: int = 0  # Highest resident memory measured after a chunk
+    peak_rss: int = 0  # Highest resident memory of this Python process so far
+    seconds: float = 0.0
+    resumed: int = 0  # Processes skipped because they were allocated before the checkpoint
+    repaired: int = 0  # Processes before the checkpoint allocated again as inconsistent
+    bulk_load: Optional[BulkLoadReport] = None
+
+
 SIMAPRO_ATTRIBUTES = (
     "simapro_project",
     "simapro_libraries",
@@ -46,6 +97,16 @@ class MultifunctionalDatabase(SQLiteBackend):
     Stores default allocation strategies per database in the `Database` metadata dictionary:
 
     * `default_allocation`: str. Reference to function in `multifunctional.allocation_strategies`.
+    * `property_index`: bool. Maintain the secondary property index; set by
+        `multifunctional.build_property_index`.
+    * `zero_allocation_stubs`: bool. Read-only processes for zero allocation factors only get their
+        functional edge.
+    * `allocation_tolerance`: float. Leave out allocated non-functional edges whose absolute
+        amount is below this value.
+    * `mf_process_checkpoint`: dict. Progress of interrupted chunked processing; set and removed
+        by `process`.
+    * `searchable_readonly_processes`: bool, default `True`. Add the read-only processes created
+        by `process` to the search index.
 
     Each database has one default allocation, but individual processes can also have specific
     default allocation strategies in `MultifunctionalProcess['default_allocation']`.
@@ -57,16 +118,347 @@ class MultifunctionalDatabase(SQLiteBackend):
     backend = "multifunctional"
     node_class = multifunctional_dispatcher_method
 
-    def write(self, data: dict, **kwargs) -> None:
+    def write(
+        self, data: dict, process: bool = True, bulk: Union[bool, dict] = False, **kwargs
+    ) -> None:
+        """Write `data`, and process it if `process`. With `bulk`, writing and processing happen in
+        a `bulk_load` session; `bulk` can be a dictionary of `bulk_load` arguments."""
         data = label_multifunctional_nodes(add_exchange_input_if_missing(data))
-        super().write(data, **kwargs)
+        # `SQLiteBackend.write` manages its own transaction
+        with self._bulk_load(bulk, transaction=False):
+            super().write(data, process=False, **kwargs)
+            if has_property_index(self.name):
+                # Bulk inserts don't trigger the index save hooks
+                build_property_index(self.name)
+            if process:
+                self.process(bulk=bulk)
+
+    @staticmethod
+    def _bulk_load(bulk: Union[bool, dict], transaction: bool):
+        if not bulk:
+            return nullcontext()
+        options = {"transaction": transaction, **(bulk if isinstance(bulk, dict) else {})}
+        return bulk_load(**options)
+
+    @property
+    def _is_simapro(self) -> bool:
+        return any(key in self.metadata for key in SIMAPRO_ATTRIBUTES) or bool(
+            self.metadata.get("products_as_process")
+        )
+
+    def process(
+        self,
+        csv: bool = False,
+        allocate: bool = True,
+        chunk_size: Optional[int] = None,
+        memory_budget: Optional[int] = None,
+        resume: bool = False,
+        bulk: Union[bool, dict] = False,
+    ) -> Optional[ProcessingReport]:
+        """Allocate multifunctional processes, and then build the processed arrays.
+
+        If `chunk_size` or `memory_budget` (in bytes) are given, multifunctional processes are
+        allocated in chunks which are each committed in one transaction, and whose intermediate
+        data is released before the next chunk starts. If the resident memory after a chunk is
+        above `memory_budget`, the chunk size is halved. Returns a `ProcessingReport` in this
+        case.
+
+        Chunked processing records its progress in the database metadata. If it is interrupted,
+        `resume=True` continues after the last committed chunk, and allocates the processes
+        before it again if their read-only processes are inconsistent. `resume` implies chunked
+        processing.
+
+        With `bulk`, allocation runs in a `bulk_load` session, in one transaction unless chunked;
+        `bulk` can be a dictionary of `bulk_load` arguments. Returns a `ProcessingReport` with the
+        `BulkLoadReport` in this case.
+
+        Search indexing, database metadata updates, and signals are deferred during allocation,
+        and happen once at the end; see `multifunctional.deferred_side_effects`."""
+        chunked = chunk_size is not None or memory_budget is not None or resume
+        report = ProcessingReport()
+        with phase("process"):
+            start = time.perf_counter()
+            # Side effects after the bulk transaction, so they see the committed state
+            deferred = deferred_side_effects(self.name)
+            with deferred, self._bulk_load(bulk, transaction=not chunked) as session:
+                if chunked and allocate:
+                    report = self.allocate_in_chunks(
+                        chunk_size or DEFAULT_CHUNK_SIZE, memory_budget, resume=resume
+                    )
+                elif allocate:
+                    with phase("discovery"):
+                        nodes = list(self.nodes_by_code(self.multifunctional_codes()))
+                    self._allocate_nodes(nodes, self._is_simapro)
+                    report.nodes = len(nodes)
+                    report.seconds = time.perf_counter() - start
+            report.bulk_load = session
+            with phase("matrix"):
+                super().process(csv=csv)
+        if CHECKPOINT in self.metadata:
+            del self.metadata[CHECKPOINT]
+            databases.flush()
+        if chunked or bulk:
+            # Measured differently, so can be slightly lower than the chunk values
+            report.peak_rss = max(peak_rss(), report.max_chunk_rss)
+            logger.info("Processed {d}: {r}", d=self.name, r=report)
+            return report
+
+    def process_for_demand(self, demand: Iterable, csv: bool = False) -> DemandReport:
+        """Allocate only the multifunctional processes in the supply chain of `demand`, and then
+        build the processed arrays.
+
+        `demand` is a dictionary or iterable of nodes, keys, or ids, as for `bw2calc.LCA`, and can
+        be in other databases. The walked supply chain and the allocated processes are cached for
+        this database, so later calls only walk and allocate what new demands add. The cache
+        starts again if this database or its default allocation changes, and the supply chain is
+        walked again if another walked database changes. Processes outside the supply chains stay
+        unallocated; `process` allocates all of them."""
+        start = time.perf_counter()
+        cache = supply_chain_cache(self.name)
+        report = DemandReport(cached=len(cache.allocated))
+        with phase("process_for_demand"):
+            with phase("discovery"):
+                if cache.products is None:
+                    cache.products = functional_products(self.name)
+                reached = walk_supply_chain(demand_keys(demand), cache.products, cache.visited)
+                codes = sorted(
+                    {cache.products[key][1] for key in reached if key in cache.products}.difference(
+                        cache.allocated
+                    )
+                )
+            with deferred_side_effects(self.name):
+                self._allocate_codes(codes, self._is_simapro)
+            cache.allocated.update(codes)
+            # Functional edges now link to the read-only processes
+            cache.products.update(functional_products(self.name, codes))
+            if codes or self.metadata.get("dirty"):
+                with phase("matrix"):
+                    super().process(csv=csv)
+        cache.record_modified(self.name)
+
+        report.reached = len(reached)
+        report.allocated = len(codes)
+        report.remaining = len(set(cache.products.values())) - len(cache.allocated)
+        report.seconds = time.perf_counter() - start
+        logger.info("Processed {d} for demand: {r}", d=self.name, r=report)
+        return report
+
+    async def aprocess(
+        self,
+        csv: bool = False,
+        allocate: bool = True,
+        progress: Optional[Callable] = None,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        """Asynchronous `process`, which doesn't block the event loop. See
+        `multifunctional.asynchronous.process`."""
+        from .asynchronous import process
 
-    def process(self, csv: bool = False, allocate: bool = True) -> None:
-        if allocate:
-            is_simapro = any(
-                key in self.metadata for key in SIMAPRO_ATTRIBUTES
-            ) or self.metadata.get("products_as_process")
+        await process(self, csv=csv, allocate=allocate, progress=progress, executor=executor)
 
-            for node in filter(lambda x: x.multifunctional, self):
+    def snapshot_allocation(self, label: Optional[str] = None) -> str:
+        """Store the current allocation results under `label`. See
+        `multifunctional.snapshots.snapshot_allocation`."""
+        return snapshot_allocation(self.name, label)
+
+    def restore_allocation(self, label: str) -> int:
+        """Restore the allocation results stored under `label` with a bulk copy, without
+        allocating again. See `multifunctional.snapshots.restore_allocation`."""
+        return restore_allocation(self.name, label)
+
+    def allocation_snapshots(self) -> Dict[str, str]:
+        """`{label: creation time}` of the stored allocation snapshots."""
+        return allocation_snapshots(self.name)
+
+    def delete_allocation_snapshot(self, label: Optional[str] = None) -> int:
+        """Delete the snapshot `label`, or all snapshots of this database."""
+        return delete_allocation_snapshot(self.name, label)
+
+    def multifunctional_codes(self) -> List[str]:
+        """Sorted codes of processes with more than one functional edge."""
+        return list(self.iter_multifunctional_codes())
+
+    def iter_multifunctional_codes(
+        self, after: Optional[str] = None, page_size: int = BATCH_SIZE
+    ) -> Iterator[str]:
+        """Codes of processes with more than one functional edge, in order, and only those after
+        `after` if given. Edge outputs are paged by code, with two queries per `page_size` codes,
+        so only one page is in memory at a time."""
+        while True:
+            query = ExchangeDataset.select(ExchangeDataset.output_code).distinct()
+            query = query.where(ExchangeDataset.output_database == self.name)
+            if after is not None:
+                query = query.where(ExchangeDataset.output_code > after)
+            page = [
+                code
+                for (code,) in query.order_by(ExchangeDataset.output_code).limit(page_size).tuples()
+            ]
+            if not page:
+                return
+            functional = Counter(
+                output_code
+                for output_code, data in ExchangeDataset.select(
+                    ExchangeDataset.output_code, ExchangeDataset.data
+                )
+                .where(
+                    ExchangeDataset.output_database == self.name,
+                    ExchangeDataset.output_code << page,
+                )
+                .tuples()
+                if data.get("functional")
+            )
+            yield from (code for code in page if functional[code] > 1)
+            after = page[-1]
+
+    def nodes_by_code(self, codes: List[str]) -> Iterator[BaseMultifunctionalNode]:
+        """Nodes with the given `codes`, loaded with one query per `BATCH_SIZE` codes."""
+        for start in range(0, len(codes), BATCH_SIZE):
+            for document in ActivityDataset.select().where(
+                ActivityDataset.database == self.name,
+                ActivityDataset.code << codes[start : start + BATCH_SIZE],
+            ):
+                yield self.node_class(document)
+
+    def _allocate_nodes(self, nodes: List[BaseMultifunctionalNode], is_simapro: bool) -> None:
+        """Allocate `nodes`, evaluating batch allocation factor functions once for all of them."""
+        from .allocation import batch_allocation_factors
+
+        with batch_allocation_factors(nodes):
+            for node in nodes:
                 node.allocate(products_as_process=is_simapro)
-        super().process(csv=csv)
+
+    def _allocate_codes(self, codes: List[str], is_simapro: bool) -> None:
+        self._allocate_nodes(list(self.nodes_by_code(codes)), is_simapro)
+
+    def inconsistent_allocations(self, codes: Iterable[str]) -> Set[str]:
+        """Codes of the multifunctional processes in `codes` whose read-only processes don't match
+        their last allocation: missing, left over, or from a different allocation run."""
+        codes = sorted(set(codes))
+        if not codes:
+            return set()
+        runs = {code: None for code in codes}
+        expected = {code: set() for code in codes}
+        for start in range(0, len(codes), BATCH_SIZE):
+            batch = codes[start : start + BATCH_SIZE]
+            for code, data in (
+                ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+                .where(ActivityDataset.database == self.name, ActivityDataset.code << batch)
+                .tuples()
+            ):
+                runs[code] = data.get("mf_allocation_run_uuid")
+            for code, data in (
+                ExchangeDataset.select(ExchangeDataset.output_code, ExchangeDataset.data)
+                .where(
+                    ExchangeDataset.output_database == self.name,
+                    ExchangeDataset.output_code << batch,
+                )
+                .tuples()
+            ):
+                if data.get("functional"):
+                    expected[code].add(data.get("mf_allocated_process_code"))
+
+        found = {code: set() for code in codes}
+        inconsistent = {code for code, run in runs.items() if run is None}
+        for code, data in (
+            ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+            .where(
+                ActivityDataset.database == self.name,
+                ActivityDataset.type == "readonly_process",
+            )
+            .tuples()
+            .iterator()
+        ):
+            parent = tuple(data.get("mf_parent_key") or ())
+            if parent[:1] != (self.name,) or parent[1] not in found:
+                continue
+            found[parent[1]].add(code)
+            if data.get("mf_allocation_run_uuid") != runs[parent[1]]:
+                inconsistent.add(parent[1])
+        inconsistent.update(code for code in codes if found[code] != expected[code])
+        return inconsistent
+
+    def _save_checkpoint(self, last_code: str) -> None:
+        checkpoint = self.metadata.get(CHECKPOINT) or {}
+        self.metadata[CHECKPOINT] = {
+            "last_code": max(last_code, checkpoint.get("last_code") or last_code),
+            "default_allocation": self.metadata.get("default_allocation"),
+        }
+        databases.flush()
+
+    def allocate_in_chunks(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        memory_budget: Optional[int] = None,
+        resume: bool = False,
+    ) -> ProcessingReport:
+        """Allocate all multifunctional processes, `chunk_size` processes per transaction, in
+        order of their codes. Codes are found page by page, and the nodes of each chunk are only
+        loaded when it runs. After each chunk is committed, its last code is stored in the
+        `mf_process_checkpoint` database metadata; `process` removes it when finished. See
+        `process` for `resume`."""
+        if chunk_size < 1:
+            raise ValueError(f"`chunk_size` must be positive, but got {chunk_size}")
+        start = time.perf_counter()
+        is_simapro = self._is_simapro
+
+        report = ProcessingReport()
+        checkpoint = self.metadata.get(CHECKPOINT) if resume else None
+        if checkpoint and checkpoint.get("default_allocation") != self.metadata.get(
+            "default_allocation"
+        ):
+            logger.warning(
+                "Default allocation of {d} changed since the checkpoint; allocating all "
+                "processes again",
+                d=self.name,
+            )
+            checkpoint = None
+        codes: Iterator[str]
+        if checkpoint:
+            last_code = checkpoint["last_code"]
+            with phase("discovery"):
+                done = list(
+                    takewhile(lambda code: code <= last_code, self.iter_multifunctional_codes())
+                )
+            with phase("consistency"):
+                repair = sorted(self.inconsistent_allocations(done))
+            codes = chain(repair, self.iter_multifunctional_codes(after=last_code))
+            report.resumed = len(done) - len(repair)
+            report.repaired = len(repair)
+            logger.info(
+                "Resuming processing of {d}: {n} processes done, {r} to repair",
+                d=self.name,
+                n=report.resumed,
+                r=report.repaired,
+            )
+        else:
+            self.metadata.pop(CHECKPOINT, None)
+            codes = self.iter_multifunctional_codes()
+
+        while True:
+            with phase("discovery"):
+                chunk = list(islice(codes, chunk_size))
+            if not chunk:
+                break
+            with phase("chunk"), sqlite3_lci_db.transaction():
+                self._allocate_codes(chunk, is_simapro)
+            self._save_checkpoint(chunk[-1])
+            report.nodes += len(chunk)
+            report.chunks += 1
+
+            if memory_budget is not None:
+                gc.collect()
+            rss = current_rss()
+            report.max_chunk_rss = max(report.max_chunk_rss, rss)
+            if memory_budget is not None and rss > memory_budget and chunk_size > 1:
+                chunk_size = max(1, chunk_size // 2)
+                logger.warning(
+                    "Resident memory {m:.0f} MB above budget of {b:.0f} MB; reducing chunk size "
+                    "to {c}",
+                    m=rss / 1e6,
+                    b=memory_budget / 1e6,
+                    c=chunk_size,
+                )
+
+        report.chunk_size = chunk_size
+        report.seconds = time.perf_counter() - start
+        return report
@@ -0,0 +1,253 @@
+"""Defer per-node side effects of saving and deleting during whole-database allocation."""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Set, Tuple
+
+from blinker import signal
+from bw2data import Database, databases, projects
+from bw2data.backends.proxies import Activity, Exchange
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from bw2data.search import IndexManager
+from loguru import logger
+
+from .instrumentation import count, phase
+from .property_index import (
+    BATCH_SIZE,
+    FunctionalEdgeIndex,
+    PropertyIndex,
+    _delete_process_rows,
+    _delete_product_rows,
+    build_property_index,
+    has_property_index,
+    reindex_process,
+)
+from .utils import ensure_tables
+
+Key = Tuple[str, str]
+
+# Database metadata key for the `searchable` setting while side effects are deferred. It is only
+# left over if Python was stopped inside a block, and then tells the next block to restore it.
+SEARCHABLE = "mf_deferred_searchable"
+
+on_allocation_changes = signal(
+    "multifunctional.on_allocation_changes",
+    doc="""Emitted once *after* a `deferred_side_effects` block, instead of a
+`bw2data.signaleddataset_on_save` or `bw2data.signaleddataset_on_delete` signal per node and edge.
+
+Expected inputs:
+    * `database`: str - database name
+    * `changes`: `DeferredChanges` - keys of the saved and deleted nodes, and the number of edges
+
+No expected return value.
+""",
+)
+
+
+@dataclass
+class DeferredChanges:
+    """Nodes and edges changed inside a `deferred_side_effects` block."""
+
+    database: str
+    saved: Set[Key] = field(default_factory=set)
+    deleted: Set[Key] = field(default_factory=set)
+    edges_saved: int = 0
+    deleted_ids: Set[int] = field(default_factory=set)
+    # Processes whose property index rows are updated at the end
+    reindex: Set[str] = field(default_factory=set)
+
+
+_changes: ContextVar[Optional[DeferredChanges]] = ContextVar(
+    "multifunctional_deferred_changes", default=None
+)
+
+
+def _active(key: Key) -> Optional[DeferredChanges]:
+    changes = _changes.get()
+    return changes if changes is not None and changes.database == key[0] else None
+
+
+def save_node(node: Activity, *args, **kwargs) -> None:
+    """Save `node` with `Activity.save`; inside `deferred_side_effects`, without signals."""
+    changes = _active((node.get("database"), node.get("code")))
+    if changes is None:
+        Activity.save(node, *args, **kwargs)
+        return
+    Activity.save(node, *args, **{**kwargs, "signal": False})
+    changes.saved.add(node.key)
+    changes.deleted.discard(node.key)
+
+
+def save_edge(edge: Exchange) -> None:
+    """Save `edge`; inside `deferred_side_effects`, without signals."""
+    changes = _active(tuple(edge["output"]))
+    if changes is None:
+        edge.save()
+        return
+    edge.save(signal=False)
+    changes.edges_saved += 1
+
+
+def delete_edge(edge: ExchangeDataset) -> None:
+    """Delete the `ExchangeDataset` `edge`; inside `deferred_side_effects`, without signals."""
+    changes = _active((edge.output_database, edge.output_code))
+    edge.delete_instance(signal=changes is None)
+
+
+def delete_node(node: Activity) -> None:
+    """Delete `node` with `Activity.delete`; inside `deferred_side_effects`, without signals."""
+    changes = _active(node.key)
+    if changes is None:
+        node.delete()
+        return
+    key, node_id = node.key, node.id
+    node.delete(signal=False)
+    changes.deleted.add(key)
+    changes.saved.discard(key)
+    changes.deleted_ids.add(node_id)
+
+
+def defer_property_reindex(database: str, code: str) -> bool:
+    """Update the property index rows of process `code` at the end of the active
+    `deferred_side_effects` block of `database`. Returns `False` if there is no such block."""
+    changes = _active((database, code))
+    if changes is None:
+        return False
+    changes.reindex.add(code)
+    return True
+
+
+def _search_batches(
+    database: str, codes: Optional[List[str]], search_readonly_processes: bool
+) -> Iterator[Tuple[List[str], List[dict]]]:
+    """`(codes, datasets)` to index, for at most `BATCH_SIZE` of the nodes with `codes`, or of all
+    nodes of `database`."""
+    query = ActivityDataset.select(
+        ActivityDataset.code, ActivityDataset.type, ActivityDataset.data
+    ).where(ActivityDataset.database == database)
+    if codes is None:
+        batches = [query.order_by(ActivityDataset.id).tuples().iterator()]
+    else:
+        batches = (
+            query.where(ActivityDataset.code << codes[start : start + BATCH_SIZE]).tuples()
+            for start in range(0, len(codes), BATCH_SIZE)
+        )
+    for rows in batches:
+        batch, datasets = [], []
+        for code, kind, data in rows:
+            batch.append(code)
+            if search_readonly_processes or kind != "readonly_process":
+                datasets.append(data)
+            if len(batch) == BATCH_SIZE:
+                yield batch, datasets
+                batch, datasets = [], []
+        if batch:
+            yield batch, datasets
+
+
+def _reindex(database: str, codes: Optional[List[str]], search_readonly_processes: bool) -> None:
+    """Replace the search index entries of the nodes with `codes` with one transaction, or rebuild
+    the search index of `database` if `codes` is `None`. Datasets are added `BATCH_SIZE` at a
+    time."""
+    index = IndexManager(Database(database).filename)
+    if codes is None:
+        index.create()
+    # Keep one connection open, so the index methods don't close it inside the transaction
+    with index.db.connection_context(), index.db.atomic():
+        # Deleted nodes aren't found below
+        for code in codes or []:
+            index.delete_dataset({"database": database, "code": code})
+        for batch, datasets in _search_batches(database, codes, search_readonly_processes):
+            index.add_datasets(datasets)
+            count("search_index_updates", len(batch))
+
+
+def _update_property_index(changes: DeferredChanges) -> None:
+    """Update the property index rows of the changed processes, instead of rebuilding the index."""
+    ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    deleted = sorted(changes.deleted_ids)
+    for node_id in deleted:
+        _delete_process_rows(node_id)
+    _delete_product_rows(deleted)
+
+    # Read-only processes don't have index rows; their product rows are updated with the edges
+    # of their parents
+    codes = sorted(changes.reindex.union(code for _, code in changes.saved))
+    for start in range(0, len(codes), BATCH_SIZE):
+        for (code,) in (
+            ActivityDataset.select(ActivityDataset.code)
+            .where(
+                ActivityDataset.database == changes.database,
+                ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                ActivityDataset.type != "readonly_process",
+            )
+            .tuples()
+        ):
+            reindex_process(changes.database, code)
+
+
+@contextmanager
+def deferred_side_effects(database: str) -> Iterator[Optional[DeferredChanges]]:
+    """Defer the side effects of saving and deleting nodes and edges of `database` while
+    allocating.
+
+    Inside the block, allocation saves and deletes with the public `bw2data` methods, but without
+    signals, and marks the database as not searchable, so nodes aren't added to the search index
+    one by one. At the end, also after errors, the `searchable` setting is restored, the search
+    index entries of all changed nodes are replaced in one transaction, the property index rows of
+    the changed processes are updated if the index is present, and `on_allocation_changes` is sent
+    once.
+
+    The original `searchable` setting is kept in the `mf_deferred_searchable` database metadata
+    during the block. If Python is stopped inside a block, the next block of the same database
+    restores it, and rebuilds the search and property indices.
+
+    Read-only processes are left out of the search index if the database metadata has
+    `searchable_readonly_processes=False`. Not used in projects with revisions, as these need the
+    signal for each change; yields `None` in that case, if already inside a block, or if the
+    database isn't registered."""
+    if projects.dataset.is_sourced or _changes.get() is not None or database not in databases:
+        yield None
+        return
+
+    metadata = databases[database]
+    interrupted = SEARCHABLE in metadata
+    if interrupted:
+        logger.warning(
+            "Earlier allocation of {d} was stopped; rebuilding its search and property indices",
+            d=database,
+        )
+        restore = metadata[SEARCHABLE]
+    else:
+        restore = {"searchable": metadata["searchable"]} if "searchable" in metadata else {}
+        metadata[SEARCHABLE] = restore
+    searchable = restore.get("searchable", True)
+    # `Activity.save` updates the search index of each node otherwise
+    metadata["searchable"] = False
+    databases.flush()
+    changes = DeferredChanges(database=database)
+    token = _changes.set(changes)
+    try:
+        yield changes
+    finally:
+        _changes.reset(token)
+        del metadata["searchable"]
+        metadata.update(restore)
+        del metadata[SEARCHABLE]
+        databases.flush()
+        changed = bool(changes.saved or changes.deleted or changes.edges_saved or changes.reindex)
+        if changed or interrupted:
+            with phase("deferred_side_effects"):
+                readonly = metadata.get("searchable_readonly_processes", True)
+                if searchable and interrupted:
+                    _reindex(database, None, readonly)
+                elif searchable:
+                    codes = sorted(code for _, code in changes.saved | changes.deleted)
+                    _reindex(database, codes, readonly)
+                if has_property_index(database) and interrupted:
+                    build_property_index(database)
+                elif has_property_index(database):
+                    _update_property_index(changes)
+        if changed:
+            on_allocation_changes.send(database=database, changes=changes)
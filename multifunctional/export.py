@@ -0,0 +1,178 @@
+"""Export allocation results to columnar Arrow or Parquet files."""
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from bw2data import databases
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+
+from .property_index import BATCH_SIZE
+
+# Column name and Arrow type name, in file order
+COLUMNS = (
+    ("database", "string"),
+    ("parent_code", "string"),
+    ("strategy", "string"),
+    ("allocated_code", "string"),
+    ("product_database", "string"),
+    ("product_code", "string"),
+    ("functional_amount", "float64"),
+    ("allocation_factor", "float64"),
+    ("functional", "bool"),
+    ("edge_type", "string"),
+    ("input_database", "string"),
+    ("input_code", "string"),
+    ("amount", "float64"),
+)
+DEFAULT_ROWS_PER_BATCH = 65_536
+
+
+def _allocated_processes(database: str) -> Dict[str, Tuple[str, Optional[str]]]:
+    """`{allocated process code: (parent code, strategy label)}`"""
+    return {
+        code: (data["mf_parent_key"][1], data.get("mf_strategy_label"))
+        for code, data in ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+        .where(
+            ActivityDataset.database == database,
+            ActivityDataset.type == "readonly_process",
+        )
+        .tuples()
+        .iterator()
+    }
+
+
+def _functional_edges(database: str, parent_codes: List[str]) -> Dict[str, tuple]:
+    """`{allocated process code: (product database, product code, amount, factor)}`, from the
+    functional edges of the parent processes."""
+    edges = {}
+    for start in range(0, len(parent_codes), BATCH_SIZE):
+        for data in (
+            ExchangeDataset.select(ExchangeDataset.data)
+            .where(
+                ExchangeDataset.output_database == database,
+                ExchangeDataset.output_code << parent_codes[start : start + BATCH_SIZE],
+            )
+            .tuples()
+            .iterator()
+        ):
+            data = data[0]
+            if data.get("functional") and data.get("mf_allocated_process_code"):
+                edges[data["mf_allocated_process_code"]] = (
+                    *data["input"],
+                    data["amount"],
+                    data.get("mf_allocation_factor"),
+                )
+    return edges
+
+
+def iter_allocation_results(names: Optional[Iterable[str]] = None) -> Iterator[dict]:
+    """Rows of allocation results, one per edge of each allocated (read-only) process.
+
+    Each row gives the parent process, the strategy, the allocated process code, the functional
+    edge of the parent it was created for (product, amount, and allocation factor), and the edge
+    itself, with the rescaled amount for non-functional edges. See `COLUMNS`.
+
+    `names` are the databases to export; default is all multifunctional databases. Rows are
+    generated with constant memory, apart from one small lookup entry per allocated process."""
+    if names is None:
+        names = sorted(
+            name for name, meta in databases.items() if meta.get("backend") == "multifunctional"
+        )
+    for database in names:
+        allocated = _allocated_processes(database)
+        codes = sorted(allocated)
+        functional = _functional_edges(
+            database, sorted({parent for parent, _ in allocated.values()})
+        )
+        for start in range(0, len(codes), BATCH_SIZE):
+            query = (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_code,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.type,
+                    ExchangeDataset.data,
+                )
+                .where(
+                    ExchangeDataset.output_database == database,
+                    ExchangeDataset.output_code << codes[start : start + BATCH_SIZE],
+                )
+                .order_by(ExchangeDataset.output_code, ExchangeDataset.id)
+                .tuples()
+                .iterator()
+            )
+            for code, input_database, input_code, edge_type, data in query:
+                parent, strategy = allocated[code]
+                product_database, product_code, functional_amount, factor = functional.get(
+                    code, (None, None, None, None)
+                )
+                yield {
+                    "database": database,
+                    "parent_code": parent,
+                    "strategy": strategy,
+                    "allocated_code": code,
+                    "product_database": product_database,
+                    "product_code": product_code,
+                    "functional_amount": functional_amount,
+                    "allocation_factor": factor,
+                    "functional": bool(data.get("functional")),
+                    "edge_type": edge_type,
+                    "input_database": input_database,
+                    "input_code": input_code,
+                    "amount": data["amount"],
+                }
+
+
+def export_allocation_results(
+    filepath: Union[str, Path],
+    names: Optional[Iterable[str]] = None,
+    file_format: Optional[str] = None,
+    rows_per_batch: int = DEFAULT_ROWS_PER_BATCH,
+) -> int:
+    """Write the allocation results of the databases `names` (default: all multifunctional
+    databases) to `filepath`, and return the number of rows. Columns are given in `COLUMNS`.
+
+    `file_format` is `arrow` (Arrow IPC file, also known as Feather, which can be memory mapped)
+    or `parquet`; by default, `parquet` if the file extension is `.parquet`, otherwise `arrow`.
+    Rows are written in record batches of `rows_per_batch` rows, so the whole export is never held
+    in memory.
+
+    Needs `pyarrow`. Read the Arrow file without copying with:
+
+    ```python
+    pyarrow.ipc.open_file(pyarrow.memory_map(filepath)).read_all()
+    ```"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as err:
+        raise ImportError(
+            "Exporting allocation results needs `pyarrow`; install with `pip install pyarrow`"
+        ) from err
+
+    filepath = Path(filepath)
+    if file_format is None:
+        file_format = "parquet" if filepath.suffix.lower() == ".parquet" else "arrow"
+    if file_format not in ("arrow", "parquet"):
+        raise ValueError(f"`file_format` must be `arrow` or `parquet`, but got {file_format}")
+    if rows_per_batch < 1:
+        raise ValueError(f"`rows_per_batch` must be positive, but got {rows_per_batch}")
+
+    schema = pa.schema([(name, pa.type_for_alias(kind)) for name, kind in COLUMNS])
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(filepath, schema)
+    else:
+        writer = pa.ipc.new_file(filepath, schema)
+
+    total, rows = 0, []
+    with writer:
+        for row in iter_allocation_results(names):
+            rows.append(row)
+            if len(rows) == rows_per_batch:
+                writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+                total += len(rows)
+                rows = []
+        if rows:
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+            total += len(rows)
+    return total
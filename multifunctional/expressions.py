@@ -0,0 +1,209 @@
+import ast
+from typing import Dict, Set
+
+import numpy as np
+
+from .columnar import FunctionalEdgeTable
+from .property_index import is_numeric
+
+# Name which refers to the edge amount instead of a property
+AMOUNT = "amount"
+FUNCTIONS = {
+    "abs": np.abs,
+    "exp": np.exp,
+    "log": np.log,
+    "max": np.maximum,
+    "min": np.minimum,
+    "sqrt": np.sqrt,
+}
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+)
+# Largest absolute value of an exponent without properties, like in `mass ** 2`
+MAX_EXPONENT = 1000
+
+
+class InvalidAllocationExpression(ValueError):
+    """Allocation expression can't be parsed, uses disallowed syntax, or can't be evaluated."""
+
+    pass
+
+
+class AllocationExpression:
+    """Allocation factor given by an arithmetic expression over edge properties.
+
+    Names in the expression refer to properties of the functional edge (including properties
+    inherited from the linked product node), except `amount`, which is the edge amount. Supports
+    numbers, `+ - * / **`, parentheses, and the functions `abs`, `exp`, `log`, `max`, `min`, and
+    `sqrt`. For example: `price * mass` or `energy_content * amount / density`.
+
+    The expression is parsed and validated once. It can be called like other allocation factor
+    functions with `(edge_data, node)`, and also evaluated for many edges at once with `.batch()`.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as err:
+            raise InvalidAllocationExpression(f"Can't parse `{expression}`: {err}") from err
+
+        for node in ast.walk(tree):
+            # Integers have arbitrary precision, so `9 ** 9 ** 9` would never finish
+            if isinstance(node, ast.Constant) and type(node.value) is int:
+                node.value = float(node.value)
+
+        names = set()
+        callees = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise InvalidAllocationExpression(
+                    f"`{type(node).__name__}` not allowed in allocation expression `{expression}`"
+                )
+            if isinstance(node, ast.Constant) and (
+                not isinstance(node.value, (int, float)) or isinstance(node.value, bool)
+            ):
+                raise InvalidAllocationExpression(
+                    f"Only numeric constants allowed in allocation expression `{expression}`"
+                )
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                    raise InvalidAllocationExpression(
+                        f"Only functions {sorted(FUNCTIONS)} allowed in allocation expression "
+                        f"`{expression}`"
+                    )
+                if node.keywords:
+                    raise InvalidAllocationExpression(
+                        f"Keyword arguments not allowed in allocation expression `{expression}`"
+                    )
+            elif isinstance(node, ast.Name):
+                if node.id in FUNCTIONS and id(node) not in callees:
+                    raise InvalidAllocationExpression(
+                        f"Function `{node.id}` used as a value in allocation expression "
+                        f"`{expression}`"
+                    )
+                names.add(node.id)
+            elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                self._check_exponent(node.right)
+
+        # Function names are only used as call targets, checked above
+        self.properties: Set[str] = {
+            name for name in names if name not in FUNCTIONS and name != AMOUNT
+        }
+        self.uses_amount = AMOUNT in names
+        self._code = compile(tree, "<allocation expression>", "eval")
+
+    def _check_exponent(self, exponent: ast.expr) -> None:
+        if any(isinstance(node, ast.Name) for node in ast.walk(exponent)):
+            return
+        try:
+            value = eval(
+                compile(ast.fix_missing_locations(ast.Expression(exponent)), "<exponent>", "eval"),
+                {"__builtins__": {}},
+            )
+        except (ArithmeticError, TypeError) as err:
+            raise InvalidAllocationExpression(
+                f"Can't evaluate exponent in allocation expression `{self.expression}`: {err}"
+            ) from err
+        if abs(value) > MAX_EXPONENT:
+            raise InvalidAllocationExpression(
+                f"Exponent {value} larger than {MAX_EXPONENT} in allocation expression "
+                f"`{self.expression}`"
+            )
+
+    def __repr__(self) -> str:
+        return f"AllocationExpression({self.expression!r})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AllocationExpression) and other.expression == self.expression
+
+    def __hash__(self) -> int:
+        return hash(self.expression)
+
+    def _evaluate(self, namespace: Dict[str, np.ndarray], where: str) -> np.ndarray:
+        try:
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                return np.asarray(
+                    eval(self._code, {"__builtins__": {}, **FUNCTIONS}, namespace),
+                    dtype=float,
+                )
+        except (ArithmeticError, TypeError) as err:
+            raise InvalidAllocationExpression(
+                f"Can't evaluate allocation expression `{self.expression}` for {where}: {err}"
+            ) from err
+
+    def __call__(self, edge_data: dict, node: dict) -> float:
+        properties = edge_data.get("properties") or {}
+        namespace = {}
+        for label in self.properties:
+            if label not in properties:
+                raise KeyError(
+                    f"Edge {edge_data} from process {node.get('name')} (id {node.get('id')}) "
+                    f"missing property {label}"
+                )
+            if not is_numeric(properties[label]):
+                raise ValueError(
+                    f"Edge {edge_data} from process {node.get('name')} (id {node.get('id')}) has "
+                    f"non-numeric property {label}: {properties[label]}"
+                )
+            namespace[label] = np.float64(properties[label])
+        if self.uses_amount:
+            namespace[AMOUNT] = np.float64(edge_data["amount"])
+
+        result = float(
+            self._evaluate(
+                namespace,
+                f"edge {edge_data} from process {node.get('name')} (id {node.get('id')})",
+            )
+        )
+        if not np.isfinite(result):
+            raise InvalidAllocationExpression(
+                f"Allocation expression `{self.expression}` gave {result} for edge {edge_data} "
+                f"from process {node.get('name')} (id {node.get('id')})"
+            )
+        return result
+
+    def batch(self, table: FunctionalEdgeTable) -> np.ndarray:
+        """Evaluate the expression for all edges in `table` at once."""
+        namespace = {}
+        for label in self.properties:
+            column = table.property_column(label)
+            if not column.present.all():
+                index = np.flatnonzero(~column.present)[0]
+                raise KeyError(
+                    f"Functional edge {table.edge_id[index]} of process "
+                    f"{table.process_id[index]} missing property {label}"
+                )
+            if not column.numeric.all():
+                index = np.flatnonzero(~column.numeric)[0]
+                raise ValueError(
+                    f"Functional edge {table.edge_id[index]} of process "
+                    f"{table.process_id[index]} has non-numeric property {label}: "
+                    f"{column.raw[index]}"
+                )
+            namespace[label] = column.values
+        if self.uses_amount:
+            namespace[AMOUNT] = table.amount
+
+        where = f"functional edges of processes {sorted(set(table.process_id.tolist()))}"
+        result = np.broadcast_to(self._evaluate(namespace, where), (len(table),)).copy()
+        if not np.isfinite(result).all():
+            index = np.flatnonzero(~np.isfinite(result))[0]
+            raise InvalidAllocationExpression(
+                f"Allocation expression `{self.expression}` gave {result[index]} for functional "
+                f"edge {table.edge_id[index]} of process {table.process_id[index]}"
+            )
+        return result
@@ -0,0 +1,158 @@
+"""Opt-in timing, SQL, and object count instrumentation of allocation and processing."""
+
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from bw2data.backends import sqlite3_lci_db
+
+TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+[\"'`\[]?(\w+)", re.IGNORECASE)
+_NULL_CONTEXT = nullcontext()
+
+
+@dataclass
+class PhaseStats:
+    """Totals for one phase, including any phases nested inside it."""
+
+    calls: int = 0
+    seconds: float = 0.0
+    # `(operation, table)`, e.g. `("SELECT", "activitydataset")`
+    sql: Counter = field(default_factory=Counter)
+    objects: Counter = field(default_factory=Counter)
+
+    @property
+    def queries(self) -> int:
+        return sum(self.sql.values())
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "queries": self.queries,
+            "sql": {
+                f"{operation} {table}".strip(): n for (operation, table), n in self.sql.items()
+            },
+            "objects": dict(self.objects),
+        }
+
+
+@dataclass
+class InstrumentationReport:
+    """Result of `instrument`.
+
+    * `total`: Everything inside the `instrument` block.
+    * `phases`: By phase name, like `allocate`, `purge`, or `matrix`. See the README for the list.
+    * `nodes`: By multifunctional process id, for each `allocate()` call.
+    """
+
+    total: PhaseStats = field(default_factory=PhaseStats)
+    phases: Dict[str, PhaseStats] = field(default_factory=dict)
+    nodes: Dict[int, PhaseStats] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total.as_dict(),
+            "phases": {name: stats.as_dict() for name, stats in self.phases.items()},
+            "nodes": {node_id: stats.as_dict() for node_id, stats in self.nodes.items()},
+        }
+
+
+def parse_statement(sql: str) -> Tuple[str, str]:
+    """Operation and (first) table of an SQL statement."""
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+    match = TABLE_RE.search(sql)
+    return operation, match.group(1).lower() if match else ""
+
+
+class Recorder:
+    def __init__(self, report: InstrumentationReport):
+        self.report = report
+        self.active: List[PhaseStats] = [report.total]
+        self.start = time.perf_counter()
+
+    def _targets(self) -> Iterator[PhaseStats]:
+        # The same phase can be nested in itself; only count once
+        return {id(stats): stats for stats in self.active}.values()
+
+    def trace(self, sql: str) -> None:
+        key = parse_statement(sql)
+        for stats in self._targets():
+            stats.sql[key] += 1
+
+    def count(self, label: str, amount: int) -> None:
+        for stats in self._targets():
+            stats.objects[label] += amount
+
+    @contextmanager
+    def phase(self, name: str, node_id: Optional[int] = None) -> Iterator[None]:
+        entered = [self.report.phases.setdefault(name, PhaseStats())]
+        if node_id is not None:
+            entered.append(self.report.nodes.setdefault(node_id, PhaseStats()))
+        self.active.extend(entered)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for stats in entered:
+                stats.calls += 1
+                stats.seconds += elapsed
+            del self.active[-len(entered) :]
+
+
+_RECORDER: ContextVar[Optional[Recorder]] = ContextVar("multifunctional_recorder", default=None)
+
+
+def phase(name: str, node_id: Optional[int] = None):
+    """Context manager marking a phase of work; does nothing unless inside `instrument`."""
+    recorder = _RECORDER.get()
+    if recorder is None:
+        return _NULL_CONTEXT
+    return recorder.phase(name, node_id)
+
+
+def count(label: str, amount: int = 1) -> None:
+    """Add `amount` to the object count `label` of the active phases, if inside `instrument`."""
+    recorder = _RECORDER.get()
+    if recorder is not None:
+        recorder.count(label, amount)
+
+
+@contextmanager
+def instrument(
+    callback: Optional[Callable[[InstrumentationReport], None]] = None,
+) -> Iterator[InstrumentationReport]:
+    """Record wall time, SQL statements, and object counts of allocation and processing.
+
+    Yields an `InstrumentationReport`, which is complete when the block exits. `callback` is then
+    called with the report, e.g. to send `report.as_dict()` to a metrics system.
+
+    SQL statements are counted with the `sqlite3` trace callback of the inventory database
+    connection of the current thread; this replaces any other trace callback on that connection
+    while active. Statements to the search index and project databases are not counted.
+
+    ```python
+    with instrument() as report:
+        database.process()
+    report.phases["purge"].seconds
+    ```
+    """
+    report = InstrumentationReport()
+    recorder = Recorder(report)
+    outer = _RECORDER.get()
+    token = _RECORDER.set(recorder)
+    connection = sqlite3_lci_db.db.connection()
+    connection.set_trace_callback(recorder.trace)
+    try:
+        yield report
+    finally:
+        connection.set_trace_callback(outer.trace if outer is not None else None)
+        _RECORDER.reset(token)
+        report.total.calls = 1
+        report.total.seconds = time.perf_counter() - recorder.start
+    if callback is not None:
+        callback(report)
@@ -0,0 +1,178 @@
+"""Low-rank updates of a solved LCA for changed allocation of a few multifunctional processes."""
+
+import warnings
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+import numpy as np
+from bw2data import Database, labels
+from bw2data.backends.schema import ActivityDataset
+
+from .node_classes import MaybeMultifunctionalProcess
+from .property_index import BATCH_SIZE
+
+Key = Tuple[str, str]
+
+
+@dataclass
+class LowRankUpdate:
+    """LCA results with the changed allocated processes, without refactorizing the technosphere
+    matrix. `columns` are the technosphere matrix columns which changed."""
+
+    supply_array: np.ndarray
+    inventory: np.ndarray  # Biosphere flow amounts; the inventory matrix summed over processes
+    score: Optional[float]  # `None` if the LCA has no characterization matrix
+    columns: List[int]
+
+
+def _node_ids(keys: Iterable[Key]) -> Dict[Key, int]:
+    by_database: Dict[str, List[str]] = {}
+    for database, code in sorted(set(keys)):
+        by_database.setdefault(database, []).append(code)
+
+    ids = {}
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            for code, node_id in (
+                ActivityDataset.select(ActivityDataset.code, ActivityDataset.id)
+                .where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                )
+                .tuples()
+            ):
+                ids[(database, code)] = node_id
+    return ids
+
+
+def _allocated_datasets(
+    changes: Union[Mapping[Any, Optional[str]], Iterable[Any]],
+) -> List[dict]:
+    """Allocated process datasets for `{node: strategy label}`, without writing them."""
+    if not isinstance(changes, Mapping):
+        changes = {node: None for node in changes}
+    datasets = []
+    for node, strategy_label in changes.items():
+        if not isinstance(node, MaybeMultifunctionalProcess):
+            raise TypeError(f"Expected a multifunctional process, but got {node!r}")
+        if node.get("skip_allocation") or not node.multifunctional:
+            continue
+        # Allocation writes into the node data, but the caller's node must stay as it is
+        datasets.extend(
+            dataset
+            for dataset in deepcopy(node).allocation_results(
+                strategy_label, products_as_process=Database(node["database"])._is_simapro
+            )
+            if dataset.get("type") == "readonly_process"
+        )
+    return datasets
+
+
+def _index(mapping: Any, key: Key, ids: Dict[Key, int], what: str) -> int:
+    try:
+        return mapping[ids[key]]
+    except KeyError:
+        raise ValueError(
+            f"{what} {key} is not in the baseline LCA matrices; process the database and build a "
+            "new LCA"
+        ) from None
+
+
+def _new_columns(lca: Any, datasets: List[dict]) -> Dict[int, Tuple[dict, dict]]:
+    """`{column: ({technosphere row: value}, {biosphere row: value})}`, with the same signs as
+    the processed arrays."""
+    keys = [(dataset["database"], dataset["code"]) for dataset in datasets]
+    keys += [tuple(exc["input"]) for dataset in datasets for exc in dataset["exchanges"]]
+    ids = _node_ids(keys)
+
+    columns = {}
+    for dataset in datasets:
+        key = (dataset["database"], dataset["code"])
+        column = _index(lca.dicts.activity, key, ids, "Allocated process")
+        technosphere: Dict[int, float] = {}
+        biosphere: Dict[int, float] = {}
+        production = False
+        for exc in dataset["exchanges"]:
+            kind, input_key = exc.get("type"), tuple(exc["input"])
+            if kind in labels.biosphere_edge_types:
+                row = _index(lca.dicts.biosphere, input_key, ids, "Biosphere flow")
+                biosphere[row] = biosphere.get(row, 0) + exc["amount"]
+            elif kind in labels.technosphere_positive_edge_types:
+                production = True
+                row = _index(lca.dicts.product, input_key, ids, "Product")
+                technosphere[row] = technosphere.get(row, 0) + exc["amount"]
+            elif kind in labels.technosphere_negative_edge_types:
+                row = _index(lca.dicts.product, input_key, ids, "Product")
+                technosphere[row] = technosphere.get(row, 0) - exc["amount"]
+        if not production and dataset["type"] in labels.implicit_production_allowed_node_types:
+            row = _index(lca.dicts.product, key, ids, "Product")
+            technosphere[row] = technosphere.get(row, 0) + 1
+        columns[column] = (technosphere, biosphere)
+    return columns
+
+
+def _column_difference(matrix: Any, column: int, values: dict) -> np.ndarray:
+    difference = -matrix[:, column].toarray().ravel()
+    for row, value in values.items():
+        difference[row] += value
+    return difference
+
+
+def low_rank_allocation_update(
+    lca: Any,
+    changes: Union[Mapping[Any, Optional[str]], Iterable[Any]],
+) -> LowRankUpdate:
+    """Results of the solved `lca` if the multifunctional processes in `changes` were allocated
+    again, without changing the database or refactorizing the technosphere matrix.
+
+    `changes` is `{process: strategy label}`, or a list of processes which use their default
+    strategy; allocation uses the current process data, so property changes can be saved first.
+    Only the columns of the allocated processes of these parents change, so the new supply is
+    found with the Woodbury identity: for the `k` changed columns `J` with differences `U`,
+
+        s' = s - Z (I + Z[J]) ^ -1 s[J],  with Z = A ^ -1 U
+
+    which needs `k` solves with the existing factorization of `A` and one dense `k` by `k` solve.
+
+    `lca` is a `bw2calc.LCA` after `lci()` (and `lcia()` for the score), built from the processed
+    arrays of the baseline allocation. The allocated processes, and all their inputs, must already
+    be in its matrices; new allocated processes need a new LCA. The `lca` itself isn't changed,
+    apart from factorizing its technosphere matrix if that wasn't done yet."""
+    if not hasattr(lca, "supply_array"):
+        raise ValueError("Run `lci()` on the baseline LCA first")
+    if not hasattr(lca, "solver"):
+        with warnings.catch_warnings():
+            # No-op with PARDISO, which reuses its own factorization
+            warnings.simplefilter("ignore")
+            lca.decompose_technosphere()
+
+    columns = _new_columns(lca, _allocated_datasets(changes))
+    changed = sorted(columns)
+    supply = np.array(lca.supply_array, dtype=float)
+
+    if changed:
+        technosphere = lca.technosphere_matrix.tocsc()
+        biosphere = lca.biosphere_matrix.tocsc()
+        update = np.column_stack(
+            [_column_difference(technosphere, column, columns[column][0]) for column in changed]
+        )
+        solved = np.column_stack(
+            [np.asarray(lca.solve_linear_system(update[:, i])).ravel() for i in range(len(changed))]
+        )
+        capacitance = np.eye(len(changed)) + solved[changed, :]
+        try:
+            correction = np.linalg.solve(capacitance, supply[changed])
+        except np.linalg.LinAlgError:
+            raise ValueError("Technosphere matrix with changed allocation is singular") from None
+        supply = supply - solved @ correction
+        inventory = np.asarray(biosphere @ supply).ravel()
+        for column in changed:
+            inventory += _column_difference(biosphere, column, columns[column][1]) * supply[column]
+    else:
+        inventory = np.asarray(lca.biosphere_matrix @ supply).ravel()
+
+    score = None
+    if hasattr(lca, "characterization_matrix"):
+        score = float((lca.characterization_matrix @ inventory).sum())
+    return LowRankUpdate(supply_array=supply, inventory=inventory, score=score, columns=changed)
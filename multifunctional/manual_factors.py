@@ -0,0 +1,251 @@
+"""Bulk import of manual allocation factors onto functional edges."""
+
+import csv
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+from bw2data import Database, databases, get_node
+from bw2data.backends import sqlite3_lci_db
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+
+from .errors import NoAllocationNeeded
+from .property_index import BATCH_SIZE, has_property_index, reindex_process
+
+FACTOR_COLUMNS = ("parent_database", "parent_code", "product_database", "product_code", "factor")
+# Number of problems listed in the error message
+MAX_LISTED = 10
+
+Key = Tuple[str, str]
+
+
+class InvalidAllocationFactors(ValueError):
+    """Allocation factor table doesn't match the functional edges in the database."""
+
+    pass
+
+
+@dataclass
+class FactorImportReport:
+    edges: int = 0  # Functional edges updated
+    parents: List[Key] = field(default_factory=list)
+    # Functional edges of the given parents which didn't get a factor
+    uncovered: List[int] = field(default_factory=list)
+    reallocated: int = 0
+
+
+def read_factor_table(filepath: Union[str, Path]) -> List[tuple]:
+    """Rows of `FACTOR_COLUMNS` from a CSV file with a header, or a Parquet file (needs
+    `pyarrow`). Other columns are ignored."""
+    filepath = Path(filepath)
+    if filepath.suffix.lower() == ".parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(filepath, columns=list(FACTOR_COLUMNS))
+        return list(zip(*(table.column(name).to_pylist() for name in FACTOR_COLUMNS)))
+
+    with open(filepath, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = [name for name in FACTOR_COLUMNS if name not in (reader.fieldnames or [])]
+        if missing:
+            raise InvalidAllocationFactors(f"Missing columns {missing} in {filepath}")
+        return [tuple(row[name] for name in FACTOR_COLUMNS) for row in reader]
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _functional_edges(parents: List[Key]) -> Tuple[Set[Key], list]:
+    """Existing `parents`, and `(parent, edge id, data)` for their functional edges."""
+    by_database: Dict[str, List[str]] = {}
+    for database, code in parents:
+        by_database.setdefault(database, []).append(code)
+
+    found, edges = set(), []
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            chunk = codes[start : start + BATCH_SIZE]
+            for (code,) in (
+                ActivityDataset.select(ActivityDataset.code)
+                .where(ActivityDataset.database == database, ActivityDataset.code << chunk)
+                .tuples()
+            ):
+                found.add((database, code))
+            for code, edge_id, data in (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_code, ExchangeDataset.id, ExchangeDataset.data
+                )
+                .where(
+                    ExchangeDataset.output_database == database,
+                    ExchangeDataset.output_code << chunk,
+                )
+                .order_by(ExchangeDataset.id)
+                .tuples()
+                .iterator()
+            ):
+                if data.get("functional"):
+                    edges.append(((database, code), edge_id, data))
+    return found, edges
+
+
+def _product_keys(parent: Key, data: dict) -> set:
+    """Keys which identify the product of a functional edge: its input, the code of its
+    allocated process, and for edges without separate product node, the `desired_code` of the
+    allocated process."""
+    keys = {tuple(data["input"])}
+    for field_name in ("desired_code", "mf_allocated_process_code"):
+        if data.get(field_name):
+            keys.add((parent[0], data[field_name]))
+    return keys
+
+
+def _problems_message(problems: List[str]) -> str:
+    listed = "\n".join(problems[:MAX_LISTED])
+    more = f"\n... and {len(problems) - MAX_LISTED} more" if len(problems) > MAX_LISTED else ""
+    return f"{len(problems)} problem(s) in allocation factor table:\n{listed}{more}"
+
+
+def import_manual_allocation_factors(
+    table: Union[str, Path, Iterable[Sequence]],
+    property_label: str = "manual_allocation",
+    require_complete: bool = True,
+    reallocate: bool = False,
+    strategy_label: Optional[str] = None,
+) -> FactorImportReport:
+    """Set `properties[property_label]` on many functional edges at once.
+
+    `table` is a CSV or Parquet file (see `read_factor_table`), or rows of `(parent database,
+    parent code, product database, product code, factor)`. The product is the node the functional
+    edge links to, the code of its allocated process, or the `desired_code` of the allocated
+    process for edges without separate product node.
+
+    The whole table is validated first, and nothing is written if there are problems: factors must
+    be finite and not negative, each row must match exactly one functional edge, rows can't be
+    repeated, and the factors of each process can't sum to zero. With `require_complete`, every
+    functional edge of the given processes must get a factor; otherwise, the edges without factor
+    are given in `uncovered` of the returned report.
+
+    All edges are then updated in one transaction, directly in the database, without loading and
+    saving `Exchange` objects or sending save signals; the property index is updated. With
+    `reallocate`, only the given processes are then allocated again, with `strategy_label` or
+    their default strategy; their databases must then have the `multifunctional` backend."""
+    rows = (
+        read_factor_table(table)
+        if isinstance(table, (str, Path))
+        else [tuple(row) for row in table]
+    )
+    problems = []
+    if any(len(row) != len(FACTOR_COLUMNS) for row in rows):
+        raise InvalidAllocationFactors(f"Each row must have the values {FACTOR_COLUMNS}")
+
+    parent_keys = [(str(row[0]), str(row[1])) for row in rows]
+    product_keys = [(str(row[2]), str(row[3])) for row in rows]
+    factors = np.array([_as_float(row[4]) for row in rows], dtype=float)
+
+    invalid = ~np.isfinite(factors) | (factors < 0)
+    for index in np.flatnonzero(invalid):
+        problems.append(f"Row {index}: invalid factor {rows[index][4]!r}")
+
+    pairs = np.array(["\x1f".join((*p, *q)) for p, q in zip(parent_keys, product_keys)], dtype=str)
+    if len(pairs):
+        _, first, counts = np.unique(pairs, return_index=True, return_counts=True)
+        for index in np.sort(first[counts > 1]):
+            problems.append(
+                f"Row {index}: factor for process {parent_keys[index]} and product "
+                f"{product_keys[index]} given more than once"
+            )
+
+    parents = list(dict.fromkeys(parent_keys))
+    if reallocate:
+        other = sorted(
+            {
+                database
+                for database, _ in parents
+                if database in databases and databases[database].get("backend") != "multifunctional"
+            }
+        )
+        if other:
+            raise ValueError(
+                f"Can only reallocate processes in `multifunctional` databases; {other} have "
+                "other backends. Nothing was written."
+            )
+    parent_index = {key: i for i, key in enumerate(parents)}
+    found, edges = _functional_edges(parents)
+
+    lookup: Dict[Tuple[Key, Key], List[int]] = {}
+    for position, (parent, _, data) in enumerate(edges):
+        for product in _product_keys(parent, data):
+            lookup.setdefault((parent, product), []).append(position)
+
+    matched = np.full(len(rows), -1, dtype=np.int64)
+    for index, (parent, product) in enumerate(zip(parent_keys, product_keys)):
+        candidates = lookup.get((parent, product), [])
+        if parent not in found:
+            problems.append(f"Row {index}: process {parent} not found")
+        elif not candidates:
+            problems.append(f"Row {index}: process {parent} has no functional edge to {product}")
+        elif len(candidates) > 1:
+            problems.append(
+                f"Row {index}: process {parent} has {len(candidates)} functional edges to "
+                f"{product}; use the `desired_code` or allocated process code instead"
+            )
+        else:
+            matched[index] = candidates[0]
+
+    edge_ids = np.array([edge_id for _, edge_id, _ in edges], dtype=np.int64)
+    edge_parents = np.array([parent_index[parent] for parent, _, _ in edges], dtype=np.int64)
+    valid = (matched >= 0) & ~invalid
+    covered = np.zeros(len(edges), dtype=bool)
+    covered[matched[valid]] = True
+    uncovered = edge_ids[~covered]
+    if require_complete:
+        for position in np.flatnonzero(~covered):
+            problems.append(
+                f"Process {edges[position][0]} has no factor for functional edge "
+                f"{edge_ids[position]}"
+            )
+
+    totals = np.bincount(
+        edge_parents[matched[valid]], weights=factors[valid], minlength=len(parents)
+    )
+    has_rows = np.bincount(edge_parents[matched[valid]], minlength=len(parents)) > 0
+    for index in np.flatnonzero(has_rows & (totals == 0)):
+        problems.append(f"Allocation factors of process {parents[index]} sum to zero")
+
+    if problems:
+        raise InvalidAllocationFactors(_problems_message(problems))
+
+    sql = f"UPDATE {ExchangeDataset._meta.table_name} SET data = ? WHERE id = ?"
+    updates = []
+    for position, factor in zip(matched, factors):
+        data = edges[position][2]
+        data["properties"] = {**(data.get("properties") or {}), property_label: float(factor)}
+        updates.append((ExchangeDataset.data.db_value(data), int(edge_ids[position])))
+
+    with sqlite3_lci_db.transaction():
+        sqlite3_lci_db.db.cursor().executemany(sql, updates)
+        for database, code in parents:
+            if has_property_index(database):
+                reindex_process(database, code)
+    for database in {database for database, _ in parents}:
+        databases.set_dirty(database)
+
+    report = FactorImportReport(edges=len(updates), parents=parents, uncovered=uncovered.tolist())
+    if reallocate:
+        is_simapro = {database: Database(database)._is_simapro for database, _ in parents}
+        with sqlite3_lci_db.transaction():
+            for database, code in parents:
+                node = get_node(database=database, code=code)
+                if (
+                    node.allocate(
+                        strategy_label=strategy_label, products_as_process=is_simapro[database]
+                    )
+                    is not NoAllocationNeeded
+                ):
+                    report.reallocated += 1
+    return report
@@ -1,12 +1,15 @@
 import warnings
-from typing import Optional, Union
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Tuple, Union
 
-from bw2data import databases, get_node, labels
+from bw2data import databases, get_node, labels, projects
 from bw2data.backends.proxies import Activity
 from loguru import logger
 
+from .deferred import save_node
 from .edge_classes import ReadOnlyExchanges
 from .errors import NoAllocationNeeded
+from .instrumentation import count, phase
 from .utils import (
     product_as_process_name,
     purge_expired_linked_readonly_processes,
@@ -34,8 +37,9 @@ class MaybeMultifunctionalProcess(BaseMultifunctionalNode):
 
     def save(self, *args, **kwargs):
         set_correct_process_type(self)
-        purge_expired_linked_readonly_processes(self)
-        super().save(*args, **kwargs)
+        with phase("purge"):
+            purge_expired_linked_readonly_processes(self)
+        save_node(self, *args, **kwargs)
 
     def __str__(self):
         base = super().__str__()
@@ -43,18 +47,16 @@ class MaybeMultifunctionalProcess(BaseMultifunctionalNode):
             return f"Multifunctional: {base}"
         return base
 
-    def allocate(
-        self, strategy_label: Optional[str] = None, products_as_process: bool = False
-    ) -> Union[None, NoAllocationNeeded]:
-        if self.get("skip_allocation"):
-            return NoAllocationNeeded
-        if not self.multifunctional:
-            # Call save because we don't know if the process type should be changed
-            self.save()
-            return NoAllocationNeeded
+    def allocation_strategy(self, strategy_label: Optional[str] = None) -> Tuple[str, Callable]:
+        """Label and function of the allocation strategy to use for this process.
 
+        Uses `strategy_label` if given, otherwise the default allocation of the process or its
+        database. Strategies are resolved for the current project."""
         from . import allocation_strategies
 
+        # Resolve strategies once, so a concurrent project change can't mix strategies
+        strategies = allocation_strategies.for_project(projects.current)
+
         if strategy_label is None:
             if self.get("default_allocation"):
                 strategy_label = self.get("default_allocation")
@@ -65,8 +67,34 @@ class MaybeMultifunctionalProcess(BaseMultifunctionalNode):
             raise ValueError(
                 "Can't find `default_allocation` in input arguments, or process/database metadata."
             )
-        if strategy_label not in allocation_strategies:
+        if strategy_label not in strategies:
             raise KeyError(f"Given strategy label {strategy_label} not in `allocation_strategies`")
+        return strategy_label, strategies[strategy_label]
+
+    def allocate(
+        self, strategy_label: Optional[str] = None, products_as_process: bool = False
+    ) -> Union[None, NoAllocationNeeded]:
+        if self.get("skip_allocation"):
+            return NoAllocationNeeded
+        if not self.multifunctional:
+            # Call save because we don't know if the process type should be changed
+            self.save()
+            return NoAllocationNeeded
+
+        with phase("allocate", node_id=self.id):
+            allocated_data = self.allocation_results(strategy_label, products_as_process)
+            with phase("update_datasets"):
+                update_datasets_from_allocation_results(allocated_data)
+
+    def allocation_results(
+        self, strategy_label: Optional[str] = None, products_as_process: bool = False
+    ) -> List[dict]:
+        """Run the allocation strategy, and return the datasets to write, without changing the
+        database. Doesn't check if allocation is needed; `allocate` does both.
+
+        The first dataset is the data of this node object, which is changed; allocate a
+        `deepcopy` to leave the node as it is."""
+        strategy_label, strategy = self.allocation_strategy(strategy_label)
 
         logger.debug(
             "Allocating {p} (id: {i}) with strategy {s}",
@@ -75,10 +103,31 @@ class MaybeMultifunctionalProcess(BaseMultifunctionalNode):
             s=strategy_label,
         )
 
-        allocated_data = allocation_strategies[strategy_label](self)
+        count("nodes")
+        with phase("strategy"):
+            allocated_data = strategy(self)
         if products_as_process:
             product_as_process_name(allocated_data)
-        update_datasets_from_allocation_results(allocated_data)
+        return allocated_data
+
+    async def aallocate(
+        self,
+        strategy_label: Optional[str] = None,
+        products_as_process: bool = False,
+        progress: Optional[Callable] = None,
+        executor: Optional[Executor] = None,
+    ) -> Union[None, NoAllocationNeeded]:
+        """Asynchronous `allocate`, which doesn't block the event loop. See
+        `multifunctional.asynchronous.allocate`."""
+        from .asynchronous import allocate
+
+        return await allocate(
+            self,
+            strategy_label=strategy_label,
+            products_as_process=products_as_process,
+            progress=progress,
+            executor=executor,
+        )
 
     def rp_exchange(self):
         if self.multifunctional:
@@ -108,7 +157,7 @@ class ReadOnlyProcessWithReferenceProduct(BaseMultifunctionalNode):
         self._data["type"] = "readonly_process"
         if not self.get("mf_parent_key"):
             raise ValueError("Must specify `mf_parent_key`")
-        super().save()
+        save_node(self)
 
     def copy(self, *args, **kwargs):
         raise NotImplementedError(
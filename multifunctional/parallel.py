@@ -0,0 +1,235 @@
+"""Process many multifunctional databases of a project in parallel."""
+
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterable, List, Optional, Set
+
+from bw2data import databases, projects
+from bw2data.backends import sqlite3_lci_db
+from bw2data.backends.schema import ExchangeDataset
+from loguru import logger
+
+from .database import DEFAULT_CHUNK_SIZE, MultifunctionalDatabase, ProcessingReport
+from .utils import current_rss, peak_rss, update_datasets_from_allocation_results
+
+
+@dataclass
+class DatabaseResult:
+    """Result of processing one database. `error` is the formatted traceback if it failed."""
+
+    name: str
+    seconds: float = 0.0
+    error: Optional[str] = None
+    report: Optional[ProcessingReport] = None
+    # Database metadata after processing, written back by the calling process
+    metadata: Optional[dict] = None
+
+
+@dataclass
+class ParallelProcessingReport:
+    """Result of `process_multifunctional_databases`.
+
+    `levels` are the groups of databases which were processed at the same time; each database
+    comes after the databases it links to."""
+
+    levels: List[List[str]] = field(default_factory=list)
+    databases: Dict[str, DatabaseResult] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    @property
+    def errors(self) -> Dict[str, str]:
+        return {name: result.error for name, result in self.databases.items() if result.error}
+
+
+def dirty_multifunctional_databases() -> List[str]:
+    """Names of multifunctional databases which have changed since they were last processed."""
+    return sorted(
+        name
+        for name, metadata in databases.items()
+        if metadata.get("backend") == "multifunctional" and metadata.get("dirty")
+    )
+
+
+def database_dependencies(names: Iterable[str]) -> Dict[str, Set[str]]:
+    """Which of the databases `names` each database in `names` links to, found with one query."""
+    names = set(names)
+    dependencies = {name: set() for name in names}
+    query = (
+        ExchangeDataset.select(ExchangeDataset.output_database, ExchangeDataset.input_database)
+        .where(
+            ExchangeDataset.output_database << list(names),
+            ExchangeDataset.input_database << list(names),
+            ExchangeDataset.output_database != ExchangeDataset.input_database,
+        )
+        .distinct()
+        .tuples()
+    )
+    for output_database, input_database in query:
+        dependencies[output_database].add(input_database)
+    return dependencies
+
+
+def dependency_levels(dependencies: Dict[str, Set[str]]) -> List[List[str]]:
+    """Group databases so that each database only depends on databases in earlier groups.
+
+    Databases in a dependency cycle are put together in the last group."""
+    remaining = {name: set(linked) for name, linked in dependencies.items()}
+    levels = []
+    while remaining:
+        level = sorted(name for name, linked in remaining.items() if not linked)
+        if not level:
+            logger.warning(
+                "Circular links between databases {d}; processing them at the same time",
+                d=sorted(remaining),
+            )
+            level = sorted(remaining)
+        levels.append(level)
+        for name in level:
+            del remaining[name]
+        for linked in remaining.values():
+            linked.difference_update(level)
+    return levels
+
+
+def allocate_for_concurrent_writers(
+    database: MultifunctionalDatabase, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> ProcessingReport:
+    """Allocate all multifunctional processes in `database`, when other Python processes write to
+    the same SQLite file.
+
+    Like `allocate_in_chunks`, but the allocation strategies of a chunk run before its transaction,
+    so other processes can write meanwhile. Each transaction takes the write lock when it starts;
+    upgrading a read lock later can deadlock with other writers."""
+    if chunk_size < 1:
+        raise ValueError(f"`chunk_size` must be positive, but got {chunk_size}")
+    start = time.perf_counter()
+    report = ProcessingReport(chunk_size=chunk_size)
+    is_simapro = database._is_simapro
+    codes = database.multifunctional_codes()
+    for position in range(0, len(codes), chunk_size):
+        chunk = codes[position : position + chunk_size]
+        results = [
+            node.allocation_results(products_as_process=is_simapro)
+            for node in database.nodes_by_code(chunk)
+            if not node.get("skip_allocation")
+        ]
+        with sqlite3_lci_db.db.atomic(lock_type="IMMEDIATE"):
+            for allocated_data in results:
+                update_datasets_from_allocation_results(allocated_data)
+        report.nodes += len(chunk)
+        report.chunks += 1
+        report.max_chunk_rss = max(report.max_chunk_rss, current_rss())
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def _open_project(project: str, project_dir: Path, logs_dir: Path) -> None:
+    """Open `project`, whose data and logs are in `project_dir` and `logs_dir`."""
+    # Project directories are in the base directories, named after the project
+    projects.change_base_directories(
+        project_dir.parent, base_logs_dir=logs_dir.parent, project_name=project, update=False
+    )
+    if projects.dir != project_dir:
+        raise ValueError(f"Project {project} is in {projects.dir}, not in {project_dir}")
+
+
+def _process_database(
+    project_dir: str,
+    logs_dir: str,
+    project: str,
+    name: str,
+    timeout: float,
+    chunk_size: int,
+    csv: bool,
+) -> DatabaseResult:
+    """Worker function; runs in a new Python process with its own SQLite connection.
+
+    Database metadata changes are written to a temporary copy of `databases.json`, and returned
+    in the result, so that only the calling process writes the project metadata."""
+    start = time.perf_counter()
+    result = DatabaseResult(name)
+    try:
+        _open_project(project, Path(project_dir), Path(logs_dir))
+        # Wait for the write locks of other workers
+        sqlite3_lci_db.db.execute_sql(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+        with TemporaryDirectory() as scratch:
+            databases.filepath = Path(scratch) / databases.filename
+            database = MultifunctionalDatabase(name)
+            result.report = allocate_for_concurrent_writers(database, chunk_size)
+            database.process(csv=csv, allocate=False)
+            result.report.peak_rss = max(peak_rss(), result.report.max_chunk_rss)
+            result.metadata = dict(databases[name])
+    except Exception:
+        result.error = traceback.format_exc()
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def process_multifunctional_databases(
+    names: Optional[Iterable[str]] = None,
+    max_workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    csv: bool = False,
+    timeout: float = 60.0,
+) -> ParallelProcessingReport:
+    """Process multifunctional databases of the current project in parallel.
+
+    Processes `names`, or all dirty multifunctional databases, each in a separate Python process
+    (at most `max_workers` at a time). Databases are processed in dependency order: a database
+    which links to another one is only processed after it, and not at all if it failed.
+
+    Each database is allocated with `allocate_for_concurrent_writers` in chunks of `chunk_size`
+    processes, and then processed with `csv`. All workers write to the same SQLite file, so
+    allocation strategies and matrix building run in parallel, but writes happen one at a time;
+    `timeout` is how long (in seconds) a worker waits for the write lock. Workers don't write the
+    project metadata; the calling process writes back the database metadata once all databases
+    of a level are finished.
+
+    Errors don't stop other databases from being processed; they are given in the `errors` of
+    the returned report."""
+    start = time.perf_counter()
+    names = sorted(dirty_multifunctional_databases() if names is None else set(names))
+    dependencies = database_dependencies(names)
+    report = ParallelProcessingReport(levels=dependency_levels(dependencies))
+    if not names:
+        return report
+
+    # Workers read the metadata from disk
+    databases.flush()
+    arguments = (str(projects.dir), str(projects.logs_dir), projects.current)
+    workers = min(max_workers or os.cpu_count() or 1, max(len(level) for level in report.levels))
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for level in report.levels:
+            futures = {}
+            for name in level:
+                failed = sorted(
+                    linked for linked in dependencies[name] if report.databases[linked].error
+                )
+                if failed:
+                    report.databases[name] = DatabaseResult(
+                        name, error=f"Not processed because linked databases failed: {failed}"
+                    )
+                else:
+                    futures[name] = executor.submit(
+                        _process_database, *arguments, name, timeout, chunk_size, csv
+                    )
+            for name, future in futures.items():
+                result = report.databases[name] = future.result()
+                if result.error:
+                    logger.error("Processing {d} failed:\n{e}", d=name, e=result.error)
+            # Workers of the next level read the metadata from disk
+            for name in futures:
+                if report.databases[name].metadata is not None:
+                    databases.data[name] = report.databases[name].metadata
+            databases.flush()
+
+    report.seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,463 @@
+from numbers import Number
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from blinker import signal
+from bw2data import databases
+from bw2data.backends import sqlite3_lci_db
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from bw2data.sqlite import PickleField
+from loguru import logger
+from peewee import BooleanField, FloatField, IntegerField, Model, TextField
+
+from .utils import ensure_tables
+
+# Database metadata flag; the index is only maintained for databases where this is `True`
+INDEX_FLAG = "property_index"
+# SQLite has a limit of 999 variables per statement
+BATCH_SIZE = 125
+
+
+class FunctionalEdgeIndex(Model):
+    """One row per functional edge of a `multifunctional` process in an indexed database."""
+
+    edge_id = IntegerField(primary_key=True)
+    database = TextField(index=True)
+    process_id = IntegerField(index=True)
+    input_database = TextField()
+    input_code = TextField()
+    amount = FloatField(null=True)
+
+    class Meta:
+        table_name = "mf_functional_edge_index"
+        indexes = ((("input_database", "input_code"), False),)
+
+
+class PropertyIndex(Model):
+    """One row per property label on a functional edge (`source="edge"`) or on the node the edge
+    links to (`source="product"`)."""
+
+    label = TextField(index=True)
+    source = TextField()
+    owner_id = IntegerField()  # Edge id for source "edge", node id for source "product"
+    value = FloatField(null=True)  # Only present for numeric values
+    numeric = BooleanField()
+    raw = PickleField()
+
+    class Meta:
+        table_name = "mf_property_index"
+        indexes = ((("source", "owner_id", "label"), True),)
+
+
+class IndexedProperty(NamedTuple):
+    process_id: int
+    edge_id: int
+    product_id: Optional[int]  # `None` if the edge input doesn't exist
+    product_type: Optional[str]
+    value: Optional[float]  # Only present for numeric values
+    raw: Any  # Value as stored on the edge or product, `None` if missing
+    numeric: bool
+    source: Optional[str]  # "edge", "product", or `None` if missing
+
+
+def is_numeric(value: Any) -> bool:
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _as_float(value: Any) -> Optional[float]:
+    if not is_numeric(value):
+        return None
+    try:
+        return float(value)
+    except TypeError:
+        # E.g. complex numbers
+        return None
+
+
+def _property_rows(properties: dict, source: str, owner_id: int) -> List[dict]:
+    return [
+        {
+            "label": label,
+            "source": source,
+            "owner_id": owner_id,
+            "value": _as_float(value),
+            "numeric": is_numeric(value),
+            "raw": value,
+        }
+        for label, value in properties.items()
+    ]
+
+
+def _insert_many(model: Model, rows: List[dict]) -> None:
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.insert_many(rows[start : start + BATCH_SIZE]).execute()
+
+
+def has_property_index(database_label: str) -> bool:
+    return bool(databases.get(database_label, {}).get(INDEX_FLAG))
+
+
+def _any_property_index() -> bool:
+    return any(meta.get(INDEX_FLAG) for meta in databases.values())
+
+
+def _index_tables_exist() -> bool:
+    return sqlite3_lci_db.db.table_exists(FunctionalEdgeIndex._meta.table_name)
+
+
+def _delete_edge_rows(edge_ids: Iterable[int]) -> None:
+    edge_ids = list(edge_ids)
+    for start in range(0, len(edge_ids), BATCH_SIZE):
+        chunk = edge_ids[start : start + BATCH_SIZE]
+        PropertyIndex.delete().where(
+            PropertyIndex.source == "edge", PropertyIndex.owner_id << chunk
+        ).execute()
+        FunctionalEdgeIndex.delete().where(FunctionalEdgeIndex.edge_id << chunk).execute()
+
+
+def _delete_process_rows(process_id: int) -> None:
+    _delete_edge_rows(
+        edge_id
+        for (edge_id,) in FunctionalEdgeIndex.select(FunctionalEdgeIndex.edge_id)
+        .where(FunctionalEdgeIndex.process_id == process_id)
+        .tuples()
+    )
+
+
+def _delete_product_rows(node_ids: Iterable[int]) -> None:
+    node_ids = list(node_ids)
+    for start in range(0, len(node_ids), BATCH_SIZE):
+        PropertyIndex.delete().where(
+            PropertyIndex.source == "product",
+            PropertyIndex.owner_id << node_ids[start : start + BATCH_SIZE],
+        ).execute()
+
+
+def _delete_unused_product_rows() -> None:
+    """Delete `product` rows of nodes which don't exist anymore, or which no indexed functional
+    edge links to."""
+    PropertyIndex._meta.database.execute_sql(f"""
+DELETE FROM {PropertyIndex._meta.table_name}
+WHERE source = 'product' AND owner_id NOT IN (
+    SELECT a.id FROM activitydataset AS a
+    JOIN {FunctionalEdgeIndex._meta.table_name} AS fe
+        ON a.database = fe.input_database AND a.code = fe.input_code
+)""")
+
+
+def _delete_database_rows(database_label: str) -> None:
+    _delete_edge_rows(
+        edge_id
+        for (edge_id,) in FunctionalEdgeIndex.select(FunctionalEdgeIndex.edge_id)
+        .where(FunctionalEdgeIndex.database == database_label)
+        .tuples()
+    )
+    _delete_unused_product_rows()
+
+
+def _index_products(keys: Iterable[Tuple[str, str]]) -> None:
+    """(Re)build the `product` rows for the nodes given by `keys`."""
+    by_database = {}
+    for database, code in keys:
+        by_database.setdefault(database, set()).add(code)
+
+    for database, codes in by_database.items():
+        codes = sorted(codes)
+        for start in range(0, len(codes), BATCH_SIZE):
+            nodes = list(
+                ActivityDataset.select(ActivityDataset.id, ActivityDataset.data)
+                .where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                )
+                .tuples()
+            )
+            PropertyIndex.delete().where(
+                PropertyIndex.source == "product",
+                PropertyIndex.owner_id << [node_id for node_id, _ in nodes],
+            ).execute()
+            rows = []
+            for node_id, data in nodes:
+                rows.extend(_property_rows(data.get("properties") or {}, "product", node_id))
+            _insert_many(PropertyIndex, rows)
+
+
+def _index_edges(database_label: str, edges: Iterable[Tuple[int, int, str, str, dict]]) -> None:
+    """Insert rows for `(process_id, edge_id, input_database, input_code, edge_data)` functional
+    edges."""
+    edge_rows, property_rows, products = [], [], set()
+    for process_id, edge_id, input_database, input_code, data in edges:
+        edge_rows.append(
+            {
+                "edge_id": edge_id,
+                "database": database_label,
+                "process_id": process_id,
+                "input_database": input_database,
+                "input_code": input_code,
+                "amount": _as_float(data.get("amount")),
+            }
+        )
+        property_rows.extend(_property_rows(data.get("properties") or {}, "edge", edge_id))
+        products.add((input_database, input_code))
+
+    _insert_many(FunctionalEdgeIndex, edge_rows)
+    _insert_many(PropertyIndex, property_rows)
+    _index_products(products)
+
+
+def build_property_index(database_label: str) -> None:
+    """Create or completely rebuild the property index for the given database.
+
+    After the index is built, it is kept up to date when nodes and edges are saved, and is used by
+    the property checks in `custom_allocation` and for product property lookups during allocation.
+    """
+    if database_label not in databases:
+        raise ValueError(f"Database `{database_label}` not defined in this project")
+
+    db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    with db.atomic():
+        _delete_database_rows(database_label)
+        processes = dict(
+            ActivityDataset.select(ActivityDataset.code, ActivityDataset.id)
+            .where(
+                ActivityDataset.database == database_label,
+                ActivityDataset.type == "multifunctional",
+            )
+            .tuples()
+        )
+        qs = (
+            ExchangeDataset.select(
+                ExchangeDataset.id,
+                ExchangeDataset.output_code,
+                ExchangeDataset.input_database,
+                ExchangeDataset.input_code,
+                ExchangeDataset.data,
+            )
+            .where(ExchangeDataset.output_database == database_label)
+            .tuples()
+        )
+        _index_edges(
+            database_label,
+            (
+                (processes[output_code], edge_id, input_database, input_code, data)
+                for edge_id, output_code, input_database, input_code, data in qs.iterator()
+                if output_code in processes and data.get("functional")
+            ),
+        )
+
+    if not databases[database_label].get(INDEX_FLAG):
+        databases[database_label][INDEX_FLAG] = True
+        databases.flush()
+
+
+def drop_property_index(database_label: str) -> None:
+    """Stop maintaining the property index for the given database and delete its rows."""
+    if _index_tables_exist():
+        db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+        with db.atomic():
+            _delete_database_rows(database_label)
+    if databases.get(database_label, {}).get(INDEX_FLAG):
+        databases[database_label][INDEX_FLAG] = False
+        databases.flush()
+
+
+def reindex_process(database_label: str, code: str) -> None:
+    """Update the index rows for the functional edges of a single process."""
+    db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    node = ActivityDataset.get_or_none(
+        ActivityDataset.database == database_label, ActivityDataset.code == code
+    )
+    if node is None:
+        return
+    with db.atomic():
+        _delete_process_rows(node.id)
+        if node.type != "multifunctional":
+            return
+        _index_edges(
+            database_label,
+            (
+                (node.id, edge_id, input_database, input_code, data)
+                for edge_id, input_database, input_code, data in ExchangeDataset.select(
+                    ExchangeDataset.id,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.data,
+                )
+                .where(
+                    ExchangeDataset.output_database == database_label,
+                    ExchangeDataset.output_code == code,
+                )
+                .tuples()
+                if data.get("functional")
+            ),
+        )
+
+
+def indexed_property_values(
+    database_label: str, property_label: str, process_id: Optional[int] = None
+) -> List[IndexedProperty]:
+    """Get the value of `property_label` for every indexed functional edge in the database.
+
+    Edge properties take precedence over properties of the linked product node. Edges which don't
+    have the property are also returned, with `source=None`."""
+    db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    sql = f"""
+SELECT fe.process_id, fe.edge_id, a.id, a.type,
+    ep.value, ep.raw, ep.numeric, pp.value, pp.raw, pp.numeric
+FROM {FunctionalEdgeIndex._meta.table_name} AS fe
+LEFT JOIN activitydataset AS a
+    ON a.database = fe.input_database AND a.code = fe.input_code
+LEFT JOIN {PropertyIndex._meta.table_name} AS ep
+    ON ep.source = 'edge' AND ep.owner_id = fe.edge_id AND ep.label = ?
+LEFT JOIN {PropertyIndex._meta.table_name} AS pp
+    ON pp.source = 'product' AND pp.owner_id = a.id AND pp.label = ?
+WHERE fe.database = ?"""
+    params = [property_label, property_label, database_label]
+    if process_id is not None:
+        sql += " AND fe.process_id = ?"
+        params.append(process_id)
+
+    raw_field = PickleField()
+    results = []
+    for (
+        process,
+        edge,
+        product_id,
+        product_type,
+        edge_value,
+        edge_raw,
+        edge_numeric,
+        product_value,
+        product_raw,
+        product_numeric,
+    ) in db.execute_sql(sql + " ORDER BY fe.process_id, fe.edge_id", params):
+        if edge_raw is not None:
+            value, raw, numeric, source = edge_value, edge_raw, edge_numeric, "edge"
+        elif product_raw is not None:
+            value, raw, numeric, source = product_value, product_raw, product_numeric, "product"
+        else:
+            results.append(
+                IndexedProperty(process, edge, product_id, product_type, None, None, False, None)
+            )
+            continue
+        results.append(
+            IndexedProperty(
+                process_id=process,
+                edge_id=edge,
+                product_id=product_id,
+                product_type=product_type,
+                value=value,
+                raw=raw_field.python_value(raw),
+                numeric=bool(numeric),
+                source=source,
+            )
+        )
+    return results
+
+
+def indexed_property_labels(database_label: str, process_id: Optional[int] = None) -> Set[str]:
+    """All property labels on functional edges (or their products) in the database."""
+    db = ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    sql = f"""
+SELECT DISTINCT p.label
+FROM {FunctionalEdgeIndex._meta.table_name} AS fe
+LEFT JOIN activitydataset AS a
+    ON a.database = fe.input_database AND a.code = fe.input_code
+JOIN {PropertyIndex._meta.table_name} AS p
+    ON (p.source = 'edge' AND p.owner_id = fe.edge_id)
+    OR (p.source = 'product' AND p.owner_id = a.id)
+WHERE fe.database = ?"""
+    params = [database_label]
+    if process_id is not None:
+        sql += " AND fe.process_id = ?"
+        params.append(process_id)
+    return {label for (label,) in db.execute_sql(sql, params)}
+
+
+def indexed_node_properties(keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], dict]:
+    """Get the indexed `properties` of the given nodes.
+
+    Nodes without indexed properties are not included in the result."""
+    ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+    by_database = {}
+    for database, code in keys:
+        by_database.setdefault(database, set()).add(code)
+
+    result = {}
+    for database, codes in by_database.items():
+        codes = sorted(codes)
+        for start in range(0, len(codes), BATCH_SIZE):
+            qs = (
+                PropertyIndex.select(ActivityDataset.code, PropertyIndex.label, PropertyIndex.raw)
+                .join(ActivityDataset, on=(PropertyIndex.owner_id == ActivityDataset.id))
+                .where(
+                    PropertyIndex.source == "product",
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                )
+                .tuples()
+            )
+            for code, label, raw in qs:
+                result.setdefault((database, code), {})[label] = raw
+    return result
+
+
+def _reindex_process_once(database_label: str, code: str) -> None:
+    """`reindex_process`, or only once at the end of an active `deferred_side_effects` block."""
+    from .deferred import defer_property_reindex
+
+    if not defer_property_reindex(database_label, code):
+        reindex_process(database_label, code)
+
+
+def _on_dataset_save(sender: Any, old: Any = None, new: Any = None, **kwargs) -> None:
+    if isinstance(new, ExchangeDataset):
+        if has_property_index(new.output_database) and (
+            new.data.get("functional") or (old is not None and old.data.get("functional"))
+        ):
+            _reindex_process_once(new.output_database, new.output_code)
+    elif isinstance(new, ActivityDataset):
+        if has_property_index(new.database) and (
+            new.type == "multifunctional" or (old is not None and old.type == "multifunctional")
+        ):
+            _reindex_process_once(new.database, new.code)
+        if (
+            (new.data.get("properties") or (old is not None and old.data.get("properties")))
+            and _any_property_index()
+            and _index_tables_exist()
+        ):
+            ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+            if (
+                FunctionalEdgeIndex.select()
+                .where(
+                    FunctionalEdgeIndex.input_database == new.database,
+                    FunctionalEdgeIndex.input_code == new.code,
+                )
+                .exists()
+            ):
+                _index_products([(new.database, new.code)])
+
+
+def _on_dataset_delete(sender: Any, old: Any = None, **kwargs) -> None:
+    if isinstance(old, ExchangeDataset) and has_property_index(old.output_database):
+        ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+        _delete_edge_rows([old.id])
+    elif isinstance(old, ActivityDataset):
+        if has_property_index(old.database):
+            ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+            _delete_process_rows(old.id)
+        # Products can be in databases without index
+        if old.data.get("properties") and _any_property_index() and _index_tables_exist():
+            ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+            _delete_product_rows([old.id])
+
+
+def _on_database_delete(sender: Any, name: str = None, **kwargs) -> None:
+    if name and _index_tables_exist():
+        logger.debug("Removing property index rows for deleted database {d}", d=name)
+        ensure_tables(FunctionalEdgeIndex, PropertyIndex)
+        _delete_database_rows(name)
+
+
+signal("bw2data.signaleddataset_on_save").connect(_on_dataset_save)
+signal("bw2data.signaleddataset_on_delete").connect(_on_dataset_delete)
+signal("bw2data.on_database_delete").connect(_on_database_delete)
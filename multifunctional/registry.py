@@ -0,0 +1,168 @@
+import threading
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional
+
+from bw2data.project import ProjectDataset, projects
+
+# Key in the project dataset `data` where custom allocation specifications are persisted
+SPECIFICATIONS = "multifunctional.custom_allocations"
+
+
+@dataclass
+class ProjectStrategies:
+    """Custom allocation strategies of one project."""
+
+    specifications: Dict[str, dict]
+    # Built from `specifications` on first use, or added at runtime
+    strategies: Dict[str, Callable] = field(default_factory=dict)
+
+
+def load_specifications(project: str) -> Dict[str, dict]:
+    """Persisted custom allocation specifications for `project`."""
+    if project == projects.current:
+        data = projects.dataset.data
+    else:
+        dataset = ProjectDataset.get_or_none(ProjectDataset.name == project)
+        data = dataset.data if dataset is not None else {}
+    return dict(data.get(SPECIFICATIONS, {}))
+
+
+class StrategyRegistry(MutableMapping):
+    """Allocation strategies available in each project.
+
+    Built-in strategies in `defaults` are shared by all projects. Custom strategies belong to one
+    project; they are either added at runtime, or persisted in the project dataset and built from
+    their specification with `builder` on first use. Built strategies are cached, so changing the
+    current project doesn't rebuild anything.
+
+    Used as a mapping, the registry gives the strategies of the current project. Use `for_project`
+    to get the strategies of a given project. Changes are guarded by a lock, so the registry can be
+    shared between threads."""
+
+    def __init__(self, defaults: Dict[str, Callable], builder: Callable[[dict], Callable]):
+        self.defaults = dict(defaults)
+        self.builder = builder
+        self._projects: Dict[str, ProjectStrategies] = {}
+        self._lock = threading.RLock()
+
+    def _entry(self, project: str) -> ProjectStrategies:
+        try:
+            return self._projects[project]
+        except KeyError:
+            pass
+        with self._lock:
+            if project not in self._projects:
+                self._projects[project] = ProjectStrategies(load_specifications(project))
+            return self._projects[project]
+
+    def get_strategy(self, project: str, label: str) -> Callable:
+        entry = self._entry(project)
+        try:
+            return entry.strategies[label]
+        except KeyError:
+            pass
+        with self._lock:
+            if label in entry.strategies:
+                return entry.strategies[label]
+            if label in entry.specifications:
+                strategy = entry.strategies[label] = self.builder(entry.specifications[label])
+                return strategy
+        return self.defaults[label]
+
+    def set_strategy(self, project: str, label: str, strategy: Callable) -> None:
+        entry = self._entry(project)
+        with self._lock:
+            entry.strategies[label] = strategy
+
+    def delete_strategy(self, project: str, label: str) -> None:
+        entry = self._entry(project)
+        with self._lock:
+            found = entry.strategies.pop(label, None) is not None
+            found = entry.specifications.pop(label, None) is not None or found
+        if not found:
+            if label in self.defaults:
+                raise KeyError(f"Can't remove built-in allocation strategy `{label}`")
+            raise KeyError(label)
+
+    def labels(self, project: str) -> List[str]:
+        entry = self._entry(project)
+        with self._lock:
+            return list(dict.fromkeys([*self.defaults, *entry.specifications, *entry.strategies]))
+
+    def register(
+        self,
+        label: str,
+        specification: dict,
+        strategy: Optional[Callable] = None,
+        project: Optional[str] = None,
+    ) -> None:
+        """Add a custom strategy given by `specification` to `project` (default: current project).
+
+        `strategy` is the already built strategy, if available. Doesn't persist `specification`."""
+        entry = self._entry(project or projects.current)
+        with self._lock:
+            entry.specifications[label] = specification
+            if strategy is None:
+                entry.strategies.pop(label, None)
+            else:
+                entry.strategies[label] = strategy
+
+    def invalidate(self, project: Optional[str] = None) -> None:
+        """Forget cached strategies of `project`, or of all projects if not given.
+
+        Persisted strategies are loaded again on next use; runtime additions are lost."""
+        with self._lock:
+            if project is None:
+                self._projects.clear()
+            else:
+                self._projects.pop(project, None)
+
+    def for_project(self, project: Optional[str] = None) -> "ProjectStrategyMapping":
+        """Strategies of `project` (default: current project), independent of later changes of the
+        current project."""
+        return ProjectStrategyMapping(self, project or projects.current)
+
+    def __getitem__(self, label: str) -> Callable:
+        return self.get_strategy(projects.current, label)
+
+    def __setitem__(self, label: str, strategy: Callable) -> None:
+        self.set_strategy(projects.current, label, strategy)
+
+    def __delitem__(self, label: str) -> None:
+        self.delete_strategy(projects.current, label)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.labels(projects.current))
+
+    def __len__(self) -> int:
+        return len(self.labels(projects.current))
+
+    def __repr__(self) -> str:
+        return f"StrategyRegistry({projects.current!r}: {self.labels(projects.current)})"
+
+
+class ProjectStrategyMapping(MutableMapping):
+    """Mapping of allocation strategies for one project in a `StrategyRegistry`."""
+
+    def __init__(self, registry: StrategyRegistry, project: str):
+        self.registry = registry
+        self.project = project
+
+    def __getitem__(self, label: str) -> Callable:
+        return self.registry.get_strategy(self.project, label)
+
+    def __setitem__(self, label: str, strategy: Callable) -> None:
+        self.registry.set_strategy(self.project, label, strategy)
+
+    def __delitem__(self, label: str) -> None:
+        self.registry.delete_strategy(self.project, label)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.registry.labels(self.project))
+
+    def __len__(self) -> int:
+        return len(self.registry.labels(self.project))
+
+    def __repr__(self) -> str:
+        return f"ProjectStrategyMapping({self.project!r}: {self.registry.labels(self.project)})"
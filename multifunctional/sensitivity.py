@@ -0,0 +1,193 @@
+"""Sensitivity of an LCA score to the allocation factors of multifunctional processes."""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from bw2data import databases, labels
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from scipy.sparse.linalg import SuperLU, splu
+
+from .low_rank import _node_ids
+from .property_index import BATCH_SIZE
+
+Key = Tuple[str, str]
+
+# `{lca: (technosphere matrix, its LU factorization)}`
+_factorizations: "WeakKeyDictionary[Any, Tuple[Any, SuperLU]]" = WeakKeyDictionary()
+
+
+@dataclass
+class EdgeSensitivity:
+    allocated_code: str
+    product: Key  # Input of the functional edge
+    factor: float  # Current allocation factor
+    derivative: float  # Change of the score per unit change of the allocation factor
+
+
+@dataclass
+class ParentSensitivity:
+    """Allocation sensitivity of one multifunctional process. As the factors sum to one, `spread`
+    is the score change per unit of allocation moved from the edge with the lowest derivative to
+    the one with the highest."""
+
+    database: str
+    code: str
+    name: Optional[str]
+    strategy: Optional[str]
+    spread: float
+    edges: List[EdgeSensitivity] = field(default_factory=list)
+
+
+def _parents(names: Iterable[str]) -> Dict[Key, Tuple[Optional[str], Optional[str]]]:
+    """`{key: (name, strategy label)}` of the multifunctional processes"""
+    parents = {}
+    for database in names:
+        for code, name, data in (
+            ActivityDataset.select(ActivityDataset.code, ActivityDataset.name, ActivityDataset.data)
+            .where(ActivityDataset.database == database, ActivityDataset.type == "multifunctional")
+            .tuples()
+            .iterator()
+        ):
+            parents[(database, code)] = (name, data.get("mf_strategy_label"))
+    return parents
+
+
+def _edges(parents: List[Key]) -> Dict[Key, List[Tuple[str, Key, dict]]]:
+    """`{parent: [(edge type, input, data)]}`"""
+    by_database: Dict[str, List[str]] = {}
+    for database, code in parents:
+        by_database.setdefault(database, []).append(code)
+
+    edges: Dict[Key, list] = {}
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            for code, kind, input_database, input_code, data in (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_code,
+                    ExchangeDataset.type,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.data,
+                )
+                .where(
+                    ExchangeDataset.output_database == database,
+                    ExchangeDataset.output_code << codes[start : start + BATCH_SIZE],
+                )
+                .order_by(ExchangeDataset.id)
+                .tuples()
+                .iterator()
+            ):
+                edges.setdefault((database, code), []).append(
+                    (kind, (input_database, input_code), data)
+                )
+    return edges
+
+
+def _factorization(lca: Any) -> SuperLU:
+    """LU factorization of the technosphere matrix of `lca`, factorized once per matrix and
+    reused for the transposed solves of later calls, e.g. after `lca.switch_method()`."""
+    matrix = lca.technosphere_matrix
+    cached = _factorizations.get(lca)
+    if cached is None or cached[0] is not matrix:
+        cached = (matrix, splu(matrix.tocsc()))
+        _factorizations[lca] = cached
+    return cached[1]
+
+
+def allocation_sensitivity(
+    lca: Any, names: Optional[Iterable[str]] = None, limit: Optional[int] = None
+) -> List[ParentSensitivity]:
+    """Derivatives of the score of the solved `lca` with respect to the allocation factor of each
+    functional edge of the allocated multifunctional processes, ranked by `spread`.
+
+    Each allocated process column is its parent's non-functional column `a` (technosphere) and
+    `b` (biosphere) scaled by the allocation factor `f`, plus its unchanged functional edge. With
+    the supply `s` and the adjoint `l`, found with one solve of the transposed technosphere matrix
+    `A.T l = B.T C.T 1`, the derivative for the allocated process `j` is
+
+        dh / df_j = s_j * (1 C b - l a)
+
+    `lca` is a `bw2calc.LCA` after `lci()` and `lcia()`, built from the processed arrays of the
+    current allocation. `names` are the databases to analyse (default: all multifunctional
+    databases); processes whose allocated processes aren't in the LCA matrices are skipped.
+    Returns at most `limit` processes."""
+    if not hasattr(lca, "characterization_matrix"):
+        raise ValueError("Run `lci()` and `lcia()` on the LCA first")
+    if names is None:
+        names = sorted(
+            name for name, meta in databases.items() if meta.get("backend") == "multifunctional"
+        )
+
+    characterized = np.asarray(lca.characterization_matrix.sum(axis=0)).ravel()
+    adjoint = _factorization(lca).solve(
+        np.asarray(lca.biosphere_matrix.T @ characterized, dtype=float).ravel(), trans="T"
+    )
+    supply = np.asarray(lca.supply_array).ravel()
+
+    parents = _parents(names)
+    edges = _edges(list(parents))
+    ids = _node_ids(
+        [key for parent in edges.values() for _, key, _ in parent]
+        + [
+            (parent[0], data["mf_allocated_process_code"])
+            for parent, parent_edges in edges.items()
+            for _, _, data in parent_edges
+            if data.get("functional") and data.get("mf_allocated_process_code")
+        ]
+    )
+
+    results = []
+    for parent, parent_edges in edges.items():
+        # Marginal score of the non-functional inputs and outputs of the whole parent
+        marginal, functional, complete = 0.0, [], True
+        for kind, key, data in parent_edges:
+            if data.get("functional"):
+                functional.append(data)
+                continue
+            try:
+                if kind in labels.biosphere_edge_types:
+                    marginal += characterized[lca.dicts.biosphere[ids[key]]] * data["amount"]
+                elif kind in labels.technosphere_positive_edge_types:
+                    marginal -= adjoint[lca.dicts.product[ids[key]]] * data["amount"]
+                elif kind in labels.technosphere_negative_edge_types:
+                    marginal += adjoint[lca.dicts.product[ids[key]]] * data["amount"]
+            except KeyError:
+                complete = False
+                break
+
+        sensitivities = []
+        for data in functional:
+            code = data.get("mf_allocated_process_code")
+            try:
+                column = lca.dicts.activity[ids[(parent[0], code)]]
+            except KeyError:
+                complete = False
+                break
+            sensitivities.append(
+                EdgeSensitivity(
+                    allocated_code=code,
+                    product=tuple(data["input"]),
+                    factor=data.get("mf_allocation_factor"),
+                    derivative=float(supply[column] * marginal),
+                )
+            )
+        if not complete or not sensitivities:
+            continue
+
+        derivatives = [edge.derivative for edge in sensitivities]
+        name, strategy = parents[parent]
+        results.append(
+            ParentSensitivity(
+                database=parent[0],
+                code=parent[1],
+                name=name,
+                strategy=strategy,
+                spread=max(derivatives) - min(derivatives),
+                edges=sensitivities,
+            )
+        )
+
+    results.sort(key=lambda result: result.spread, reverse=True)
+    return results[:limit] if limit is not None else results
@@ -0,0 +1,391 @@
+"""Snapshots of allocation results, to switch back to an earlier allocation without allocating
+again."""
+
+import hashlib
+import json
+import pickle
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from blinker import signal
+from bw2data import databases
+from bw2data.backends import sqlite3_lci_db
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from loguru import logger
+from peewee import BlobField, IntegerField, Model, TextField
+
+from .property_index import BATCH_SIZE, build_property_index, has_property_index
+from .utils import ensure_tables
+
+# Increase when the layout of the stored blob changes
+SNAPSHOT_VERSION = 1
+# Number of stale processes listed in the error message
+MAX_LISTED = 10
+
+Key = Tuple[str, str]
+
+
+class AllocationSnapshot(Model):
+    """One row per snapshot; the allocated state is stored as a compressed pickle in `blob`."""
+
+    database = TextField()
+    label = TextField()
+    created = TextField()
+    processes = IntegerField()  # Number of allocated (read-only) processes
+    blob = BlobField()
+
+    class Meta:
+        table_name = "mf_allocation_snapshot"
+        indexes = ((("database", "label"), True),)
+
+
+class StaleAllocationSnapshot(ValueError):
+    """Multifunctional processes were changed after the snapshot was taken."""
+
+    pass
+
+
+def _without_bookkeeping(data: dict) -> dict:
+    return {key: value for key, value in data.items() if not key.startswith("mf_")}
+
+
+def _bookkeeping(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key.startswith("mf_")}
+
+
+def _parents(database_label: str) -> Dict[str, Tuple[int, dict, List[Tuple[int, dict]]]]:
+    """`{code: (id, data, [(edge id, edge data)])}` for the multifunctional processes."""
+    parents = {
+        code: (node_id, data, [])
+        for node_id, code, data in ActivityDataset.select(
+            ActivityDataset.id, ActivityDataset.code, ActivityDataset.data
+        )
+        .where(
+            ActivityDataset.database == database_label,
+            ActivityDataset.type == "multifunctional",
+        )
+        .tuples()
+        .iterator()
+    }
+    codes = sorted(parents)
+    for start in range(0, len(codes), BATCH_SIZE):
+        for code, edge_id, data in (
+            ExchangeDataset.select(
+                ExchangeDataset.output_code, ExchangeDataset.id, ExchangeDataset.data
+            )
+            .where(
+                ExchangeDataset.output_database == database_label,
+                ExchangeDataset.output_code << codes[start : start + BATCH_SIZE],
+            )
+            .order_by(ExchangeDataset.id)
+            .tuples()
+            .iterator()
+        ):
+            parents[code][2].append((edge_id, data))
+    return parents
+
+
+def _product_properties(keys: List[Key]) -> Dict[Key, Any]:
+    """Properties of the nodes which functional edges link to, apart from allocated processes,
+    which are themselves allocation results."""
+    by_database: Dict[str, List[str]] = {}
+    for database, code in sorted(set(keys)):
+        by_database.setdefault(database, []).append(code)
+
+    properties = {}
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            for code, data in (
+                ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+                .where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + BATCH_SIZE],
+                    ActivityDataset.type != "readonly_process",
+                )
+                .tuples()
+                .iterator()
+            ):
+                properties[(database, code)] = data.get("properties")
+    return properties
+
+
+def _fingerprints(parents: dict) -> Dict[str, str]:
+    """Hash of everything allocation depends on for each multifunctional process: its data and
+    edges apart from the `mf_` bookkeeping fields, and the properties of its products. Edge ids
+    are left out, as allocation writes the edges again."""
+    products = _product_properties(
+        [
+            tuple(data["input"])
+            for _, _, edges in parents.values()
+            for _, data in edges
+            if data.get("functional") and data.get("input")
+        ]
+    )
+    fingerprints = {}
+    for code, (_, data, edges) in parents.items():
+        content = [
+            _without_bookkeeping(data),
+            [_without_bookkeeping(edge) for _, edge in edges],
+            [
+                products.get(tuple(edge["input"]))
+                for _, edge in edges
+                if edge.get("functional") and edge.get("input")
+            ],
+        ]
+        fingerprints[code] = hashlib.sha256(
+            json.dumps(content, sort_keys=True, default=repr).encode("utf-8")
+        ).hexdigest()
+    return fingerprints
+
+
+def _allocated_processes(database_label: str) -> List[tuple]:
+    return list(
+        ActivityDataset.select(
+            ActivityDataset.code,
+            ActivityDataset.name,
+            ActivityDataset.location,
+            ActivityDataset.product,
+            ActivityDataset.type,
+            ActivityDataset.data,
+        )
+        .where(
+            ActivityDataset.database == database_label,
+            ActivityDataset.type == "readonly_process",
+        )
+        .order_by(ActivityDataset.id)
+        .tuples()
+    )
+
+
+def _allocated_edges(database_label: str, codes: List[str]) -> List[tuple]:
+    edges = []
+    for start in range(0, len(codes), BATCH_SIZE):
+        edges.extend(
+            ExchangeDataset.select(
+                ExchangeDataset.input_database,
+                ExchangeDataset.input_code,
+                ExchangeDataset.output_code,
+                ExchangeDataset.type,
+                ExchangeDataset.data,
+            )
+            .where(
+                ExchangeDataset.output_database == database_label,
+                ExchangeDataset.output_code << codes[start : start + BATCH_SIZE],
+            )
+            .order_by(ExchangeDataset.id)
+            .tuples()
+        )
+    return edges
+
+
+def _default_label(database_label: str, parents: dict) -> str:
+    labels = {data.get("mf_strategy_label") for _, data, _ in parents.values()}
+    if len(labels) != 1 or None in labels:
+        raise ValueError(
+            f"Processes in `{database_label}` weren't all allocated with the same strategy; "
+            "give a snapshot `label`"
+        )
+    return labels.pop()
+
+
+def _check_database(database_label: str) -> None:
+    if databases.get(database_label, {}).get("backend") != "multifunctional":
+        raise ValueError(f"`{database_label}` is not a multifunctional database in this project")
+
+
+def snapshot_allocation(database_label: str, label: Optional[str] = None) -> str:
+    """Store the current allocation results of a database under `label`, and return the label.
+
+    The snapshot includes the allocated (read-only) processes and their edges, and the `mf_`
+    bookkeeping fields of the multifunctional processes and their edges. The default label is the
+    strategy label all processes were allocated with. An existing snapshot with the same label is
+    replaced."""
+    _check_database(database_label)
+    db = ensure_tables(AllocationSnapshot)
+    with sqlite3_lci_db.transaction():
+        parents = _parents(database_label)
+        label = label or _default_label(database_label, parents)
+        fingerprints = _fingerprints(parents)
+        processes = _allocated_processes(database_label)
+        payload = {
+            "version": SNAPSHOT_VERSION,
+            "parents": {
+                code: (
+                    fingerprints[code],
+                    _bookkeeping(data),
+                    [_bookkeeping(edge) for _, edge in edges],
+                )
+                for code, (_, data, edges) in parents.items()
+            },
+            "processes": processes,
+            "edges": _allocated_edges(database_label, [row[0] for row in processes]),
+        }
+        blob = zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        with db.atomic():
+            AllocationSnapshot.delete().where(
+                AllocationSnapshot.database == database_label, AllocationSnapshot.label == label
+            ).execute()
+            AllocationSnapshot.create(
+                database=database_label,
+                label=label,
+                created=datetime.now(timezone.utc).isoformat(),
+                processes=len(processes),
+                blob=blob,
+            )
+    logger.debug(
+        "Stored allocation snapshot {l} of {d} ({n} bytes)", l=label, d=database_label, n=len(blob)
+    )
+    return label
+
+
+def _insert_many(model: Model, fields: list, rows: List[tuple]) -> None:
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.insert_many(rows[start : start + BATCH_SIZE], fields=fields).execute()
+
+
+def _update_data(model: Model, updates: List[Tuple[int, dict]]) -> None:
+    sql = f"UPDATE {model._meta.table_name} SET data = ? WHERE id = ?"
+    sqlite3_lci_db.db.cursor().executemany(
+        sql, [(model.data.db_value(data), row_id) for row_id, data in updates]
+    )
+
+
+def _stale_message(database_label: str, stale: List[str]) -> str:
+    listed = ", ".join(stale[:MAX_LISTED])
+    more = f" and {len(stale) - MAX_LISTED} more" if len(stale) > MAX_LISTED else ""
+    return (
+        f"{len(stale)} multifunctional process(es) in `{database_label}` were added, deleted, or "
+        f"changed since the snapshot was taken: {listed}{more}"
+    )
+
+
+def restore_allocation(database_label: str, label: str) -> int:
+    """Replace the current allocation results of a database with the snapshot `label`, and
+    return the number of restored allocated processes.
+
+    This is a bulk copy in one transaction: the allocated processes and their edges are deleted
+    and inserted again from the snapshot, and the `mf_` fields of the multifunctional processes
+    and their edges are reset. No allocation strategy is run, and no save signals are sent; the
+    property index and search index are rebuilt if the database has them.
+
+    Raises `StaleAllocationSnapshot`, and changes nothing, if multifunctional processes, their
+    edges, or the properties of their products changed since the snapshot was taken. The
+    database is marked as dirty; use `process(allocate=False)` to build its matrices without
+    allocating again."""
+    _check_database(database_label)
+    ensure_tables(AllocationSnapshot)
+    row = AllocationSnapshot.get_or_none(
+        AllocationSnapshot.database == database_label, AllocationSnapshot.label == label
+    )
+    if row is None:
+        raise KeyError(f"No allocation snapshot `{label}` for database `{database_label}`")
+    payload = pickle.loads(zlib.decompress(row.blob))
+    if payload.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Allocation snapshot `{label}` was stored by an incompatible version")
+    saved = payload["parents"]
+
+    with sqlite3_lci_db.transaction():
+        parents = _parents(database_label)
+        fingerprints = _fingerprints(parents)
+        stale = sorted(
+            set(fingerprints).symmetric_difference(saved)
+            | {
+                code
+                for code, fingerprint in fingerprints.items()
+                if code in saved and saved[code][0] != fingerprint
+            }
+        )
+        if stale:
+            raise StaleAllocationSnapshot(_stale_message(database_label, stale))
+
+        current = [code for code, *_ in _allocated_processes(database_label)]
+        for start in range(0, len(current), BATCH_SIZE):
+            ExchangeDataset.delete().where(
+                ExchangeDataset.output_database == database_label,
+                ExchangeDataset.output_code << current[start : start + BATCH_SIZE],
+            ).execute()
+        ActivityDataset.delete().where(
+            ActivityDataset.database == database_label,
+            ActivityDataset.type == "readonly_process",
+        ).execute()
+
+        _insert_many(
+            ActivityDataset,
+            [
+                ActivityDataset.code,
+                ActivityDataset.name,
+                ActivityDataset.location,
+                ActivityDataset.product,
+                ActivityDataset.type,
+                ActivityDataset.data,
+                ActivityDataset.database,
+            ],
+            [process + (database_label,) for process in payload["processes"]],
+        )
+        _insert_many(
+            ExchangeDataset,
+            [
+                ExchangeDataset.input_database,
+                ExchangeDataset.input_code,
+                ExchangeDataset.output_code,
+                ExchangeDataset.type,
+                ExchangeDataset.data,
+                ExchangeDataset.output_database,
+            ],
+            [edge + (database_label,) for edge in payload["edges"]],
+        )
+
+        nodes, edges = [], []
+        for code, (node_id, data, current_edges) in parents.items():
+            _, node_bookkeeping, edge_bookkeeping = saved[code]
+            nodes.append((node_id, {**_without_bookkeeping(data), **node_bookkeeping}))
+            # Same fingerprint, so same edges in the same order
+            for (edge_id, edge), bookkeeping in zip(current_edges, edge_bookkeeping):
+                edges.append((edge_id, {**_without_bookkeeping(edge), **bookkeeping}))
+        _update_data(ActivityDataset, nodes)
+        _update_data(ExchangeDataset, edges)
+
+        if has_property_index(database_label):
+            # Allocated processes have new ids
+            build_property_index(database_label)
+
+    databases.set_dirty(database_label)
+    if databases[database_label].get("searchable"):
+        from bw2data import Database
+
+        Database(database_label).make_searchable(reset=True, signal=False)
+    return len(payload["processes"])
+
+
+def allocation_snapshots(database_label: str) -> Dict[str, str]:
+    """`{label: creation time}` of the allocation snapshots of a database."""
+    if not sqlite3_lci_db.db.table_exists(AllocationSnapshot._meta.table_name):
+        return {}
+    ensure_tables(AllocationSnapshot)
+    return dict(
+        AllocationSnapshot.select(AllocationSnapshot.label, AllocationSnapshot.created)
+        .where(AllocationSnapshot.database == database_label)
+        .order_by(AllocationSnapshot.label)
+        .tuples()
+    )
+
+
+def delete_allocation_snapshot(database_label: str, label: Optional[str] = None) -> int:
+    """Delete the snapshot `label`, or all snapshots of the database if `label` is `None`, and
+    return the number of deleted snapshots."""
+    if not sqlite3_lci_db.db.table_exists(AllocationSnapshot._meta.table_name):
+        return 0
+    ensure_tables(AllocationSnapshot)
+    query = AllocationSnapshot.delete().where(AllocationSnapshot.database == database_label)
+    if label is not None:
+        query = query.where(AllocationSnapshot.label == label)
+    return query.execute()
+
+
+def _on_database_delete(sender: Any, name: str = None, **kwargs) -> None:
+    if name and delete_allocation_snapshot(name):
+        logger.debug("Removed allocation snapshots of deleted database {d}", d=name)
+
+
+signal("bw2data.on_database_delete").connect(_on_database_delete)
@@ -1,33 +1,57 @@
+from collections import ChainMap
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+
 import bw2data as bd
 
+from .property_index import has_property_index, indexed_node_properties
 
-def add_product_node_properties_to_exchange(obj: dict) -> dict:
-    """Add properties from products to the exchange to make them available during allocation."""
-    this = (obj["database"], obj["code"])
-    for exc in filter(lambda x: x.get("functional") and "input" in x, obj.get("exchanges", [])):
-        if exc.get("type") == "production":
-            # Keep as separate because it should eventually be an output, not an input...
-            other = exc["input"]
-        elif exc.get("type") == "technosphere":
-            other = exc["input"]
-        else:
-            other = None
-
-        if other is None or this == other:
-            continue
+EMPTY = MappingProxyType({})
+
+
+def _node_properties(key: tuple) -> dict:
+    try:
+        return bd.get_node(database=key[0], code=key[1]).get("properties", {})
+    except bd.errors.UnknownObject:
+        return {}
+
+
+def layered_properties(
+    edge_properties: Optional[Mapping], product_properties: Optional[Mapping]
+) -> Mapping:
+    """Read-only view of the edge properties over the product properties; edge properties take
+    precedence. Nothing is copied, so changes to either are visible in the view."""
+    return MappingProxyType(ChainMap(edge_properties or EMPTY, product_properties or EMPTY))
 
-        if not exc.get("properties"):
-            exc["properties"] = {}
 
-        exc["__mf__properties_from_product"] = set()
+def edge_with_product_properties(edge: Mapping, product_properties: Mapping) -> Mapping:
+    """Read-only view of `edge` whose `properties` are layered over `product_properties`."""
+    properties = layered_properties(edge.get("properties"), product_properties)
+    return MappingProxyType(ChainMap({"properties": properties}, edge))
 
-        try:
-            other = bd.get_node(database=other[0], code=other[1])
-        except bd.errors.UnknownObject:
+
+def product_node_properties(obj: dict) -> Dict[int, Mapping]:
+    """Properties of the product nodes of the functional edges of `obj`, as `{position in
+    obj['exchanges']: properties}`, to make them available during allocation.
+
+    Only production and technosphere edges which link to another node are included. Uses one
+    query for all products with the property index. Neither `obj` nor the nodes are changed."""
+    this = (obj["database"], obj["code"])
+
+    edges = {}
+    for position, exc in enumerate(obj.get("exchanges", [])):
+        if not exc.get("functional") or "input" not in exc:
+            continue
+        # Production edges are kept separate because they should eventually be an output
+        if exc.get("type") not in ("production", "technosphere"):
             continue
-        for k, v in other.get("properties", {}).items():
-            if k not in exc["properties"]:
-                exc["__mf__properties_from_product"].add(k)
-                exc["properties"][k] = v
+        other = tuple(exc["input"])
+        if this != other:
+            edges[position] = other
+
+    if edges and has_property_index(obj["database"]):
+        properties = indexed_node_properties(edges.values())
+    else:
+        properties = {key: _node_properties(key) for key in set(edges.values())}
 
-    return obj
+    return {position: properties.get(key) or EMPTY for position, key in edges.items()}
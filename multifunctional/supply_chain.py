@@ -0,0 +1,180 @@
+"""Find the multifunctional processes in the supply chain of a demand, to allocate only those."""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+from bw2data import databases, get_node, labels, projects
+from bw2data.backends.schema import ExchangeDataset
+
+from .instrumentation import count
+from .property_index import BATCH_SIZE
+
+Key = Tuple[str, str]
+
+
+@dataclass
+class DemandReport:
+    """Summary of `MultifunctionalDatabase.process_for_demand`."""
+
+    reached: int = 0  # Nodes newly reached in the supply chain
+    allocated: int = 0  # Multifunctional processes allocated in this call
+    cached: int = 0  # Multifunctional processes allocated by earlier calls
+    remaining: int = 0  # Multifunctional processes outside the supply chains so far
+    seconds: float = 0.0
+
+
+@dataclass
+class SupplyChainCache:
+    """Walked supply chain and allocated processes of one multifunctional database."""
+
+    default_allocation: Optional[str] = None
+    modified: Dict[str, Optional[str]] = field(default_factory=dict)  # Of the walked databases
+    visited: Set[Key] = field(default_factory=set)
+    products: Optional[Dict[Key, Key]] = None  # See `functional_products`
+    allocated: Set[str] = field(default_factory=set)
+
+    def record_modified(self, database: str) -> None:
+        names = {key[0] for key in self.visited} | {database}
+        self.modified = {
+            name: databases[name].get("modified") for name in names if name in databases
+        }
+
+
+_caches: Dict[Tuple[str, str], SupplyChainCache] = {}
+
+
+def supply_chain_cache(database: str) -> SupplyChainCache:
+    """Cache of `database` in the current project.
+
+    Starts again if `database` or its default allocation changed since the cache was last used,
+    and walks the supply chain again if another walked database changed."""
+    metadata = databases[database]
+    cache = _caches.get((projects.current, database))
+    if (
+        cache is None
+        or cache.default_allocation != metadata.get("default_allocation")
+        or cache.modified.get(database) != metadata.get("modified")
+    ):
+        cache = _caches[(projects.current, database)] = SupplyChainCache(
+            default_allocation=metadata.get("default_allocation")
+        )
+    elif any(
+        name not in databases or databases[name].get("modified") != modified
+        for name, modified in cache.modified.items()
+    ):
+        cache.visited.clear()
+    return cache
+
+
+def clear_supply_chain_cache(database: Optional[str] = None) -> None:
+    """Forget the cached supply chains of `database`, or of all databases."""
+    for key in list(_caches):
+        if database is None or key[1] == database:
+            del _caches[key]
+
+
+def demand_keys(demand: Iterable) -> List[Key]:
+    """Keys of the nodes in `demand`, a dictionary or iterable of nodes, keys, or ids as for
+    `bw2calc.LCA`."""
+    keys = []
+    for obj in demand:
+        if isinstance(obj, int):
+            keys.append(get_node(id=obj).key)
+        elif hasattr(obj, "key"):
+            keys.append(obj.key)
+        else:
+            keys.append(tuple(obj))
+    return keys
+
+
+def functional_products(database: str, codes: Optional[List[str]] = None) -> Dict[Key, Key]:
+    """`{product key: process key}` for the functional edges of the multifunctional processes of
+    `database`, or of those with `codes`. Products include the (desired) codes of the read-only
+    processes, and each multifunctional process also maps to itself."""
+    edges: Counter = Counter()
+    products: Dict[str, List[Key]] = {}
+    batches = (
+        [None]
+        if codes is None
+        else [codes[i : i + BATCH_SIZE] for i in range(0, len(codes), BATCH_SIZE)]
+    )
+    for batch in batches:
+        query = ExchangeDataset.select(ExchangeDataset.output_code, ExchangeDataset.data).where(
+            ExchangeDataset.output_database == database
+        )
+        if batch is not None:
+            query = query.where(ExchangeDataset.output_code << batch)
+        for code, data in query.tuples().iterator():
+            if not data.get("functional"):
+                continue
+            edges[code] += 1
+            keys = products.setdefault(code, [(database, code)])
+            if data.get("input"):
+                keys.append(tuple(data["input"]))
+            for field_name in ("desired_code", "mf_allocated_process_code"):
+                if data.get(field_name):
+                    keys.append((database, data[field_name]))
+    return {
+        product: (database, code)
+        for code, keys in products.items()
+        if edges[code] > 1
+        for product in keys
+    }
+
+
+def _linked(keys: Iterable[Key], kinds: List[str], upstream: bool) -> Iterator[Key]:
+    """Inputs of the edges of `kinds` whose output is in `keys`, or with `upstream`, outputs of
+    those whose input is in `keys`."""
+    if upstream:
+        database_field, code_field = ExchangeDataset.input_database, ExchangeDataset.input_code
+        found = (ExchangeDataset.output_database, ExchangeDataset.output_code)
+    else:
+        database_field, code_field = ExchangeDataset.output_database, ExchangeDataset.output_code
+        found = (ExchangeDataset.input_database, ExchangeDataset.input_code)
+
+    by_database: Dict[str, List[str]] = {}
+    for database, code in keys:
+        by_database.setdefault(database, []).append(code)
+    for database, codes in by_database.items():
+        for start in range(0, len(codes), BATCH_SIZE):
+            yield from (
+                ExchangeDataset.select(*found)
+                .where(
+                    database_field == database,
+                    code_field << codes[start : start + BATCH_SIZE],
+                    ExchangeDataset.type << kinds,
+                )
+                .tuples()
+            )
+
+
+def walk_supply_chain(
+    demand: Iterable[Key], products: Mapping[Key, Key], visited: Optional[Set[Key]] = None
+) -> Set[Key]:
+    """Keys of the nodes in the supply chain of `demand` which aren't in `visited`; adds them to
+    `visited`.
+
+    Follows technosphere edges from nodes to their inputs, and from products to the processes
+    producing them: through production edges, and through `products`, which maps the functional
+    products of multifunctional processes to their keys (see `functional_products`). Uses one
+    query per `BATCH_SIZE` nodes for each step away from the demand."""
+    visited = set() if visited is None else visited
+    edges = labels.technosphere_negative_edge_types + labels.technosphere_positive_edge_types
+    production = [
+        kind
+        for kind in labels.technosphere_positive_edge_types
+        if kind not in labels.substitution_edge_types
+    ]
+
+    reached = set()
+    frontier = {tuple(key) for key in demand} - visited
+    while frontier:
+        visited.update(frontier)
+        reached.update(frontier)
+        count("supply_chain_nodes", len(frontier))
+        found = {products[key] for key in frontier if key in products}
+        found.update(_linked(frontier, production, upstream=True))
+        found.update(_linked(frontier, edges, upstream=False))
+        frontier = found - visited
+    return reached
@@ -0,0 +1,266 @@
+"""Seeded generator of synthetic multifunctional inventories, for load testing and benchmarks."""
+
+import math
+import random
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bw2data import databases, geomapping
+from bw2data.backends.schema import ActivityDataset, ExchangeDataset
+from bw2data.backends.utils import dict_as_activitydataset, dict_as_exchangedataset
+from bw2data.utils import set_correct_process_type
+
+from .bulk_load import bulk_load
+from .database import MultifunctionalDatabase
+from .property_index import BATCH_SIZE, build_property_index, has_property_index
+from .utils import add_exchange_input_if_missing, label_multifunctional_nodes
+
+LOCATIONS = ("GLO", "RoW", "CH", "DE", "FR", "US")
+NONNUMERIC_VALUES = ("unknown", "n/a", None, [1, 2])
+
+
+@dataclass
+class FunctionalEdgeLayout:
+    code: str  # Code of the product node, allocated process, or process itself
+    product_node: bool
+    desired_code: bool
+    # Can be used as input by other processes; false if the allocated process gets a random code
+    linkable: bool
+
+
+@dataclass
+class SyntheticInventory:
+    """Synthetic database with multifunctional processes, following the patterns in the test
+    fixtures.
+
+    * `functional_edges` gives the distribution of the number of functional edges per process, as
+        `{number of edges: weight}`. Processes with one functional edge are normal processes.
+    * `product_nodes` is the share of functional edges which link to a separate `product` node.
+        The others are chimaera edges without `input`, and use `desired_code` with probability
+        `desired_codes`.
+    * Each process has `biosphere_edges` edges to `biosphere_flows` emission nodes, and
+        `internal_links` technosphere inputs from the products of random earlier processes
+        (including the generated codes of allocated processes).
+    * Each functional edge gets the `properties` labels, on the edge or (with probability
+        `product_properties`) on its product node. Values are missing with probability
+        `missing_properties` and non-numeric with probability `nonnumeric_properties`.
+    * `simapro` adds SimaPro database metadata, which changes the names of allocated processes.
+
+    Generation is deterministic for a given `seed`. Datasets are generated lazily by `datasets()`,
+    and each process only depends on its own index, so any number of processes can be streamed
+    with constant memory use."""
+
+    database: str = "synthetic"
+    processes: int = 100
+    functional_edges: Dict[int, float] = field(default_factory=lambda: {1: 1, 2: 5, 3: 2, 5: 1})
+    product_nodes: float = 0.5
+    desired_codes: float = 0.5
+    biosphere_flows: int = 10
+    biosphere_edges: int = 2
+    internal_links: int = 1
+    properties: Tuple[str, ...] = ("price", "mass")
+    product_properties: float = 0.5
+    missing_properties: float = 0.0
+    nonnumeric_properties: float = 0.0
+    simapro: bool = False
+    seed: int = 42
+
+    @classmethod
+    def with_exchanges(cls, exchanges: int, **kwargs) -> "SyntheticInventory":
+        """Inventory with approximately `exchanges` exchanges in total."""
+        inventory = cls(**kwargs)
+        inventory.processes = max(1, math.ceil(exchanges / inventory.exchanges_per_process))
+        return inventory
+
+    @property
+    def exchanges_per_process(self) -> float:
+        """Expected number of exchanges per process (upper bound for internal links)."""
+        total = sum(self.functional_edges.values())
+        mean = sum(count * weight for count, weight in self.functional_edges.items()) / total
+        return mean + self.biosphere_edges + self.internal_links
+
+    def metadata(self) -> dict:
+        """Database metadata to register the database with."""
+        if not self.simapro:
+            return {}
+        return {
+            "simapro_project": "synthetic",
+            "simapro_version": "9.5",
+            "simapro_csv_version": "9.0.0.0",
+        }
+
+    def _random(self, index: int, stream: str) -> random.Random:
+        return random.Random(f"{self.seed}:{index}:{stream}")
+
+    def layout(self, index: int) -> List[FunctionalEdgeLayout]:
+        """Functional edges of process `index`. Can be recomputed at any time, so other processes
+        can link to its products without storing them."""
+        rng = self._random(index, "layout")
+        count = rng.choices(list(self.functional_edges), list(self.functional_edges.values()))[0]
+        edges = []
+        for j in range(count):
+            if rng.random() < self.product_nodes:
+                edges.append(FunctionalEdgeLayout(f"product-{index}-{j}", True, False, True))
+            elif count == 1:
+                # Not allocated; the chimaera process is its own product
+                edges.append(FunctionalEdgeLayout(f"process-{index}", False, False, True))
+            elif rng.random() < self.desired_codes:
+                edges.append(FunctionalEdgeLayout(f"process-{index}-output-{j}", False, True, True))
+            else:
+                edges.append(FunctionalEdgeLayout(f"process-{index}", False, False, False))
+        return edges
+
+    def _property_values(self, rng: random.Random) -> dict:
+        values = {}
+        for label in self.properties:
+            value = rng.random()
+            if value < self.missing_properties:
+                continue
+            elif value < self.missing_properties + self.nonnumeric_properties:
+                values[label] = rng.choice(NONNUMERIC_VALUES)
+            else:
+                values[label] = round(rng.uniform(0.1, 100), 3)
+        return values
+
+    def biosphere(self) -> Iterator[dict]:
+        for index in range(self.biosphere_flows):
+            yield {
+                "database": self.database,
+                "code": f"flow-{index}",
+                "name": f"flow - {index}",
+                "unit": "kg",
+                "type": "emission",
+                "categories": ("air",),
+            }
+
+    def process(self, index: int) -> Iterator[dict]:
+        """Product nodes of process `index`, followed by the process itself."""
+        rng = self._random(index, "data")
+        exchanges = []
+        for j, edge in enumerate(self.layout(index)):
+            exchange = {
+                "functional": True,
+                "type": "production",
+                "amount": round(rng.uniform(0.5, 50), 3),
+            }
+            properties = self._property_values(rng)
+            if edge.product_node:
+                product = {
+                    "database": self.database,
+                    "code": edge.code,
+                    "name": f"product {index}-{j}",
+                    "unit": "kg",
+                    "type": "product",
+                }
+                if rng.random() < self.product_properties:
+                    product["properties"] = properties
+                else:
+                    exchange["properties"] = properties
+                exchange["input"] = (self.database, edge.code)
+                yield product
+            else:
+                exchange.update(
+                    {"name": f"product {index}-{j}", "unit": "kg", "properties": properties}
+                )
+                if edge.desired_code:
+                    exchange["desired_code"] = edge.code
+            exchanges.append(exchange)
+
+        for _ in range(self.biosphere_edges if self.biosphere_flows else 0):
+            exchanges.append(
+                {
+                    "type": "biosphere",
+                    "amount": round(rng.uniform(0.001, 10), 3),
+                    "input": (self.database, f"flow-{rng.randrange(self.biosphere_flows)}"),
+                }
+            )
+        for _ in range(self.internal_links if index else 0):
+            linkable = [edge for edge in self.layout(rng.randrange(index)) if edge.linkable]
+            if linkable:
+                exchanges.append(
+                    {
+                        "type": "technosphere",
+                        "amount": round(rng.uniform(0.001, 10), 3),
+                        "input": (self.database, rng.choice(linkable).code),
+                    }
+                )
+
+        dataset = {
+            "database": self.database,
+            "code": f"process-{index}",
+            "name": f"process - {index}",
+            "location": rng.choice(LOCATIONS),
+            "exchanges": exchanges,
+        }
+        if sum(1 for exc in exchanges if exc.get("functional")) > 1:
+            dataset["type"] = "multifunctional"
+        yield dataset
+
+    def datasets(self) -> Iterator[dict]:
+        """Generate all datasets lazily, in `write`-compatible list format."""
+        yield from self.biosphere()
+        for index in range(self.processes):
+            yield from self.process(index)
+
+    def data(self) -> Dict[Tuple[str, str], dict]:
+        """All datasets in `{(database, code): dataset}` format. Holds everything in memory; use
+        `write_synthetic_database` for large inventories."""
+        return {(ds["database"], ds["code"]): ds for ds in self.datasets()}
+
+
+def write_synthetic_database(
+    inventory: SyntheticInventory,
+    process: bool = False,
+    searchable: bool = False,
+    default_allocation: Optional[str] = "price",
+) -> MultifunctionalDatabase:
+    """Stream `inventory` into a `MultifunctionalDatabase` without loading it in memory. Replaces
+    any existing data in that database.
+
+    Prepares datasets as `MultifunctionalDatabase.write` does, `BATCH_SIZE` at a time, and inserts
+    each batch with the `ActivityDataset` and `ExchangeDataset` models, all in one `bulk_load`
+    session. Skips the search index unless `searchable`."""
+    db = MultifunctionalDatabase(inventory.database)
+    metadata = {**inventory.metadata(), "searchable": searchable}
+    if default_allocation:
+        metadata["default_allocation"] = default_allocation
+    if db.name in databases:
+        databases[db.name].update(metadata)
+    else:
+        db.register(write_empty=False, **metadata)
+
+    datasets, count, locations = inventory.datasets(), 0, set()
+    with bulk_load():
+        db.delete(keep_params=True, warn=False, vacuum=False, signal=False)
+        while True:
+            batch = {(ds["database"], ds["code"]): ds for ds in islice(datasets, BATCH_SIZE)}
+            if not batch:
+                break
+            activities, exchanges = [], []
+            for key, ds in label_multifunctional_nodes(
+                add_exchange_input_if_missing(batch)
+            ).items():
+                ds = set_correct_process_type(ds)
+                for exc in ds.pop("exchanges", []):
+                    exc.setdefault("output", key)
+                    exchanges.append(dict_as_exchangedataset(exc))
+                activities.append(dict_as_activitydataset(ds, add_snowflake_id=True))
+                if ds.get("location"):
+                    locations.add(ds["location"])
+            ActivityDataset.insert_many(activities).execute()
+            for start in range(0, len(exchanges), BATCH_SIZE):
+                ExchangeDataset.insert_many(exchanges[start : start + BATCH_SIZE]).execute()
+            count += len(batch)
+
+    databases[db.name]["number"] = count
+    databases.set_modified(db.name)
+    geomapping.add(locations)
+
+    if has_property_index(db.name):
+        build_property_index(db.name)
+    if searchable:
+        db.make_searchable(reset=True, signal=False)
+    if process:
+        db.process(bulk=True)
+    return db
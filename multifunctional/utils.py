@@ -1,15 +1,55 @@
+import os
+import sys
 from collections import Counter
 from pprint import pformat
 from typing import Dict, List
 
 from bw2data import get_node, labels
-from bw2data.backends import Exchange, Node
+from bw2data.backends import Exchange, Node, sqlite3_lci_db
 from bw2data.backends.schema import ExchangeDataset
 from bw2data.errors import UnknownObject
 from loguru import logger
+from peewee import Model, SqliteDatabase
 
 from multifunctional.errors import MultipleFunctionalExchangesWithSameInput
 
+from .instrumentation import count
+
+
+def ensure_tables(*models: Model) -> SqliteDatabase:
+    """Bind our own `peewee` models to the SQLite database of the current project.
+
+    `bw2data` replaces its database object when the project changes, so we check the binding each
+    time and create missing tables when we first see a new database object."""
+    db = sqlite3_lci_db.db
+    unbound = [model for model in models if model._meta.database is not db]
+    for model in unbound:
+        model.bind(db, bind_refs=False, bind_backrefs=False)
+    if unbound:
+        db.create_tables(unbound, safe=True)
+    return db
+
+
+def peak_rss() -> int:
+    """Highest resident memory use of this process so far, in bytes (0 if not available)."""
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss() -> int:
+    """Current resident memory use of this process in bytes, or the peak if not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
 
 def allocation_before_writing(data: Dict[tuple, dict], strategy_label: str) -> Dict[tuple, dict]:
     """Utility to perform allocation on datasets and expand `data` with allocated processes."""
@@ -64,6 +104,7 @@ def add_exchange_input_if_missing(data: dict) -> dict:
 
 def update_datasets_from_allocation_results(data: List[dict]) -> None:
     """Given data from allocation, create, update, or delete datasets as needed from `data`."""
+    from .deferred import delete_edge, save_edge
     from .node_classes import ReadOnlyProcessWithReferenceProduct
 
     for ds in data:
@@ -77,19 +118,22 @@ def update_datasets_from_allocation_results(data: List[dict]) -> None:
         # .save() calls purge_expired_linked_readonly_processes(), which will delete existing
         # read-only processes (we have a new allocation and therefore a new mf_allocation_run_uuid)
         node.save()
+        count("datasets_saved")
 
         # Delete existing edges. Much easier than trying to find the right one to update.
         for edge in ExchangeDataset.select().where(
             ExchangeDataset.output_code == ds["code"],
             ExchangeDataset.output_database == ds["database"],
         ):
-            edge.delete_instance()
+            delete_edge(edge)
+            count("edges_deleted")
 
         for exc_data in exchanges:
             exc = Exchange()
             exc.update(**exc_data)
             exc.output = node
-            exc.save()
+            save_edge(exc)
+        count("edges_saved", len(exchanges))
 
 
 def product_as_process_name(data: List[dict]) -> None:
@@ -163,6 +207,7 @@ def set_correct_process_type(dataset: Node) -> Node:
 
 def purge_expired_linked_readonly_processes(dataset: Node) -> None:
     from .database import MultifunctionalDatabase
+    from .deferred import delete_node, save_edge
 
     if not dataset.get("mf_was_once_allocated"):
         return
@@ -175,14 +220,15 @@ def purge_expired_linked_readonly_processes(dataset: Node) -> None:
                 and ds.get("mf_parent_key") == dataset.key
                 and ds["mf_allocation_run_uuid"] != dataset["mf_allocation_run_uuid"]
             ):
-                ds.delete()
+                delete_node(ds)
+                count("readonly_processes_deleted")
 
         for exc in dataset.exchanges():
             try:
                 exc.input
             except UnknownObject:
                 exc.input = dataset
-                exc.save()
+                save_edge(exc)
                 logger.debug(
                     "Edge to deleted readonly process redirected to parent process: %s",
                     exc,
@@ -207,7 +253,7 @@ def purge_expired_linked_readonly_processes(dataset: Node) -> None:
                 dataset,
             )
             edge.input = dataset
-            edge.save()
+            save_edge(edge)
             if dataset["type"] != labels.chimaera_node_default:
                 logger.debug(
                     "Change node type to chimaera: %s (%s)",
@@ -219,4 +265,5 @@ def purge_expired_linked_readonly_processes(dataset: Node) -> None:
         # Obsolete readonly processes
         for ds in MultifunctionalDatabase(dataset["database"]):
             if ds["type"] in ("readonly_process",) and ds.get("mf_parent_key") == dataset.key:
-                ds.delete()
+                delete_node(ds)
+                count("readonly_processes_deleted")
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+from test_chunked_processing import allocation_summary
+
+from multifunctional import allocation_strategies
+from multifunctional.asynchronous import Progress, ReallocationScheduler
+from multifunctional.errors import NoAllocationNeeded
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def blocking_strategy(label: str = "equal"):
+    """Strategy which waits for `release`, and records the threads it ran in."""
+    started, release, threads = threading.Event(), threading.Event(), []
+
+    def strategy(node):
+        threads.append(threading.current_thread().name)
+        started.set()
+        assert release.wait(10)
+        return allocation_strategies[label](node)
+
+    return strategy, started, release, threads
+
+
+async def wait_for(event: threading.Event) -> None:
+    assert await asyncio.get_running_loop().run_in_executor(None, event.wait, 10)
+
+
+def test_aallocate(basic):
+    basic.metadata["default_allocation"] = "price"
+    updates = []
+    result = asyncio.run(bd.get_node(code="1").aallocate(progress=updates.append))
+    assert result is None
+    assert updates == [Progress("allocate", 0, 1), Progress("done", 1, 1)]
+    check_basic_allocation_results(
+        4 * 7 / (4 * 7 + 6 * 12) * 10, 6 * 12 / (4 * 7 + 6 * 12) * 10, basic
+    )
+
+
+def test_aallocate_errors(basic):
+    process = bd.get_node(code="1")
+    with pytest.raises(ValueError):
+        asyncio.run(process.aallocate())
+    with pytest.raises(KeyError):
+        asyncio.run(process.aallocate("foo"))
+
+
+def test_aallocate_not_needed(basic):
+    assert asyncio.run(bd.get_node(code="a").aallocate()) is NoAllocationNeeded
+
+
+def test_aallocate_threads(basic):
+    strategy, started, release, threads = blocking_strategy()
+    allocation_strategies["blocking"] = strategy
+    release.set()
+    asyncio.run(bd.get_node(code="1").aallocate("blocking"))
+    assert threads and threads[0] != threading.current_thread().name
+    check_basic_allocation_results(5, 5, basic)
+
+
+def test_aallocate_cancelled(basic):
+    strategy, started, release, _ = blocking_strategy()
+    allocation_strategies["blocking"] = strategy
+
+    async def main():
+        task = asyncio.ensure_future(bd.get_node(code="1").aallocate("blocking"))
+        await wait_for(started)
+        task.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert len(basic) == 2
+    assert not bd.get_node(code="1").get("mf_was_once_allocated")
+
+
+def test_reallocation_scheduler_newest_wins(basic):
+    strategy, started, release, threads = blocking_strategy("price")
+    allocation_strategies["blocking"] = strategy
+
+    async def main():
+        scheduler = ReallocationScheduler()
+        node = bd.get_node(code="1")
+        first = scheduler.submit(node, "blocking")
+        await wait_for(started)
+        second = scheduler.submit(node, "equal")
+        assert scheduler.pending() == [node.id]
+        release.set()
+        await scheduler.wait()
+        assert first.cancelled()
+        assert second.result() is None
+        assert not scheduler.pending()
+
+    asyncio.run(main())
+    check_basic_allocation_results(5, 5, basic)
+
+
+@bw2test
+def test_aprocess():
+    for name in ("normal", "asynchronous"):
+        write_synthetic_database(SyntheticInventory(database=name, processes=30, product_nodes=1))
+    bd.Database("normal").process()
+
+    updates = []
+    asyncio.run(bd.Database("asynchronous").aprocess(progress=updates.append))
+
+    total = len(bd.Database("asynchronous").multifunctional_codes())
+    assert [update.stage for update in updates] == (
+        ["discovery"] + ["allocate"] * (total + 1) + ["matrix", "done"]
+    )
+    assert updates[-1] == Progress("done", total, total)
+    assert allocation_summary("normal") == allocation_summary("asynchronous")
+    assert bd.Database("asynchronous").filepath_processed().is_file()
+
+
+@bw2test
+def test_aprocess_cancelled():
+    write_synthetic_database(SyntheticInventory(processes=30, product_nodes=1))
+    db = bd.Database("synthetic")
+    stages = []
+
+    def progress(update):
+        # Called in the task running `aprocess`
+        stages.append(update.stage)
+        if update.done == 3:
+            asyncio.current_task().cancel()
+
+    async def main():
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.ensure_future(db.aprocess(progress=progress))
+
+    asyncio.run(main())
+    allocated = [
+        node
+        for node in db
+        if node["type"] == "multifunctional" and node.get("mf_was_once_allocated")
+    ]
+    assert len(allocated) == 3
+    assert "matrix" not in stages
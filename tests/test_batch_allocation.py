@@ -0,0 +1,108 @@
+from functools import partial
+
+import bw2data as bd
+import numpy as np
+import pytest
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+
+from multifunctional import allocation_strategies, generic_allocation, instrument
+from multifunctional.allocation import PropertyAllocationFactor, batch_allocation_factors
+from multifunctional.columnar import FunctionalEdgeTable
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+class CountingFactor:
+    """Price times amount, counting scalar and batch calls."""
+
+    def __init__(self, fail_bulk: bool = False):
+        self.fail_bulk = fail_bulk
+        self.calls = self.batches = 0
+
+    def __call__(self, edge_data: dict, node: dict) -> float:
+        self.calls += 1
+        return edge_data["amount"] * edge_data["properties"]["price"]
+
+    def batch(self, table: FunctionalEdgeTable) -> np.ndarray:
+        self.batches += 1
+        if self.fail_bulk and len(set(table.process_id.tolist())) > 1:
+            raise ValueError("Nope")
+        return table.amount * table.property_column("price").values
+
+
+def factors(database: str) -> dict:
+    return {
+        (node["code"], edge["input"]): edge["mf_allocation_factor"]
+        for node in bd.Database(database)
+        if node["type"] == "multifunctional"
+        for edge in node.functional_edges()
+    }
+
+
+def test_property_allocation_factor_batch(basic):
+    node = bd.get_node(code="1")
+    data = dict(node._data, exchanges=[exc._data for exc in node.exchanges()])
+    table = FunctionalEdgeTable.from_dataset(data)
+    functional = [exc for exc in data["exchanges"] if exc.get("functional")]
+    for func in (PropertyAllocationFactor("price"), PropertyAllocationFactor("mass", False)):
+        assert np.allclose(func.batch(table), [func(exc, data) for exc in functional])
+    with pytest.raises(KeyError):
+        PropertyAllocationFactor("volume").batch(table)
+
+
+def test_functional_edge_table_missing_properties_read_only():
+    dataset = {"exchanges": [{"functional": True, "amount": 1}, {"functional": True, "amount": 2}]}
+    table = FunctionalEdgeTable.from_dataset(dataset)
+    assert table.edge_properties == table.product_properties == [{}, {}]
+    with pytest.raises(TypeError):
+        table.edge_properties[0]["price"] = 1
+    assert table.property_column("price").present.tolist() == [False, False]
+
+
+def test_process_uses_precomputed_factors(basic):
+    basic.metadata["default_allocation"] = "price"
+    with instrument() as report:
+        basic.process()
+    assert report.total.objects["precomputed_factors"] == 2
+    check_basic_allocation_results(
+        4 * 7 / (4 * 7 + 6 * 12) * 10, 6 * 12 / (4 * 7 + 6 * 12) * 10, basic
+    )
+
+
+def test_batch_allocation_factors_skips_unresolved(basic):
+    # No default allocation
+    with batch_allocation_factors(list(basic)) as evaluated:
+        assert evaluated == 0
+
+
+@bw2test
+def test_custom_batch_strategy():
+    write_synthetic_database(SyntheticInventory(processes=40, seed=3))
+    db = bd.Database("synthetic")
+    func = CountingFactor()
+    allocation_strategies["counting"] = partial(generic_allocation, func=func)
+    db.metadata["default_allocation"] = "counting"
+    db.process()
+    assert func.batches == 1
+    assert func.calls == 0
+    batched = factors("synthetic")
+    assert batched
+
+    db.metadata["default_allocation"] = "price"
+    db.process(chunk_size=7)
+    assert factors("synthetic") == pytest.approx(batched)
+
+
+@bw2test
+def test_custom_batch_strategy_fallback():
+    write_synthetic_database(SyntheticInventory(processes=20, seed=3))
+    db = bd.Database("synthetic")
+    func = CountingFactor(fail_bulk=True)
+    allocation_strategies["counting"] = partial(generic_allocation, func=func)
+    db.metadata["default_allocation"] = "counting"
+    db.process()
+    # Failed bulk call, then one call per process
+    parents = {code for code, _ in factors("synthetic")}
+    assert parents
+    assert func.batches == 1 + len(parents)
+    assert func.calls == 0
@@ -0,0 +1,101 @@
+import logging
+
+import bw2data as bd
+import numpy as np
+import pytest
+
+from multifunctional import (
+    build_property_index,
+    check_properties_for_allocation,
+    check_property_for_allocation,
+)
+from multifunctional.columnar import FunctionalEdgeTable
+from multifunctional.custom_allocation import MessageType
+
+
+def test_check_properties_for_allocation_record_array(errors):
+    result = check_properties_for_allocation("errors", ["price", "mass"])
+    assert isinstance(result, np.recarray)
+    assert result.dtype.names == (
+        "label",
+        "process_id",
+        "edge_id",
+        "product_id",
+        "level",
+        "message_type",
+    )
+    assert len(result) == 4
+    assert set(result.label) == {"mass"}
+    assert set(result.process_id) == {bd.get_node(code="1").id}
+
+    expected = {
+        (bd.get_node(code="a").id, logging.WARNING, "MISSING_PRODUCT_PROPERTY"),
+        (bd.get_node(code="b").id, logging.CRITICAL, "NONNUMERIC_PRODUCT_PROPERTY"),
+        (bd.get_node(code="first one here").id, logging.CRITICAL, "NONNUMERIC_EDGE_PROPERTY"),
+        (bd.get_node(code="second one here").id, logging.WARNING, "MISSING_EDGE_PROPERTY"),
+    }
+    assert {(row.product_id, row.level, row.message_type) for row in result} == expected
+    assert {MessageType[name] for name in result.message_type} == {
+        MessageType.MISSING_PRODUCT_PROPERTY,
+        MessageType.NONNUMERIC_PRODUCT_PROPERTY,
+        MessageType.NONNUMERIC_EDGE_PROPERTY,
+        MessageType.MISSING_EDGE_PROPERTY,
+    }
+
+
+def test_check_properties_for_allocation_valid(errors):
+    result = check_properties_for_allocation("errors", ["price"])
+    assert len(result) == 0
+    result, messages = check_properties_for_allocation("errors", ["price"], messages=True)
+    assert len(result) == 0
+    assert messages == []
+
+
+def test_check_properties_for_allocation_missing_label(errors):
+    result = check_properties_for_allocation("errors", ["foo"])
+    assert len(result) == 7
+    assert set(result.message_type) == {"MISSING_PRODUCT_PROPERTY", "MISSING_EDGE_PROPERTY"}
+
+
+def test_check_properties_for_allocation_messages(errors):
+    result, messages = check_properties_for_allocation("errors", ["mass", "foo"], messages=True)
+    assert len(result) == len(messages) == 11
+    for row, message in zip(result, messages):
+        assert message.process_id == row.process_id
+        assert message.product_id == row.product_id
+        assert message.message_type.name == row.message_type
+        assert f"`{row.label}`" in message.message
+
+
+def test_check_properties_for_allocation_with_index(errors):
+    expected = check_properties_for_allocation("errors", ["mass", "price", "foo"])
+    build_property_index("errors")
+    indexed = check_properties_for_allocation("errors", ["mass", "price", "foo"])
+    assert sorted(map(tuple, indexed.tolist())) == sorted(map(tuple, expected.tolist()))
+
+
+def test_check_properties_for_allocation_same_as_single_label(errors):
+    single = check_property_for_allocation("errors", "mass")
+    _, batch = check_properties_for_allocation("errors", ["mass"], messages=True)
+    assert sorted(msg.message for msg in single) == sorted(msg.message for msg in batch)
+
+
+def test_check_properties_for_allocation_missing_database(errors):
+    with pytest.raises(ValueError):
+        check_properties_for_allocation("missing", ["mass"])
+
+
+def test_functional_edge_table(product_properties):
+    table = FunctionalEdgeTable.from_database("product_properties")
+    assert len(table) == 2
+    assert set(table.amount) == {4, 6}
+    assert table.labels() == {"price", "mass"}
+
+    column = table.property_column("price")
+    assert column.present.all()
+    assert column.numeric.all()
+    assert sorted(column.values) == [7, 12]
+
+    subset = table.subset(table.amount == 4)
+    assert len(subset) == 1
+    assert subset.product_id[0] == bd.get_node(code="product").id
@@ -0,0 +1,82 @@
+import bw2data as bd
+import pytest
+from bw2data.backends import sqlite3_lci_db
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+
+from multifunctional import MultifunctionalDatabase
+from multifunctional.bulk_load import BulkLoadReport, bulk_load
+
+
+def pragmas() -> tuple:
+    return tuple(
+        sqlite3_lci_db.execute_sql(f"PRAGMA {name}").fetchone()[0]
+        for name in ("journal_mode", "synchronous", "cache_size", "temp_store")
+    )
+
+
+@bw2test
+def test_bulk_load_sets_and_restores_pragmas():
+    before = pragmas()
+    with bulk_load(cache_size=-1000, reindex=True) as report:
+        assert pragmas() == ("wal", 1, -1000, 2)
+        assert sqlite3_lci_db.db.in_transaction()
+        bd.Database("foo").register()
+        bd.Database("foo").new_node(code="a", name="a").save()
+    assert pragmas() == before
+    assert report.restored == dict(
+        zip(("journal_mode", "synchronous", "cache_size", "temp_store"), before)
+    )
+    assert report.rows_changed >= 1
+    assert report.rows_per_second > 0
+    assert report.reindexed
+    assert not sqlite3_lci_db.db.in_transaction()
+
+
+@bw2test
+def test_bulk_load_restores_after_error():
+    before = pragmas()
+    bd.Database("foo").register()
+    with pytest.raises(ZeroDivisionError):
+        with bulk_load(synchronous="OFF", journal_mode=None):
+            bd.Database("foo").new_node(code="a", name="a").save()
+            1 / 0
+    assert pragmas() == before
+    # Rolled back
+    assert len(bd.Database("foo")) == 0
+
+
+@bw2test
+def test_bulk_load_nested():
+    with bulk_load(transaction=False) as outer:
+        with bulk_load(synchronous="OFF") as inner:
+            assert pragmas()[1] == 1
+            assert sqlite3_lci_db.db.in_transaction()
+    assert inner.nested and not outer.nested
+    assert inner.restored == {}
+
+
+def test_bulk_load_unknown_pragma():
+    with pytest.raises(ValueError):
+        with bulk_load(page_size=4096):
+            pass
+
+
+@bw2test
+def test_write_and_process_bulk(basic_data):
+    before = pragmas()
+    db = MultifunctionalDatabase("basic")
+    db.register(default_allocation="equal")
+    db.write(basic_data, process=False, bulk=True)
+    report = db.process(bulk={"reindex": True})
+    assert isinstance(report.bulk_load, BulkLoadReport)
+    assert report.bulk_load.reindexed
+    assert report.nodes == 1
+    assert pragmas() == before
+    check_basic_allocation_results(5, 5, db)
+
+
+def test_process_without_bulk_returns_none(basic):
+    basic.metadata["default_allocation"] = "equal"
+    assert basic.process() is None
+    assert basic.process(chunk_size=2, bulk=True).bulk_load.rows_changed > 0
@@ -0,0 +1,163 @@
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase
+from multifunctional.database import CHECKPOINT, ProcessingReport
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+from multifunctional.utils import current_rss, peak_rss
+
+
+def allocation_summary(name: str) -> list:
+    return sorted(
+        (node["code"], exc.input["code"] if exc.input else None, exc["mf_allocation_factor"])
+        for node in bd.Database(name)
+        if node["type"] == "multifunctional"
+        for exc in node.functional_edges()
+    )
+
+
+@bw2test
+def test_chunked_processing_matches_process():
+    for name in ("normal", "chunked"):
+        write_synthetic_database(SyntheticInventory(database=name, processes=40, product_nodes=1))
+
+    assert bd.Database("normal").process() is None
+    report = bd.Database("chunked").process(chunk_size=7)
+
+    assert isinstance(report, ProcessingReport)
+    assert report.nodes == len(bd.Database("chunked").multifunctional_codes())
+    assert report.chunks == -(-report.nodes // 7)
+    assert report.chunk_size == 7
+    assert report.peak_rss >= report.max_chunk_rss > 0
+    assert allocation_summary("normal") == allocation_summary("chunked")
+    assert len(bd.Database("normal")) == len(bd.Database("chunked"))
+    assert bd.Database("chunked").filepath_processed().is_file()
+
+
+@bw2test
+def test_chunked_processing_memory_budget():
+    write_synthetic_database(SyntheticInventory(processes=20))
+    report = bd.Database("synthetic").process(chunk_size=8, memory_budget=1)
+    assert report.chunk_size == 1
+    assert report.chunks > 1
+    assert all(
+        exc.get("mf_allocation_factor") is not None
+        for node in bd.Database("synthetic")
+        if node["type"] == "multifunctional"
+        for exc in node.functional_edges()
+    )
+
+
+def test_chunked_processing_reallocates(basic):
+    basic.metadata["default_allocation"] = "price"
+    basic.process(chunk_size=1)
+    basic.metadata["default_allocation"] = "mass"
+    report = basic.process(chunk_size=1)
+    assert report.nodes == report.chunks == 1
+    assert bd.get_node(code="1")["mf_strategy_label"] == "property allocation by 'mass'"
+
+
+def test_multifunctional_codes(many_products):
+    assert many_products.multifunctional_codes() == ["1"]
+
+
+@bw2test
+def test_iter_multifunctional_codes():
+    write_synthetic_database(SyntheticInventory(processes=30, product_nodes=1))
+    db = bd.Database("synthetic")
+    codes = db.multifunctional_codes()
+    assert codes == sorted(codes) and len(codes) > 3
+    assert list(db.iter_multifunctional_codes(page_size=2)) == codes
+    assert list(db.iter_multifunctional_codes(after=codes[2], page_size=3)) == codes[3:]
+
+
+@bw2test
+def test_chunked_processing_loads_nodes_per_chunk(monkeypatch):
+    write_synthetic_database(SyntheticInventory(processes=30, product_nodes=1))
+    db = bd.Database("synthetic")
+    original = MultifunctionalDatabase.nodes_by_code
+    loaded = []
+
+    def record(self, codes):
+        loaded.append(len(codes))
+        return original(self, codes)
+
+    def fail(self):
+        raise AssertionError("Found all codes up front")
+
+    monkeypatch.setattr(MultifunctionalDatabase, "nodes_by_code", record)
+    monkeypatch.setattr(MultifunctionalDatabase, "multifunctional_codes", fail)
+    report = db.allocate_in_chunks(chunk_size=4)
+    assert loaded == [4] * (report.nodes // 4) + ([report.nodes % 4] if report.nodes % 4 else [])
+
+
+def test_chunk_size_validated(basic):
+    with pytest.raises(ValueError):
+        basic.allocate_in_chunks(chunk_size=0)
+
+
+def test_rss():
+    assert current_rss() > 0
+    assert peak_rss() >= current_rss() / 2
+
+
+@bw2test
+def test_resume_after_interruption(monkeypatch):
+    for name in ("normal", "resumed"):
+        write_synthetic_database(SyntheticInventory(database=name, processes=40, product_nodes=1))
+    bd.Database("normal").process()
+
+    db = bd.Database("resumed")
+    total = len(db.multifunctional_codes())
+    original = MultifunctionalDatabase._allocate_codes
+    calls = []
+
+    def crash_on_third_chunk(self, codes, is_simapro):
+        calls.append(codes)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        original(self, codes, is_simapro)
+
+    monkeypatch.setattr(MultifunctionalDatabase, "_allocate_codes", crash_on_third_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        db.process(chunk_size=5)
+    monkeypatch.undo()
+    assert bd.databases["resumed"][CHECKPOINT]["last_code"] == calls[1][-1]
+
+    report = db.process(resume=True, chunk_size=5)
+    assert report.resumed == 10
+    assert report.repaired == 0
+    assert report.nodes == total - 10
+    assert CHECKPOINT not in bd.databases["resumed"]
+    assert allocation_summary("normal") == allocation_summary("resumed")
+    assert len(bd.Database("normal")) == len(bd.Database("resumed"))
+
+
+@bw2test
+def test_resume_repairs_inconsistent_allocation():
+    write_synthetic_database(SyntheticInventory(processes=30, product_nodes=1))
+    db = bd.Database("synthetic")
+    db.allocate_in_chunks(chunk_size=4)
+    codes = db.multifunctional_codes()
+    assert bd.databases["synthetic"][CHECKPOINT]["last_code"] == codes[-1]
+    assert db.inconsistent_allocations(codes) == set()
+
+    # Lost read-only process, as if written halfway
+    broken = next(node for node in bd.get_node(code=codes[1]).functional_edges())
+    bd.get_node(code=broken["mf_allocated_process_code"])._document.delete_instance()
+    assert db.inconsistent_allocations(codes) == {codes[1]}
+
+    report = db.process(resume=True)
+    assert (report.resumed, report.repaired, report.nodes) == (len(codes) - 1, 1, 1)
+    assert db.inconsistent_allocations(codes) == set()
+
+
+def test_resume_without_checkpoint(basic):
+    basic.metadata["default_allocation"] = "price"
+    report = basic.process(resume=True)
+    assert (report.resumed, report.repaired, report.nodes) == (0, 0, 1)
+
+    basic.metadata[CHECKPOINT] = {"last_code": "1", "default_allocation": "mass"}
+    report = basic.process(resume=True)
+    assert (report.resumed, report.nodes) == (0, 1)
@@ -0,0 +1,113 @@
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+
+from multifunctional import FunctionalEdgeClassifier, FunctionalEdgeRule, MultifunctionalDatabase
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def unlabelled(basic_data: dict) -> dict:
+    node = basic_data[("basic", "1")]
+    del node["type"]
+    for exc in node["exchanges"]:
+        exc.pop("functional", None)
+    return basic_data
+
+
+def test_classify_rules():
+    classifier = FunctionalEdgeClassifier(
+        [
+            FunctionalEdgeRule(functional=False, name="^waste"),
+            {"types": ["production"], "amount_sign": 1, "units": ["kg"]},
+            {"types": ["technosphere"], "product_types": ["product"], "amount_sign": -1},
+            {"input_databases": ["other"]},
+        ]
+    )
+    assert classifier.classify({"type": "production", "amount": 1, "unit": "kg"})
+    assert classifier.classify({"type": "production", "amount": 1, "unit": "MJ"}) is None
+    edge = {"type": "production", "amount": 1, "name": "waste", "unit": "kg"}
+    assert classifier.classify(edge) is False
+    assert (
+        classifier.classify({"type": "production", "amount": 1}, ("product", "waste oil")) is False
+    )
+    assert classifier.classify({"type": "technosphere", "amount": -2}, ("product", "x"))
+    assert classifier.classify({"type": "technosphere", "amount": 2}, ("product", "x")) is None
+    assert classifier.classify({"type": "biosphere", "input": ("other", "a")})
+    assert FunctionalEdgeClassifier([], default=False).classify({"functional": True}) is False
+
+    with pytest.raises(ValueError):
+        FunctionalEdgeClassifier([{"amount_sign": 2}])
+    with pytest.raises(TypeError):
+        FunctionalEdgeClassifier([{"colour": "blue"}])
+
+
+@bw2test
+def test_label_data(basic_data):
+    data = unlabelled(basic_data)
+    report = FunctionalEdgeClassifier([{"types": ["production"]}], default=False).label_data(data)
+
+    assert (report.edges, report.changed_edges, report.functional_edges) == (3, 2, 2)
+    assert report.changed_nodes == 1
+    assert report.multifunctional_nodes == [("basic", "1")]
+    assert data[("basic", "1")]["type"] == "multifunctional"
+
+    db = MultifunctionalDatabase("basic")
+    db.register(default_allocation="equal")
+    db.write(data)
+    check_basic_allocation_results(5, 5, db)
+
+
+def test_label_data_product_nodes(basic_data):
+    basic_data[("basic", "p")] = {"name": "product", "type": "product"}
+    basic_data[("basic", "1")]["exchanges"][2]["input"] = ("basic", "p")
+    basic_data[("basic", "1")]["exchanges"][2]["type"] = "production"
+    classifier = FunctionalEdgeClassifier([{"product_types": ["product"]}], default=False)
+    report = classifier.label_data(basic_data)
+    assert report.changed_edges == 3
+    assert report.changed_nodes == 1
+    assert basic_data[("basic", "1")]["type"] == "process"
+
+
+def test_label_database(basic):
+    basic.metadata["default_allocation"] = "equal"
+    basic.process()
+    assert len(basic) == 4
+
+    report = FunctionalEdgeClassifier([{"name": "^first"}], default=False).label_database("basic")
+    assert (report.edges, report.changed_edges, report.functional_edges) == (3, 1, 1)
+    assert report.changed_nodes == 1
+    assert report.multifunctional_nodes == []
+    node = bd.get_node(code="1")
+    # Links to itself
+    assert node["type"] == "processwithreferenceproduct"
+    assert [edge["name"] for edge in node.functional_edges()] == ["first product - 1"]
+    # Allocated processes removed
+    assert len(basic) == 2
+    assert bd.databases["basic"]["dirty"]
+
+    report = FunctionalEdgeClassifier([{"types": ["production"]}]).label_database("basic")
+    assert (report.changed_edges, report.changed_nodes) == (1, 1)
+    assert report.multifunctional_nodes == [("basic", "1")]
+    basic.process()
+    assert bd.get_node(code="1")["type"] == "multifunctional"
+    allocated = [node for node in basic if node["type"] == "readonly_process"]
+    assert sorted(node["reference product"] for node in allocated) == [
+        "first product - 1",
+        "second product - 1",
+    ]
+
+
+@bw2test
+def test_label_database_synthetic():
+    write_synthetic_database(SyntheticInventory(processes=30, product_nodes=1))
+    db = bd.Database("synthetic")
+    expected = len(db.multifunctional_codes())
+
+    # Same labels as already given
+    classifier = FunctionalEdgeClassifier(
+        [{"types": ["production"], "product_types": ["product"]}], default=False
+    )
+    report = classifier.label_database("synthetic")
+    assert report.changed_edges == report.changed_nodes == 0
+    assert len(report.multifunctional_nodes) == expected
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+from pathlib import Path
+
+import bw2data as bd
+import pytest
+from blinker import signal
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase, deferred_side_effects, on_allocation_changes
+from multifunctional.deferred import SEARCHABLE, delete_node, save_node
+from multifunctional.parallel import _open_project
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+@pytest.fixture
+def received():
+    saves, changes = [], []
+
+    def on_save(sender, **kwargs):
+        saves.append(kwargs)
+
+    def on_changes(sender, **kwargs):
+        changes.append(kwargs["changes"])
+
+    signal("bw2data.signaleddataset_on_save").connect(on_save)
+    on_allocation_changes.connect(on_changes)
+    yield saves, changes
+    signal("bw2data.signaleddataset_on_save").disconnect(on_save)
+    on_allocation_changes.disconnect(on_changes)
+
+
+@bw2test
+def test_process_defers_side_effects(basic_data, received):
+    db = MultifunctionalDatabase("basic")
+    db.register(default_allocation="equal")
+    db.write(basic_data, process=False)
+    saves, changes = received
+    saves.clear()
+
+    db.process()
+    assert saves == []
+    assert len(changes) == 1
+    readonly = {node.key for node in db if node["type"] == "readonly_process"}
+    assert len(readonly) == 2
+    assert readonly < changes[0].saved
+    assert changes[0].edges_saved > 0
+    assert {node.key for node in db.search("process")} == readonly | {("basic", "1")}
+
+
+@bw2test
+def test_readonly_processes_not_searchable(basic_data):
+    db = MultifunctionalDatabase("basic")
+    db.register(default_allocation="equal", searchable_readonly_processes=False)
+    db.write(basic_data)
+    assert [node.key for node in db.search("process")] == [("basic", "1")]
+
+
+@bw2test
+def test_deferred_side_effects_after_error(received):
+    db = bd.Database("foo")
+    db.register()
+    db.new_node(code="a", name="keep").save()
+    db.new_node(code="b", name="drop").save()
+    _, changes = received
+
+    with pytest.raises(ZeroDivisionError):
+        with deferred_side_effects("foo") as deferred:
+            save_node(db.new_node(code="c", name="new", location="somewhere"))
+            delete_node(bd.get_node(code="b"))
+            1 / 0
+    assert changes == [deferred]
+    assert deferred.saved == {("foo", "c")} and deferred.deleted == {("foo", "b")}
+    assert sorted(node["code"] for node in db.search("*")) == ["a", "c"]
+    assert "somewhere" in bd.geomapping
+    assert "searchable" not in bd.databases["foo"]
+    assert bd.databases["foo"]["dirty"]
+
+
+@bw2test
+def test_deferred_side_effects_nested():
+    bd.Database("foo").register()
+    with deferred_side_effects("foo") as outer:
+        with deferred_side_effects("foo") as inner:
+            assert inner is None
+    assert outer is not None
+
+
+def stop_in_third_chunk(project_dir: str, logs_dir: str, project: str) -> None:
+    """Run in a new Python process; processes in chunks, and exits without any cleanup."""
+    _open_project(project, Path(project_dir), Path(logs_dir))
+    original = MultifunctionalDatabase._allocate_codes
+    chunks = []
+
+    def allocate_codes(self, codes, is_simapro):
+        chunks.append(codes)
+        if len(chunks) == 3:
+            os._exit(1)
+        original(self, codes, is_simapro)
+
+    MultifunctionalDatabase._allocate_codes = allocate_codes
+    bd.Database("synthetic").process(chunk_size=5)
+
+
+@bw2test
+def test_searchable_after_stopped_processing():
+    write_synthetic_database(SyntheticInventory(processes=40, product_nodes=1), searchable=True)
+    worker = multiprocessing.get_context("spawn").Process(
+        target=stop_in_third_chunk,
+        args=(str(bd.projects.dir), str(bd.projects.logs_dir), bd.projects.current),
+    )
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 1
+
+    # Metadata as written by the stopped process
+    bd.projects.set_current(bd.projects.current)
+    assert bd.databases["synthetic"][SEARCHABLE] == {"searchable": True}
+    db = bd.Database("synthetic")
+    report = db.process(chunk_size=5, resume=True)
+    assert report.resumed == 10
+
+    bd.projects.set_current(bd.projects.current)
+    assert bd.databases["synthetic"]["searchable"] is True
+    assert SEARCHABLE not in bd.databases["synthetic"]
+    readonly = {node["code"] for node in db if node["type"] == "readonly_process"}
+    assert readonly
+    assert readonly <= {node["code"] for node in db.search("*", limit=None)}
@@ -0,0 +1,63 @@
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import export_allocation_results
+from multifunctional.export import COLUMNS, iter_allocation_results
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def test_iter_allocation_results(basic):
+    basic.metadata["default_allocation"] = "price"
+    bd.get_node(code="1").allocate()
+    rows = sorted(
+        iter_allocation_results(), key=lambda row: (row["product_code"], row["edge_type"])
+    )
+
+    assert len(rows) == 4
+    assert all(list(row) == [name for name, _ in COLUMNS] for row in rows)
+    assert {row["parent_code"] for row in rows} == {"1"}
+    assert {row["strategy"] for row in rows} == {"property allocation by 'price'"}
+
+    favorite = [row for row in rows if row["allocated_code"] == "my favorite code"]
+    assert [row["functional"] for row in favorite] == [False, True]
+    biosphere, production = favorite
+    assert biosphere["edge_type"] == "biosphere"
+    assert biosphere["input_code"] == "a"
+    assert biosphere["allocation_factor"] == pytest.approx(4 * 7 / (4 * 7 + 6 * 12))
+    assert biosphere["amount"] == pytest.approx(biosphere["allocation_factor"] * 10)
+    assert biosphere["functional_amount"] == production["amount"] == 4
+    assert biosphere["product_code"] == production["input_code"] == "my favorite code"
+
+
+def test_iter_allocation_results_not_allocated(basic):
+    assert list(iter_allocation_results(["basic"])) == []
+
+
+@bw2test
+@pytest.mark.parametrize("suffix", [".arrow", ".parquet"])
+def test_export_allocation_results(tmp_path, suffix):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    write_synthetic_database(SyntheticInventory(processes=20), process=True)
+    expected = list(iter_allocation_results())
+
+    filepath = tmp_path / f"results{suffix}"
+    assert export_allocation_results(filepath, rows_per_batch=7) == len(expected)
+
+    if suffix == ".parquet":
+        table = pq.read_table(filepath)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(str(filepath))).read_all()
+    assert table.column_names == [name for name, _ in COLUMNS]
+    assert table.to_pylist() == expected
+    assert table.column("allocation_factor").null_count == 0
+
+
+@bw2test
+def test_export_allocation_results_validation(tmp_path):
+    pytest.importorskip("pyarrow")
+    with pytest.raises(ValueError):
+        export_allocation_results(tmp_path / "results.csv", file_format="csv")
+    with pytest.raises(ValueError):
+        export_allocation_results(tmp_path / "results.arrow", rows_per_batch=0)
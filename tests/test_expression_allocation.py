@@ -0,0 +1,177 @@
+from typing import Callable
+from unittest.mock import MagicMock
+
+import bw2data as bd
+import numpy as np
+import pytest
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+
+from multifunctional import (
+    add_custom_expression_allocation_to_project,
+    allocation_strategies,
+    expression_allocation,
+)
+from multifunctional.allocation import allocation_factor_values, generic_allocation
+from multifunctional.columnar import FunctionalEdgeTable
+from multifunctional.custom_allocation import DEFAULT_ALLOCATIONS
+from multifunctional.expressions import AllocationExpression, InvalidAllocationExpression
+
+EDGES = {
+    "name": "foo",
+    "exchanges": [
+        {"functional": True, "amount": 2, "properties": {"price": 3, "mass": 4, "density": 2}},
+        {"functional": True, "amount": 5, "properties": {"price": 1, "mass": 10, "density": 4}},
+        {"functional": False, "amount": 1},
+    ],
+}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "__import__('os')",
+        "price.real",
+        "price if mass else density",
+        "'price'",
+        "True * price",
+        "price > mass",
+        "[price]",
+        "lambda: 1",
+        "round(price)",
+        "max(price, mass, key=1)",
+        "price +",
+        "max + price",
+        "price * sqrt",
+    ],
+)
+def test_allocation_expression_invalid(expression):
+    with pytest.raises(InvalidAllocationExpression):
+        AllocationExpression(expression)
+
+
+@pytest.mark.parametrize("expression", ["9 ** 9 ** 9", "2 ** (9 ** 9 ** 9)", "price ** 1e6"])
+def test_allocation_expression_large_exponent(expression):
+    with pytest.raises(InvalidAllocationExpression):
+        AllocationExpression(expression)
+    # Small constant exponents still work
+    assert AllocationExpression("2 ** 3 ** 2")({}, {}) == 512
+
+
+@pytest.mark.parametrize("expression", ["1 / 0", "price / (mass - mass)", "sqrt(price, mass, 1)"])
+def test_allocation_expression_evaluation_error(expression):
+    expr = AllocationExpression(expression)
+    edge = {"properties": {"price": 2, "mass": 3}}
+    with pytest.raises(InvalidAllocationExpression, match="process p .id 7") as error:
+        expr(edge, {"name": "p", "id": 7})
+    assert expression in str(error.value)
+
+
+def test_allocation_expression_names():
+    expr = AllocationExpression("sqrt(energy_content) * amount / density + 2")
+    assert expr.properties == {"energy_content", "density"}
+    assert expr.uses_amount
+
+
+def test_allocation_expression_scalar():
+    expr = AllocationExpression("price * mass / density")
+    assert expr(EDGES["exchanges"][0], EDGES) == 6
+    assert AllocationExpression("max(price, mass) * amount")(EDGES["exchanges"][1], EDGES) == 50
+
+
+def test_allocation_expression_scalar_errors():
+    with pytest.raises(KeyError):
+        AllocationExpression("volume")(EDGES["exchanges"][0], EDGES)
+    with pytest.raises(ValueError):
+        AllocationExpression("price")({"amount": 1, "properties": {"price": "1"}}, EDGES)
+    with pytest.raises(ValueError):
+        AllocationExpression("price / (mass - 4)")(EDGES["exchanges"][0], EDGES)
+
+
+def test_allocation_expression_batch():
+    table = FunctionalEdgeTable.from_dataset(EDGES)
+    assert len(table) == 2
+    expr = AllocationExpression("price * mass / density")
+    assert np.allclose(expr.batch(table), [6, 2.5])
+    assert np.allclose(AllocationExpression("2").batch(table), [2, 2])
+    assert np.allclose(
+        expr.batch(table), [expr(exc, EDGES) for exc in EDGES["exchanges"] if exc["functional"]]
+    )
+
+
+def test_allocation_expression_batch_errors():
+    table = FunctionalEdgeTable.from_dataset(EDGES)
+    with pytest.raises(KeyError):
+        AllocationExpression("volume").batch(table)
+    with pytest.raises(ValueError):
+        AllocationExpression("log(price - 1)").batch(table)
+
+
+def test_allocation_factor_values_uses_batch():
+    func = MagicMock(return_value=1)
+    func.batch = MagicMock(return_value=np.array([1.0, 3.0]))
+    functional = [exc for exc in EDGES["exchanges"] if exc["functional"]]
+    assert allocation_factor_values(func, EDGES, functional) == [1, 3]
+    assert not func.called
+    assert func.batch.called
+
+
+def test_expression_allocation_matches_property_allocation(basic):
+    basic.metadata["default_allocation"] = "price"
+    allocation_strategies["price expression"] = expression_allocation("price * amount")
+    try:
+        bd.get_node(code="1").allocate(strategy_label="price expression")
+    finally:
+        del allocation_strategies["price expression"]
+    check_basic_allocation_results(
+        4 * 7 / (4 * 7 + 6 * 12) * 10, 6 * 12 / (4 * 7 + 6 * 12) * 10, basic
+    )
+    assert bd.get_node(code="1")["mf_strategy_label"] == "expression allocation by 'price * amount'"
+
+
+def test_expression_allocation_product(basic):
+    allocation_strategies["price mass"] = expression_allocation("price * mass")
+    try:
+        bd.get_node(code="1").allocate(strategy_label="price mass")
+    finally:
+        del allocation_strategies["price mass"]
+    check_basic_allocation_results(42 / 90 * 10, 48 / 90 * 10, basic)
+
+
+def test_expression_allocation_generic_allocation_dict():
+    data = {
+        "database": "foo",
+        "code": "bar",
+        "exchanges": [
+            {"functional": True, "amount": 2, "properties": {"price": 3}},
+            {"functional": True, "amount": 1, "properties": {"price": 2}},
+        ],
+    }
+    generic_allocation(data, func=AllocationExpression("price"))
+    assert [exc["mf_allocation_factor"] for exc in data["exchanges"]] == [0.6, 0.4]
+
+
+@bw2test
+def test_custom_expression_allocation_persisted():
+    bd.projects.set_current("other")
+    add_custom_expression_allocation_to_project("value density", "price * mass / 2")
+    assert isinstance(allocation_strategies["value density"], Callable)
+    assert bd.projects.dataset.data["multifunctional.custom_allocations"]["value density"] == {
+        "expression": "price * mass / 2"
+    }
+
+    bd.projects.set_current("default")
+    assert set(allocation_strategies) == DEFAULT_ALLOCATIONS
+
+    bd.projects.set_current("other")
+    strategy = allocation_strategies["value density"]
+    assert strategy.keywords["func"] == AllocationExpression("price * mass / 2")
+
+
+@bw2test
+def test_custom_expression_allocation_validated():
+    with pytest.raises(InvalidAllocationExpression):
+        add_custom_expression_allocation_to_project("broken", "price; import os")
+    assert "broken" not in allocation_strategies
+    with pytest.raises(KeyError):
+        add_custom_expression_allocation_to_project("price", "price")
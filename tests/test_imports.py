@@ -0,0 +1,57 @@
+import subprocess
+import sys
+
+import pytest
+
+import multifunctional
+from multifunctional import allocation, custom_allocation, property_index, utils
+
+
+def run(code: str) -> str:
+    return subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout.strip()
+
+
+def test_import_is_lazy():
+    code = """
+import sys
+import multifunctional
+from bw2data.subclass_mapping import DATABASE_BACKEND_MAPPING, NODE_PROCESS_CLASS_MAPPING
+
+assert DATABASE_BACKEND_MAPPING["multifunctional"] is multifunctional.MultifunctionalDatabase
+assert "multifunctional" in NODE_PROCESS_CLASS_MAPPING
+print(sorted(
+    name for name in ("bw2io", "multifunctional.allocation", "multifunctional.custom_allocation")
+    if name in sys.modules
+))
+"""
+    assert run(code) == "[]"
+
+
+def test_allocation_strategies_dont_import_bw2io():
+    code = """
+import sys
+from multifunctional import allocation_strategies
+print("bw2io" in sys.modules)
+"""
+    assert run(code) == "False"
+
+
+def test_lazy_attributes():
+    assert multifunctional.allocation_strategies is allocation.allocation_strategies
+    assert multifunctional.generic_allocation is allocation.generic_allocation
+    assert (
+        multifunctional.check_properties_for_allocation
+        is custom_allocation.check_properties_for_allocation
+    )
+    assert multifunctional.build_property_index is property_index.build_property_index
+    assert multifunctional.allocation_before_writing is utils.allocation_before_writing
+    assert set(multifunctional.__all__).issubset(dir(multifunctional))
+    for name in multifunctional.__all__:
+        assert getattr(multifunctional, name) is not None
+
+
+def test_missing_attribute():
+    with pytest.raises(AttributeError):
+        multifunctional.missing
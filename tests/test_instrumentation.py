@@ -0,0 +1,74 @@
+import bw2data as bd
+
+from multifunctional import instrument
+from multifunctional.instrumentation import count, parse_statement, phase
+
+
+def test_parse_statement():
+    assert parse_statement('SELECT "t1"."id" FROM "activitydataset" AS "t1"') == (
+        "SELECT",
+        "activitydataset",
+    )
+    assert parse_statement('INSERT INTO "exchangedataset" ("data") VALUES (?)') == (
+        "INSERT",
+        "exchangedataset",
+    )
+    assert parse_statement("BEGIN") == ("BEGIN", "")
+
+
+def test_phase_without_instrumentation():
+    with phase("anything", node_id=1):
+        count("objects")
+
+
+def test_nested_phases():
+    with instrument() as report:
+        with phase("outer"):
+            count("things", 2)
+            with phase("inner", node_id=7):
+                count("things")
+            with phase("inner"):
+                pass
+
+    assert report.phases["outer"].calls == 1
+    assert report.phases["inner"].calls == 2
+    assert report.phases["outer"].objects["things"] == 3
+    assert report.phases["inner"].objects["things"] == 1
+    assert report.nodes[7].objects["things"] == 1
+    assert report.total.objects["things"] == 3
+    assert report.total.seconds >= report.phases["outer"].seconds >= 0
+
+
+def test_instrument_process(basic):
+    basic.metadata["default_allocation"] = "price"
+    reports = []
+    with instrument(callback=reports.append) as report:
+        basic.process()
+
+    assert reports == [report]
+    assert {"process", "discovery", "allocate", "strategy", "supplemental"}.issubset(report.phases)
+    assert {"allocation_factors", "copy", "update_datasets", "purge", "matrix"}.issubset(
+        report.phases
+    )
+    process_id = bd.get_node(code="1").id
+    assert list(report.nodes) == [process_id]
+    assert report.phases["allocate"].objects["nodes"] == 1
+    assert report.phases["allocate"].objects["allocated_processes"] == 2
+    assert report.nodes[process_id].objects["datasets_saved"] == 3
+
+    assert report.total.queries > 0
+    assert report.phases["update_datasets"].sql[("INSERT", "exchangedataset")] > 0
+    assert report.phases["discovery"].sql[("SELECT", "activitydataset")] > 0
+    assert report.phases["process"].queries <= report.total.queries
+    assert report.phases["matrix"].seconds <= report.phases["process"].seconds
+
+    as_dict = report.as_dict()
+    assert as_dict["nodes"][process_id]["objects"]["nodes"] == 1
+    assert as_dict["phases"]["discovery"]["sql"]["SELECT activitydataset"] > 0
+
+
+def test_instrument_restores_trace_callback(basic):
+    with instrument() as report:
+        pass
+    bd.get_node(code="1")
+    assert report.total.queries == 0
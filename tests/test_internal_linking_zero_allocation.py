@@ -1,3 +1,8 @@
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase
 from multifunctional.allocation import allocation_strategies
 
 
@@ -159,3 +164,80 @@ def test_allocation_sets_code_for_zero_allocation_products_in_multifunctional_pr
         if "mf_allocation_run_uuid" in node:
             del node["mf_allocation_run_uuid"]
     assert result == expected
+
+
+def chicken_process() -> dict:
+    """Multifunctional process with a zero allocation factor for one functional edge."""
+    return {
+        "exchanges": [
+            {"name": "🍫", "unit": "kg", "amount": 1, "type": "technosphere"},
+            {
+                "name": "🐑",
+                "unit": "kg",
+                "amount": 1.0,
+                "type": "production",
+                "desired_code": "sheep",
+                "functional": True,
+                "properties": {"manual_allocation": 100.0},
+            },
+            {
+                "name": "🐣",
+                "unit": "kg",
+                "desired_code": "cluck",
+                "amount": 0.1,
+                "type": "production",
+                "functional": True,
+                "properties": {"manual_allocation": 0.0},
+            },
+        ],
+        "type": "multifunctional",
+        "name": "(unknown)",
+        "location": None,
+        "code": "chicken",
+        "database": "db",
+    }
+
+
+def test_zero_allocation_stubs():
+    result = allocation_strategies["manual_allocation"](
+        chicken_process(), zero_allocation_stubs=True
+    )
+    sheep, cluck = result[1:]
+    assert [exc["name"] for exc in sheep["exchanges"]] == ["🐑", "🍫"]
+    assert [exc["name"] for exc in cluck["exchanges"]] == ["🐣"]
+    assert cluck["exchanges"][0]["input"] == ("db", "cluck")
+
+
+def test_allocation_tolerance():
+    given = chicken_process()
+    given["exchanges"][2]["properties"]["manual_allocation"] = 1.0
+    given["exchanges"].append({"name": "🧂", "amount": 1e-3, "type": "technosphere"})
+    result = allocation_strategies["manual_allocation"](given, tolerance=1e-4)
+    sheep, cluck = result[1:]
+    assert [exc["name"] for exc in sheep["exchanges"]] == ["🐑", "🍫", "🧂"]
+    assert [exc["name"] for exc in cluck["exchanges"]] == ["🐣", "🍫"]
+    assert cluck["exchanges"][1]["amount"] == pytest.approx(1 / 101)
+
+
+@bw2test
+def test_zero_allocation_stubs_database_metadata():
+    db = MultifunctionalDatabase("db")
+    db.register(default_allocation="manual_allocation", zero_allocation_stubs=True)
+    chicken = chicken_process()
+    chicken["exchanges"][0]["input"] = ("db", "chocolate")
+    db.write(
+        {
+            ("db", "chocolate"): {"name": "🍫", "type": "process", "exchanges": []},
+            ("db", "chicken"): chicken,
+            ("db", "egg eater"): {
+                "name": "egg eater",
+                "type": "process",
+                "exchanges": [{"input": ("db", "cluck"), "amount": 2, "type": "technosphere"}],
+            },
+        }
+    )
+    cluck = bd.get_node(code="cluck")
+    assert cluck["type"] == "readonly_process"
+    assert [exc["type"] for exc in cluck.exchanges()] == ["production"]
+    assert len(bd.get_node(code="sheep").exchanges()) == 2
+    assert next(iter(bd.get_node(code="egg eater").technosphere())).input == cluck
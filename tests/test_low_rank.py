@@ -0,0 +1,74 @@
+from copy import deepcopy
+
+import bw2calc as bc
+import bw2data as bd
+import numpy as np
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import low_rank_allocation_update
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def build_lca(demand: dict, flows: list) -> bc.LCA:
+    method = bd.Method(("low rank",))
+    if not method.registered:
+        method.register()
+    method.write([(flow.id, index + 1) for index, flow in enumerate(flows)])
+    fu, objs, _ = bd.prepare_lca_inputs(demand=demand, method=("low rank",))
+    lca = bc.LCA(fu, data_objs=objs)
+    lca.lci()
+    lca.lcia()
+    return lca
+
+
+def test_low_rank_update_basic(basic):
+    basic.metadata["default_allocation"] = "price"
+    basic.process()
+    flows = [bd.get_node(code="a")]
+    demand = {bd.get_node(code="my favorite code"): 1}
+    baseline = build_lca(demand, flows)
+    assert baseline.score == pytest.approx(4 * 7 / (4 * 7 + 6 * 12) * 10 / 4)
+
+    parent = bd.get_node(code="1")
+    before = deepcopy(parent._data)
+    result = low_rank_allocation_update(baseline, {parent: "mass"})
+    assert parent._data == before
+    assert len(result.columns) == 2
+    assert result.score == pytest.approx(4 * 6 / (4 * 6 + 6 * 4) * 10 / 4)
+    # Database and baseline unchanged
+    assert baseline.score == pytest.approx(4 * 7 / (4 * 7 + 6 * 12) * 10 / 4)
+    assert bd.get_node(code="1")["mf_strategy_label"] == "property allocation by 'price'"
+
+    same = low_rank_allocation_update(baseline, [parent])
+    assert same.score == pytest.approx(baseline.score)
+    assert np.allclose(same.supply_array, baseline.supply_array)
+
+
+@bw2test
+def test_low_rank_update_matches_reallocation():
+    write_synthetic_database(SyntheticInventory(processes=40, product_nodes=1), process=True)
+    db = bd.Database("synthetic")
+    flows = [node for node in db if node["type"] == "emission"]
+    parents = [node for node in db if node["type"] == "multifunctional"][:3]
+    demand = {node: 1 for node in db if node["type"] == "product"}
+    baseline = build_lca(demand, flows)
+
+    result = low_rank_allocation_update(baseline, {parent: "mass" for parent in parents})
+    assert len(result.columns) >= len(parents)
+    assert result.score != pytest.approx(baseline.score)
+
+    for parent in parents:
+        parent.allocate(strategy_label="mass")
+    db.process(allocate=False)
+    expected = build_lca(demand, flows)
+    assert result.score == pytest.approx(expected.score)
+    # Matrix order can change when processing again
+    inventory = np.asarray(expected.inventory.sum(axis=1)).ravel()
+    for node_id, row in baseline.dicts.biosphere.items():
+        assert result.inventory[row] == pytest.approx(inventory[expected.dicts.biosphere[node_id]])
+
+
+def test_low_rank_update_needs_lci(basic):
+    with pytest.raises(ValueError, match="lci"):
+        low_rank_allocation_update(object(), [])
@@ -0,0 +1,198 @@
+import csv
+
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import (
+    MultifunctionalDatabase,
+    build_property_index,
+    import_manual_allocation_factors,
+)
+from multifunctional.manual_factors import FACTOR_COLUMNS, InvalidAllocationFactors
+from multifunctional.property_index import indexed_property_values
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def synthetic_rows(factor: float = 2.0) -> list:
+    """One factor per functional edge of every multifunctional process, increasing per edge."""
+    rows = []
+    for node in bd.Database("synthetic"):
+        if node["type"] == "multifunctional":
+            for i, edge in enumerate(node.functional_edges()):
+                rows.append(("synthetic", node["code"], *edge["input"], factor + i))
+    return rows
+
+
+@pytest.fixture
+@bw2test
+def synthetic():
+    write_synthetic_database(SyntheticInventory(processes=20, product_nodes=1))
+    return bd.Database("synthetic")
+
+
+def test_import_manual_factors(synthetic):
+    rows = synthetic_rows()
+    report = import_manual_allocation_factors(
+        rows, reallocate=True, strategy_label="manual_allocation"
+    )
+
+    parents = sorted({row[1] for row in rows})
+    assert report.edges == len(rows)
+    assert sorted(code for _, code in report.parents) == parents
+    assert report.reallocated == len(parents)
+    assert report.uncovered == []
+    for node in synthetic:
+        if node["type"] == "multifunctional":
+            edges = list(node.functional_edges())
+            expected = [2.0 + i for i in range(len(edges))]
+            assert [edge["properties"]["manual_allocation"] for edge in edges] == expected
+            assert [edge["mf_allocation_factor"] for edge in edges] == pytest.approx(
+                [value / sum(expected) for value in expected]
+            )
+    assert bd.databases["synthetic"]["dirty"]
+
+
+def test_import_manual_factors_keeps_other_properties(synthetic):
+    rows = synthetic_rows()
+    import_manual_allocation_factors(rows, property_label="custom")
+    node = bd.get_node(database="synthetic", code=rows[0][1])
+    edge = next(iter(node.functional_edges()))
+    assert edge["properties"]["custom"] == 2.0
+    assert "mass" in edge["properties"] or "mass" in edge.input.get("properties", {})
+    assert not node.get("mf_was_once_allocated")
+
+
+def test_import_manual_factors_csv(synthetic, tmp_path):
+    rows = synthetic_rows()
+    filepath = tmp_path / "factors.csv"
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("comment",) + FACTOR_COLUMNS)
+        writer.writerows(("",) + row for row in rows)
+    assert import_manual_allocation_factors(filepath).edges == len(rows)
+
+
+def test_import_manual_factors_parquet(synthetic, tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = synthetic_rows()
+    filepath = tmp_path / "factors.parquet"
+    pq.write_table(pa.table(dict(zip(FACTOR_COLUMNS, zip(*rows)))), filepath)
+    assert import_manual_allocation_factors(filepath).edges == len(rows)
+
+
+def test_import_manual_factors_property_index(synthetic):
+    build_property_index("synthetic")
+    rows = synthetic_rows()
+    import_manual_allocation_factors(rows)
+    values = indexed_property_values("synthetic", "manual_allocation")
+    assert sorted(value.value for value in values) == sorted(row[4] for row in rows)
+
+
+def test_import_manual_factors_desired_code(basic):
+    rows = [("basic", "1", "basic", "my favorite code", 1)]
+    with pytest.raises(InvalidAllocationFactors, match="no factor for functional edge"):
+        import_manual_allocation_factors(rows)
+    report = import_manual_allocation_factors(rows, require_complete=False)
+    assert report.edges == 1
+    assert len(report.uncovered) == 1
+
+
+@bw2test
+def test_import_manual_factors_allocated_process_code():
+    db = MultifunctionalDatabase("shared")
+    db.register(default_allocation="equal")
+    db.write(
+        {
+            ("shared", "product"): {"name": "product", "type": "product"},
+            ("shared", "1"): {
+                "name": "process",
+                "type": "multifunctional",
+                "exchanges": [
+                    {
+                        "functional": True,
+                        "type": "production",
+                        "amount": amount,
+                        "input": ("shared", "product"),
+                        "name": name,
+                    }
+                    for amount, name in ((1, "first"), (2, "second"))
+                ],
+            },
+        }
+    )
+    rows = [("shared", "1", "shared", "product", 1), ("shared", "1", "shared", "product", 3)]
+    with pytest.raises(InvalidAllocationFactors, match="allocated process code instead"):
+        import_manual_allocation_factors(rows)
+
+    codes = [edge["mf_allocated_process_code"] for edge in bd.get_node(code="1").functional_edges()]
+    rows = [("shared", "1", "shared", code, factor) for code, factor in zip(codes, (1, 3))]
+    # Named like in `process`
+    db.metadata["products_as_process"] = True
+    report = import_manual_allocation_factors(
+        rows, reallocate=True, strategy_label="manual_allocation"
+    )
+    assert report.edges == 2
+    assert [
+        edge["mf_allocation_factor"] for edge in bd.get_node(code="1").functional_edges()
+    ] == pytest.approx([0.25, 0.75])
+    assert sorted(node["name"] for node in db if node["type"] == "readonly_process") == [
+        "first",
+        "second",
+    ]
+
+
+@bw2test
+def test_import_manual_factors_reallocate_other_backend():
+    db = bd.Database("plain")
+    db.write(
+        {
+            ("plain", "1"): {
+                "name": "process",
+                "exchanges": [
+                    {"functional": True, "type": "production", "amount": 1, "input": ("plain", "1")}
+                ],
+            }
+        }
+    )
+    rows = [("plain", "1", "plain", "1", 1)]
+    with pytest.raises(ValueError, match="`multifunctional` databases"):
+        import_manual_allocation_factors(rows, reallocate=True)
+    edge = next(iter(bd.get_node(code="1").production()))
+    assert "manual_allocation" not in (edge.get("properties") or {})
+
+    report = import_manual_allocation_factors(rows)
+    assert report.edges == 1
+
+
+def test_import_manual_factors_validation(synthetic):
+    rows = synthetic_rows()
+    parent, product = rows[0][1], rows[0][3]
+    bad = rows + [
+        rows[0],
+        ("synthetic", parent, "synthetic", "nope", 1),
+        ("synthetic", "missing", "synthetic", product, 1),
+        ("synthetic", parent, "synthetic", product, -1),
+        ("synthetic", parent, "synthetic", product, "x"),
+    ]
+    with pytest.raises(InvalidAllocationFactors) as error:
+        import_manual_allocation_factors(bad)
+    message = str(error.value)
+    assert "more than once" in message
+    assert "no functional edge to ('synthetic', 'nope')" in message
+    assert "('synthetic', 'missing') not found" in message
+    assert "invalid factor -1" in message
+    assert "invalid factor 'x'" in message
+    # Nothing written
+    assert not any(
+        "manual_allocation" in (edge.get("properties") or {})
+        for node in synthetic
+        for edge in node.functional_edges()
+    )
+
+
+def test_import_manual_factors_zero_sum(synthetic):
+    rows = [row[:4] + (0,) for row in synthetic_rows()]
+    with pytest.raises(InvalidAllocationFactors, match="sum to zero"):
+        import_manual_allocation_factors(rows)
@@ -0,0 +1,116 @@
+import bw2data as bd
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase, process_multifunctional_databases
+from multifunctional.parallel import (
+    _process_database,
+    database_dependencies,
+    dependency_levels,
+    dirty_multifunctional_databases,
+)
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def write_downstream(name: str, upstream: str, **metadata) -> None:
+    """Database with one multifunctional process which consumes a product of `upstream`."""
+    db = MultifunctionalDatabase(name)
+    db.register(**metadata)
+    db.write(
+        {
+            (name, "1"): {
+                "name": "downstream process",
+                "exchanges": [
+                    {"functional": True, "type": "production", "name": "a", "amount": 1},
+                    {"functional": True, "type": "production", "name": "b", "amount": 3},
+                    {"type": "technosphere", "amount": 2, "input": (upstream, "product-0-0")},
+                ],
+            }
+        },
+        process=False,
+    )
+    bd.databases[name]["dirty"] = True
+
+
+def setup_project(failing: bool = False) -> None:
+    for name in ("upstream", "other"):
+        write_synthetic_database(SyntheticInventory(database=name, processes=10, product_nodes=1))
+        bd.databases[name]["dirty"] = True
+    if failing:
+        del bd.databases["upstream"]["default_allocation"]
+    write_downstream("downstream", "upstream", default_allocation="equal")
+    bd.databases.flush()
+
+
+def test_dependency_levels():
+    dependencies = {"a": set(), "b": {"a"}, "c": {"a", "b"}, "d": set()}
+    assert dependency_levels(dependencies) == [["a", "d"], ["b"], ["c"]]
+
+
+def test_dependency_levels_cycle():
+    dependencies = {"a": set(), "b": {"c"}, "c": {"b"}}
+    assert dependency_levels(dependencies) == [["a"], ["b", "c"]]
+
+
+@bw2test
+def test_database_dependencies():
+    setup_project()
+    assert dirty_multifunctional_databases() == ["downstream", "other", "upstream"]
+    assert database_dependencies(["downstream", "other", "upstream"]) == {
+        "downstream": {"upstream"},
+        "other": set(),
+        "upstream": set(),
+    }
+    assert database_dependencies(["downstream"]) == {"downstream": set()}
+
+
+@bw2test
+def test_process_multifunctional_databases():
+    setup_project()
+    report = process_multifunctional_databases(max_workers=2)
+
+    assert report.levels == [["other", "upstream"], ["downstream"]]
+    assert not report.errors
+    assert set(report.databases) == {"downstream", "other", "upstream"}
+    assert report.seconds >= max(result.seconds for result in report.databases.values())
+    for name in report.databases:
+        assert not bd.databases[name]["dirty"]
+        assert bd.databases[name]["processed"]
+        assert bd.Database(name).filepath_processed().is_file()
+    assert bd.databases["downstream"]["depends"] == ["upstream"]
+    assert bd.get_node(database="downstream", code="1")["mf_was_once_allocated"]
+    assert not dirty_multifunctional_databases()
+
+
+@bw2test
+def test_process_multifunctional_databases_errors():
+    setup_project(failing=True)
+    report = process_multifunctional_databases(chunk_size=5, max_workers=1)
+
+    assert set(report.errors) == {"downstream", "upstream"}
+    assert "ValueError" in report.errors["upstream"]
+    assert "upstream" in report.errors["downstream"]
+    assert report.databases["other"].report.nodes
+    assert bd.databases["upstream"]["dirty"]
+    assert dirty_multifunctional_databases() == ["downstream", "upstream"]
+
+
+@bw2test
+def test_process_multifunctional_databases_nothing_dirty():
+    report = process_multifunctional_databases()
+    assert report.levels == [] and report.databases == {}
+
+
+@bw2test
+def test_worker_leaves_project_metadata_alone():
+    setup_project()
+    metadata_file = bd.projects.dir / bd.databases.filename
+    before = metadata_file.read_bytes()
+    result = _process_database(
+        str(bd.projects.dir), str(bd.projects.logs_dir), bd.projects.current, "other", 5, 3, False
+    )
+    assert result.error is None
+    assert metadata_file.read_bytes() == before
+    assert result.metadata["processed"] and not result.metadata["dirty"]
+
+    bd.projects.set_current(bd.projects.current)
+    assert bd.databases["other"]["dirty"]
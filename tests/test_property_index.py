@@ -0,0 +1,235 @@
+import logging
+from copy import deepcopy
+
+import bw2data as bd
+import pytest
+from fixtures.product_properties import DATA
+
+from multifunctional import (
+    build_property_index,
+    check_property_for_allocation,
+    check_property_for_process_allocation,
+    deferred_side_effects,
+    drop_property_index,
+    list_available_properties,
+)
+from multifunctional.custom_allocation import MessageType
+from multifunctional.property_index import (
+    PropertyIndex,
+    has_property_index,
+    indexed_node_properties,
+    indexed_property_labels,
+    indexed_property_values,
+    reindex_process,
+)
+
+
+def test_build_property_index_metadata(product_properties):
+    assert not has_property_index("product_properties")
+    build_property_index("product_properties")
+    assert has_property_index("product_properties")
+    assert bd.databases["product_properties"]["property_index"]
+
+    drop_property_index("product_properties")
+    assert not has_property_index("product_properties")
+    assert not indexed_property_values("product_properties", "price")
+
+
+def test_build_property_index_missing_database(product_properties):
+    with pytest.raises(ValueError):
+        build_property_index("missing")
+
+
+def test_indexed_property_values(product_properties):
+    build_property_index("product_properties")
+    process = bd.get_node(code="1")
+    product = bd.get_node(code="product")
+
+    rows = indexed_property_values("product_properties", "price")
+    assert len(rows) == 2
+    assert {row.process_id for row in rows} == {process.id}
+    by_source = {row.source: row for row in rows}
+    assert by_source["product"].product_id == product.id
+    assert by_source["product"].value == 7
+    assert by_source["product"].numeric
+    assert by_source["edge"].value == 12
+
+    rows = indexed_property_values("product_properties", "missing")
+    assert {row.source for row in rows} == {None}
+
+
+def test_indexed_property_labels(product_properties):
+    build_property_index("product_properties")
+    assert indexed_property_labels("product_properties") == {"price", "mass"}
+    assert indexed_property_labels("product_properties", bd.get_node(code="product").id) == set()
+
+
+def test_index_updated_on_edge_save(product_properties):
+    build_property_index("product_properties")
+    process = bd.get_node(code="1")
+    edge = next(exc for exc in process.functional_edges() if exc.get("properties"))
+    edge["properties"]["price"] = "expensive"
+    edge["properties"]["volume"] = 2
+    edge.save()
+
+    assert "volume" in indexed_property_labels("product_properties")
+    row = next(
+        row
+        for row in indexed_property_values("product_properties", "price")
+        if row.edge_id == edge.id
+    )
+    assert row.raw == "expensive"
+    assert row.value is None
+    assert not row.numeric
+
+
+def test_index_updated_once_per_process_in_deferred_block(product_properties, monkeypatch):
+    build_property_index("product_properties")
+    calls = []
+
+    def record(database, code):
+        calls.append(code)
+        reindex_process(database, code)
+
+    for module in ("property_index", "deferred"):
+        monkeypatch.setattr(f"multifunctional.{module}.reindex_process", record)
+    process = bd.get_node(code="1")
+    with deferred_side_effects("product_properties") as changes:
+        for edge in process.functional_edges():
+            edge.setdefault("properties", {})["volume"] = 2
+            edge.save()
+        assert calls == []
+        assert changes.reindex == {"1"}
+    assert calls == ["1"]
+    rows = indexed_property_values("product_properties", "volume")
+    assert {row.edge_id for row in rows if row.source == "edge"} == {
+        exc.id for exc in process.functional_edges()
+    }
+
+
+def test_index_updated_on_product_save(product_properties):
+    build_property_index("product_properties")
+    product = bd.get_node(code="product")
+    product["properties"]["price"] = 70
+    product.save()
+
+    values = {row.value for row in indexed_property_values("product_properties", "price")}
+    assert values == {70, 12}
+    assert indexed_node_properties([product.key]) == {product.key: {"price": 70, "mass": 6}}
+
+
+def product_rows(node_id: int) -> int:
+    return (
+        PropertyIndex.select()
+        .where(PropertyIndex.source == "product", PropertyIndex.owner_id == node_id)
+        .count()
+    )
+
+
+def test_index_updated_on_product_delete(product_properties):
+    build_property_index("product_properties")
+    product = bd.get_node(code="product")
+    assert product_rows(product.id) == 2
+
+    product.delete()
+    assert product_rows(product.id) == 0
+    assert {row.source for row in indexed_property_values("product_properties", "price")} == {
+        None,
+        "edge",
+    }
+
+
+def test_index_updated_on_database_delete(product_properties):
+    build_property_index("product_properties")
+    product = bd.get_node(code="product")
+    del bd.databases["product_properties"]
+    assert product_rows(product.id) == 0
+
+
+def test_index_dropped_product_rows(product_properties):
+    build_property_index("product_properties")
+    drop_property_index("product_properties")
+    assert not PropertyIndex.select().where(PropertyIndex.source == "product").count()
+
+
+def test_index_updated_on_allocation(product_properties):
+    build_property_index("product_properties")
+    product_properties.metadata["default_allocation"] = "price"
+    product_properties.process()
+
+    # Edges are recreated during allocation; index should follow
+    process = bd.get_node(code="1")
+    rows = indexed_property_values("product_properties", "mass")
+    assert {row.edge_id for row in rows} == {exc.id for exc in process.functional_edges()}
+    assert {row.product_type for row in rows} == {"product", "readonly_process"}
+
+
+def test_index_updated_incrementally_on_allocation(product_properties, monkeypatch):
+    def index_rows():
+        return sorted(
+            (row.edge_id, row.product_id, row.source, row.value)
+            for label in ("price", "mass")
+            for row in indexed_property_values("product_properties", label)
+        )
+
+    build_property_index("product_properties")
+    product_properties.metadata["default_allocation"] = "price"
+    with monkeypatch.context() as patched:
+        patched.setattr("multifunctional.deferred.build_property_index", pytest.fail)
+        product_properties.process()
+        product_properties.metadata["default_allocation"] = "mass"
+        product_properties.process()
+    allocated, count = index_rows(), PropertyIndex.select().count()
+    build_property_index("product_properties")
+    assert index_rows() == allocated
+    assert PropertyIndex.select().count() == count
+
+
+def test_index_rebuilt_on_write(product_properties):
+    build_property_index("product_properties")
+    data = deepcopy(DATA)
+    data[("product_properties", "product")]["properties"]["price"] = 5
+    product_properties.write(data, process=False)
+
+    rows = indexed_property_values("product_properties", "price")
+    assert {row.edge_id for row in rows} == {
+        exc.id for exc in bd.get_node(code="1").functional_edges()
+    }
+    assert {row.value for row in rows} == {5, 12}
+
+
+def test_index_checks_match_scan(errors):
+    def summarize(messages):
+        return sorted(
+            (msg.level, msg.message_type.value, msg.product_id, msg.process_id, msg.message)
+            for msg in messages
+        )
+
+    scanned = summarize(check_property_for_allocation("errors", "mass"))
+    scanned_process = summarize(
+        check_property_for_process_allocation(bd.get_node(code="1"), "mass")
+    )
+    scanned_labels = sorted(list_available_properties("errors"), key=lambda x: x[0])
+
+    build_property_index("errors")
+    assert summarize(check_property_for_allocation("errors", "mass")) == scanned
+    assert (
+        summarize(check_property_for_process_allocation(bd.get_node(code="1"), "mass"))
+        == scanned_process
+    )
+    assert sorted(list_available_properties("errors"), key=lambda x: x[0]) == scanned_labels
+    assert check_property_for_allocation("errors", "price") is True
+    assert len(scanned) == 4
+    assert {level for level, *_ in scanned} == {logging.WARNING, logging.CRITICAL}
+
+
+def test_index_allocation_uses_indexed_product_properties(product_properties):
+    build_property_index("product_properties")
+    product_properties.metadata["default_allocation"] = "price"
+    product_properties.process()
+
+    edges = {exc["amount"]: exc for exc in bd.get_node(code="1").functional_edges()}
+    # 4 * 7 from the product node, 6 * 12 from the edge
+    assert edges[4]["mf_allocation_factor"] == pytest.approx(28 / 100)
+    assert edges[6]["mf_allocation_factor"] == pytest.approx(72 / 100)
+    assert MessageType.ALL_VALID in dict(list_available_properties("product_properties")).values()
@@ -0,0 +1,103 @@
+import logging
+from unittest.mock import patch
+
+import bw2data as bd
+import pytest
+
+from multifunctional import (
+    build_property_index,
+    check_properties_for_allocation,
+    check_property_for_allocation,
+    check_property_for_process_allocation,
+)
+from multifunctional.custom_allocation import MessageType, PropertyMessage
+
+
+def test_property_message_render_once():
+    calls = []
+
+    def render():
+        calls.append(1)
+        return "something is missing"
+
+    msg = PropertyMessage(
+        level=logging.WARNING,
+        process_id=1,
+        product_id=2,
+        message_type=MessageType.MISSING_EDGE_PROPERTY,
+        render=render,
+    )
+    assert not calls
+    assert "something" not in repr(msg)
+    assert msg.message == "something is missing"
+    assert msg.message == "something is missing"
+    assert len(calls) == 1
+
+
+def test_property_messages_not_rendered_on_creation(errors):
+    with patch("multifunctional.custom_allocation.get_node") as get_node:
+        messages = check_property_for_allocation("errors", "mass")
+        assert len(messages) == 4
+        assert not get_node.called
+
+    for msg in messages:
+        assert "`mass`" in msg.message
+    product = bd.get_node(code="a")
+    msg = next(m for m in messages if m.message_type == MessageType.MISSING_PRODUCT_PROPERTY)
+    assert str(product) in msg.message
+    assert str(bd.get_node(code="1")) in msg.message
+
+
+def test_property_messages_not_rendered_with_index(errors):
+    build_property_index("errors")
+    with patch("multifunctional.custom_allocation.get_node") as get_node:
+        messages = check_property_for_process_allocation(bd.get_node(code="1"), "mass")
+        assert len(messages) == 4
+        assert not get_node.called
+    assert all("`mass`" in msg.message for msg in messages)
+
+
+def test_check_property_for_allocation_count_only(errors):
+    assert check_property_for_allocation("errors", "mass", count_only=True) == 4
+    assert check_property_for_allocation("errors", "price", count_only=True) == 0
+    assert check_properties_for_allocation("errors", ["mass", "foo"], count_only=True) == 11
+
+
+def test_check_property_for_allocation_limit(errors):
+    assert len(check_property_for_allocation("errors", "mass", limit=2)) == 2
+    assert len(check_properties_for_allocation("errors", ["mass", "foo"], limit=5)) == 5
+    assert check_property_for_allocation("errors", "price", limit=2) is True
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_check_property_limit_positive(errors, limit):
+    with pytest.raises(ValueError, match="`limit` must be positive"):
+        check_property_for_allocation("errors", "mass", limit=limit)
+    with pytest.raises(ValueError, match="`limit` must be positive"):
+        check_properties_for_allocation("errors", ["mass"], limit=limit)
+    with pytest.raises(ValueError, match="`limit` must be positive"):
+        check_property_for_process_allocation(bd.get_node(code="1"), "mass", limit=limit)
+
+
+def test_check_property_for_process_allocation_count_only(errors):
+    node = bd.get_node(code="1")
+    assert check_property_for_process_allocation(node, "mass", count_only=True) == 4
+    assert check_property_for_process_allocation(node, "price", count_only=True) == 0
+    assert (
+        check_property_for_process_allocation(bd.get_node(code="a"), "mass", count_only=True) == 0
+    )
+
+    build_property_index("errors")
+    assert check_property_for_process_allocation(node, "mass", count_only=True) == 4
+
+
+def test_check_property_for_process_allocation_limit(errors):
+    node = bd.get_node(code="1")
+    assert len(check_property_for_process_allocation(node, "mass", limit=1)) == 1
+
+    messages = []
+    check_property_for_process_allocation(node, "mass", messages, limit=3)
+    assert len(messages) == 3
+
+    build_property_index("errors")
+    assert len(check_property_for_process_allocation(node, "mass", limit=1)) == 1
@@ -0,0 +1,89 @@
+import bw2data as bd
+import pytest
+import scipy.sparse.linalg
+from bw2data.tests import bw2test
+from test_low_rank import build_lca
+
+import multifunctional.sensitivity
+from multifunctional import allocation_sensitivity, low_rank_allocation_update
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def test_allocation_sensitivity_basic(basic):
+    basic.metadata["default_allocation"] = "price"
+    basic.process()
+    lca = build_lca({bd.get_node(code="my favorite code"): 1}, [bd.get_node(code="a")])
+
+    (result,) = allocation_sensitivity(lca)
+    assert (result.database, result.code, result.name) == ("basic", "1", "process - 1")
+    assert result.strategy == "property allocation by 'price'"
+    first, second = sorted(result.edges, key=lambda edge: edge.allocated_code != "my favorite code")
+    assert first.product == ("basic", "my favorite code")
+    assert first.factor == pytest.approx(4 * 7 / (4 * 7 + 6 * 12))
+    # Score is factor * 10 kg of `a` per 4 units of product
+    assert first.derivative == pytest.approx(10 / 4)
+    assert second.derivative == 0
+    assert result.spread == pytest.approx(10 / 4)
+
+
+@bw2test
+def test_allocation_sensitivity_predicts_score_change():
+    # Without internal links, the score is linear in the allocation factors
+    write_synthetic_database(
+        SyntheticInventory(processes=30, product_nodes=1, internal_links=0), process=True
+    )
+    db = bd.Database("synthetic")
+    lca = build_lca(
+        {node: 1 for node in db if node["type"] == "product"},
+        [node for node in db if node["type"] == "emission"],
+    )
+    results = allocation_sensitivity(lca, names=["synthetic"])
+    assert len(results) == len(db.multifunctional_codes())
+    assert [result.spread for result in results] == sorted(
+        (result.spread for result in results), reverse=True
+    )
+    assert len(allocation_sensitivity(lca, limit=2)) == 2
+
+    top = results[0]
+    parent = bd.get_node(database="synthetic", code=top.code)
+    new_factors = {
+        edge["mf_allocated_process_code"]: edge["mf_allocation_factor"]
+        for edge in parent.allocation_results("mass")[0]["exchanges"]
+        if edge.get("functional")
+    }
+    # `allocation_results` changes the node data in memory
+    parent = bd.get_node(database="synthetic", code=top.code)
+
+    expected = low_rank_allocation_update(lca, {parent: "mass"}).score - lca.score
+    predicted = sum(
+        edge.derivative * (new_factors[edge.allocated_code] - edge.factor) for edge in top.edges
+    )
+    assert expected and predicted == pytest.approx(expected)
+
+
+def test_allocation_sensitivity_needs_lcia(basic):
+    with pytest.raises(ValueError, match="lcia"):
+        allocation_sensitivity(object())
+
+
+def test_allocation_sensitivity_factorizes_once(basic, monkeypatch):
+    basic.metadata["default_allocation"] = "price"
+    basic.process()
+    factorized = []
+
+    def splu(matrix):
+        factorized.append(matrix)
+        return scipy.sparse.linalg.splu(matrix)
+
+    monkeypatch.setattr(multifunctional.sensitivity, "splu", splu)
+    demand, flows = {bd.get_node(code="my favorite code"): 1}, [bd.get_node(code="a")]
+    lca = build_lca(demand, flows)
+    first = allocation_sensitivity(lca)
+    assert allocation_sensitivity(lca) == first
+    assert len(factorized) == 1
+
+    # New technosphere matrix, new factorization
+    lca.technosphere_matrix = lca.technosphere_matrix.copy()
+    assert allocation_sensitivity(lca) == first
+    assert allocation_sensitivity(build_lca(demand, flows)) == first
+    assert len(factorized) == 3
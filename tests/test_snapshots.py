@@ -0,0 +1,110 @@
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+from test_allocation import check_basic_allocation_results
+from test_chunked_processing import allocation_summary
+
+from multifunctional import build_property_index
+from multifunctional.property_index import indexed_property_values
+from multifunctional.snapshots import (
+    AllocationSnapshot,
+    StaleAllocationSnapshot,
+    snapshot_allocation,
+)
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+PRICE = (4 * 7 / (4 * 7 + 6 * 12) * 10, 6 * 12 / (4 * 7 + 6 * 12) * 10)
+
+
+def allocate(database, strategy_label: str) -> None:
+    for node in database:
+        if node["type"] == "multifunctional":
+            node.allocate(strategy_label=strategy_label)
+
+
+def test_snapshot_restore(basic):
+    allocate(basic, "price")
+    assert basic.snapshot_allocation("price") == "price"
+    allocate(basic, "mass")
+    # Default label is the strategy label stored by allocation
+    assert basic.snapshot_allocation() == bd.get_node(code="1")["mf_strategy_label"]
+    assert set(basic.allocation_snapshots()) == {"price", basic.snapshot_allocation()}
+
+    assert basic.restore_allocation("price") == 2
+    check_basic_allocation_results(*PRICE, basic)
+    assert bd.get_node(code="1")["mf_strategy_label"] == "property allocation by 'price'"
+    assert bd.databases["basic"]["dirty"]
+
+    # Restored state can be allocated again as usual
+    allocate(basic, "equal")
+    check_basic_allocation_results(5, 5, basic)
+
+
+@bw2test
+def test_snapshot_restore_matches_allocation():
+    write_synthetic_database(SyntheticInventory(processes=20, product_nodes=1))
+    db = bd.Database("synthetic")
+    allocate(db, "price")
+    expected = allocation_summary("synthetic"), len(db)
+    db.snapshot_allocation("price")
+    allocate(db, "mass")
+    assert allocation_summary("synthetic") != expected[0]
+
+    db.restore_allocation("price")
+    assert (allocation_summary("synthetic"), len(db)) == expected
+    db.process(allocate=False)
+    assert db.filepath_processed().is_file()
+
+
+def test_snapshot_restore_property_index(basic):
+    build_property_index("basic")
+    allocate(basic, "price")
+    basic.snapshot_allocation("price")
+    allocate(basic, "mass")
+    basic.restore_allocation("price")
+    assert sorted(value.value for value in indexed_property_values("basic", "price")) == [7, 12]
+
+
+def test_snapshot_stale(basic):
+    allocate(basic, "price")
+    basic.snapshot_allocation("price")
+    allocate(basic, "mass")
+    node = bd.get_node(code="1")
+    edge = next(iter(node.biosphere()))
+    edge["amount"] = 20
+    edge.save()
+
+    with pytest.raises(StaleAllocationSnapshot, match="changed since the snapshot"):
+        basic.restore_allocation("price")
+    check_basic_allocation_results(5, 5, basic)
+
+
+def test_snapshot_stale_product_property(basic):
+    allocate(basic, "price")
+    basic.snapshot_allocation("before")
+    node = bd.get_node(code="1")
+    edge = next(iter(node.functional_edges()))
+    edge["properties"]["price"] = 100
+    edge.save()
+    with pytest.raises(StaleAllocationSnapshot):
+        basic.restore_allocation("before")
+
+
+def test_snapshot_errors(basic):
+    with pytest.raises(ValueError, match="give a snapshot `label`"):
+        basic.snapshot_allocation()
+    with pytest.raises(KeyError):
+        basic.restore_allocation("nope")
+    with pytest.raises(ValueError, match="not a multifunctional database"):
+        snapshot_allocation("missing")
+
+
+def test_snapshot_delete(basic):
+    allocate(basic, "price")
+    basic.snapshot_allocation("price")
+    basic.snapshot_allocation("other")
+    assert basic.delete_allocation_snapshot("other") == 1
+    assert list(basic.allocation_snapshots()) == ["price"]
+
+    del bd.databases["basic"]
+    assert not AllocationSnapshot.select().where(AllocationSnapshot.database == "basic").exists()
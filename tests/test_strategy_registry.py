@@ -0,0 +1,112 @@
+import threading
+from typing import Callable
+
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import (
+    add_custom_expression_allocation_to_project,
+    add_custom_property_allocation_to_project,
+    allocation_strategies,
+)
+from multifunctional.allocation import strategy_from_specification
+from multifunctional.custom_allocation import DEFAULT_ALLOCATIONS
+from multifunctional.registry import StrategyRegistry
+
+
+@bw2test
+def test_registry_for_other_project():
+    bd.projects.set_current("other")
+    add_custom_property_allocation_to_project("whatever")
+    bd.projects.set_current("default")
+
+    assert "whatever" not in allocation_strategies
+    assert "whatever" in allocation_strategies.for_project("other")
+    assert set(allocation_strategies.for_project("other")) == DEFAULT_ALLOCATIONS | {"whatever"}
+    assert set(allocation_strategies.for_project("missing")) == DEFAULT_ALLOCATIONS
+
+
+@bw2test
+def test_registry_builds_lazily_and_caches():
+    bd.projects.set_current("other")
+    bd.projects.dataset.data["multifunctional.custom_allocations"] = {
+        "price-mass": {"expression": "price * mass"}
+    }
+    bd.projects.dataset.save()
+    bd.projects.set_current("default")
+
+    calls = []
+
+    def builder(specification):
+        calls.append(specification)
+        return strategy_from_specification(specification)
+
+    registry = StrategyRegistry(defaults=allocation_strategies.defaults, builder=builder)
+    strategies = registry.for_project("other")
+    assert "price-mass" in list(strategies)
+    assert not calls
+
+    strategy = strategies["price-mass"]
+    bd.projects.set_current("other")
+    bd.projects.set_current("default")
+    assert registry.for_project("other")["price-mass"] is strategy
+    assert calls == [{"expression": "price * mass"}]
+
+
+@bw2test
+def test_registry_runtime_additions_scoped_to_project():
+    bd.projects.set_current("default")
+    allocation_strategies["silly"] = allocation_strategies["equal"]
+    try:
+        assert "silly" in allocation_strategies
+        bd.projects.set_current("other")
+        assert "silly" not in allocation_strategies
+        bd.projects.set_current("default")
+        assert "silly" in allocation_strategies
+    finally:
+        del allocation_strategies["silly"]
+    assert set(allocation_strategies) == DEFAULT_ALLOCATIONS
+
+
+def test_registry_cant_delete_defaults():
+    with pytest.raises(KeyError):
+        del allocation_strategies["price"]
+    with pytest.raises(KeyError):
+        del allocation_strategies["missing"]
+    assert set(allocation_strategies) == DEFAULT_ALLOCATIONS
+
+
+@bw2test
+def test_registry_forgets_deleted_project():
+    bd.projects.set_current("other")
+    add_custom_expression_allocation_to_project("value", "price * amount")
+    bd.projects.set_current("default")
+    bd.projects.delete_project("other", delete_dir=True)
+
+    bd.projects.set_current("other")
+    assert set(allocation_strategies) == DEFAULT_ALLOCATIONS
+
+
+@bw2test
+def test_registry_threads():
+    bd.projects.set_current("other")
+    add_custom_property_allocation_to_project("whatever")
+    bd.projects.set_current("default")
+    allocation_strategies.invalidate()
+
+    strategies = allocation_strategies.for_project("other")
+    results = []
+
+    def lookup():
+        results.append(strategies["whatever"])
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8
+    assert all(isinstance(result, Callable) for result in results)
+    assert len({id(result) for result in results}) == 1
@@ -1,179 +1,150 @@
+from copy import deepcopy
+
 import bw2data as bd
+import pytest
 from bw2data.tests import bw2test
 
-from multifunctional.supplemental import add_product_node_properties_to_exchange
+from multifunctional import MultifunctionalDatabase
+from multifunctional.allocation import generic_allocation, property_allocation
+from multifunctional.supplemental import (
+    edge_with_product_properties,
+    layered_properties,
+    product_node_properties,
+)
 
 
-@bw2test
-def test_not_overwrite_properties():
-    bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "production",
-                "properties": {"first": 7},
-            }
-        ],
-    }
-    expected = {
+def dataset(edge_type: str = "production", **kwargs) -> dict:
+    return {
         "database": "foo",
         "code": "2",
         "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "production",
-                "__mf__properties_from_product": {"second"},
-                "properties": {"first": 7, "second": False},
-            }
+            {"input": ("foo", "1"), "functional": True, "type": edge_type, **kwargs},
         ],
     }
-    assert add_product_node_properties_to_exchange(data) == expected
+
+
+@bw2test
+def test_not_overwrite_properties():
+    bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
+    data = dataset(properties={"first": 7})
+    expected = deepcopy(data)
+
+    products = product_node_properties(data)
+    assert products == {0: {"first": True, "second": False}}
+    view = edge_with_product_properties(data["exchanges"][0], products[0])
+    assert dict(view["properties"]) == {"first": 7, "second": False}
+    assert view["type"] == "production"
+    # Nothing copied into the edge
+    assert data == expected
 
 
 @bw2test
 def test_update_properties_production():
     bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "production",
-            }
-        ],
-    }
-    expected = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "__mf__properties_from_product": {"first", "second"},
-                "type": "production",
-                "properties": {"first": True, "second": False},
-            }
-        ],
-    }
-    assert add_product_node_properties_to_exchange(data) == expected
+    data = dataset()
+    products = product_node_properties(data)
+    view = edge_with_product_properties(data["exchanges"][0], products[0])
+    assert dict(view["properties"]) == {"first": True, "second": False}
+    assert "properties" not in data["exchanges"][0]
 
 
 @bw2test
 def test_update_properties_technosphere():
     bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "technosphere",
-            }
-        ],
-    }
-    expected = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "technosphere",
-                "__mf__properties_from_product": {"first", "second"},
-                "properties": {"first": True, "second": False},
-            }
-        ],
-    }
-    assert add_product_node_properties_to_exchange(data) == expected
+    assert product_node_properties(dataset("technosphere")) == {0: {"first": True, "second": False}}
 
 
 @bw2test
 def test_not_update_properties_other():
     bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "w00t",
-            }
-        ],
-    }
-    expected = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("foo", "1"),
-                "functional": True,
-                "type": "w00t",
-            }
-        ],
-    }
-    assert add_product_node_properties_to_exchange(data) == expected
+    assert product_node_properties(dataset("w00t")) == {}
 
 
 @bw2test
 def test_skip_exc_without_input():
     bd.Database("foo").write({("foo", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "functional": True,
-                "type": "production",
-            }
-        ],
-    }
-    expected = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "functional": True,
-                "type": "production",
-            }
-        ],
-    }
-    assert add_product_node_properties_to_exchange(data) == expected
+    data = dataset()
+    del data["exchanges"][0]["input"]
+    assert product_node_properties(data) == {}
+
+
+@bw2test
+def test_skip_link_to_itself():
+    bd.Database("foo").write({("foo", "2"): {"properties": {"first": True}}})
+    data = dataset()
+    data["exchanges"][0]["input"] = ("foo", "2")
+    assert product_node_properties(data) == {}
 
 
 def test_get_properties_different_database():
     bd.Database("bar").write({("bar", "1"): {"properties": {"first": True, "second": False}}})
-    data = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("bar", "1"),
-                "functional": True,
-                "type": "production",
-                "properties": {"first": 7},
-            }
-        ],
-    }
-    expected = {
-        "database": "foo",
-        "code": "2",
-        "exchanges": [
-            {
-                "input": ("bar", "1"),
-                "functional": True,
-                "type": "production",
-                "__mf__properties_from_product": {"second"},
-                "properties": {"first": 7, "second": False},
-            }
-        ],
+    data = dataset(properties={"first": 7})
+    data["exchanges"][0]["input"] = ("bar", "1")
+    products = product_node_properties(data)
+    assert dict(layered_properties(data["exchanges"][0]["properties"], products[0])) == {
+        "first": 7,
+        "second": False,
     }
-    assert add_product_node_properties_to_exchange(data) == expected
+
+
+def test_layered_properties_read_only():
+    edge, product = {"first": 7}, {"first": 1, "second": 2}
+    view = layered_properties(edge, product)
+    assert view["first"] == 7 and view["second"] == 2
+    assert sorted(view) == ["first", "second"]
+    with pytest.raises(TypeError):
+        view["third"] = 3
+    # Not a copy
+    product["third"] = 3
+    assert view["third"] == 3
+    assert dict(layered_properties(None, None)) == {}
+
+
+@bw2test
+def test_allocation_leaves_edges_unchanged():
+    db = MultifunctionalDatabase("foo")
+    db.write(
+        {
+            ("foo", "a"): {"name": "a", "type": "product", "properties": {"price": 2}},
+            ("foo", "b"): {"name": "b", "type": "product", "properties": {"price": 0}},
+            ("foo", "1"): {
+                "name": "process",
+                "type": "multifunctional",
+                "exchanges": [
+                    {"input": ("foo", "a"), "type": "production", "amount": 1, "functional": True},
+                    {
+                        "input": ("foo", "b"),
+                        "type": "production",
+                        "amount": 1,
+                        "functional": True,
+                        "properties": {"mass": 1},
+                    },
+                ],
+            },
+        },
+        process=False,
+    )
+    node = bd.get_node(code="1")
+    data = dict(node._data, exchanges=[deepcopy(exc._data) for exc in node.exchanges()])
+    for exc in data["exchanges"]:
+        del exc["output"]
+    expected = deepcopy(data["exchanges"])
+
+    # Fails halfway, after looking up product properties
+    failing = deepcopy(data)
+    with pytest.raises(ZeroDivisionError):
+        generic_allocation(failing, func=lambda edge, node: edge["properties"]["price"] * 0)
+    assert failing["exchanges"] == expected
+
+    processes = property_allocation("price")(data)
+    assert [exc["mf_allocation_factor"] for exc in data["exchanges"]] == [1, 0]
+    for original, allocated in zip(data["exchanges"], expected):
+        assert original.get("properties") == allocated.get("properties")
+    for process in processes[1:]:
+        assert "price" not in process["exchanges"][0].get("properties", {})
+
+    node.allocate(strategy_label="price")
+    assert [exc.get("properties") for exc in bd.get_node(code="1").exchanges()] == [
+        None,
+        {"mass": 1},
+    ]
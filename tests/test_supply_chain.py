@@ -0,0 +1,121 @@
+import bw2calc as bc
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase
+from multifunctional.supply_chain import (
+    DemandReport,
+    clear_supply_chain_cache,
+    functional_products,
+    walk_supply_chain,
+)
+
+
+def multifunctional_process(code: str, products: bool = False) -> dict:
+    edges = []
+    for number, mass in ((1, 1), (2, 3)):
+        edge = {"functional": True, "type": "production", "amount": 1, "properties": {"mass": mass}}
+        if products:
+            edge["input"] = ("background", f"product {code.lower()}{number}")
+        else:
+            edge.update(
+                name=f"{code} - {number}", unit="kg", desired_code=f"{code.lower()}{number}"
+            )
+        edges.append(edge)
+    edges.append({"type": "biosphere", "amount": 4, "input": ("background", "co2")})
+    return {"name": code, "type": "multifunctional", "location": "somewhere", "exchanges": edges}
+
+
+@pytest.fixture
+@bw2test
+def background():
+    db = MultifunctionalDatabase("background")
+    db.register(default_allocation="mass")
+    db.write(
+        {
+            ("background", "co2"): {"name": "co2", "type": "emission"},
+            ("background", "A"): multifunctional_process("A"),
+            ("background", "B"): multifunctional_process("B", products=True),
+            ("background", "product b1"): {"name": "b1", "type": "product", "unit": "kg"},
+            ("background", "product b2"): {"name": "b2", "type": "product", "unit": "kg"},
+            ("background", "C"): {
+                "name": "C",
+                "type": "process",
+                "exchanges": [
+                    {"type": "production", "amount": 1, "input": ("background", "C")},
+                    {"type": "technosphere", "amount": 2, "input": ("background", "a1")},
+                ],
+            },
+        },
+        process=False,
+    )
+    clear_supply_chain_cache()
+    return db
+
+
+def readonly_parents(db: MultifunctionalDatabase) -> set:
+    return {node["mf_parent_key"][1] for node in db if node["type"] == "readonly_process"}
+
+
+def test_walk_supply_chain(background):
+    products = functional_products("background")
+    assert products[("background", "a2")] == ("background", "A")
+    assert products[("background", "product b2")] == ("background", "B")
+    assert set(products.values()) == {("background", "A"), ("background", "B")}
+
+    visited = set()
+    reached = walk_supply_chain([("background", "C")], products, visited)
+    assert reached == {("background", "C"), ("background", "a1"), ("background", "A")}
+    assert walk_supply_chain([("background", "C")], products, visited) == set()
+
+
+def test_process_for_demand(background):
+    report = background.process_for_demand({bd.get_node(code="C"): 1})
+    assert isinstance(report, DemandReport)
+    assert (report.allocated, report.cached, report.remaining) == (1, 0, 1)
+    assert readonly_parents(background) == {"A"}
+    assert not background.metadata["dirty"]
+
+    lca = bc.LCA({bd.get_node(code="C"): 1})
+    lca.lci()
+    # 2 kg of a1, with a mass allocation factor of 1/4
+    assert lca.inventory.sum() == pytest.approx(2)
+
+    # Cached
+    report = background.process_for_demand([bd.get_node(code="C").id])
+    assert (report.reached, report.allocated, report.cached) == (0, 0, 1)
+
+
+def test_process_for_demand_new_demands(background):
+    background.process_for_demand([("background", "C")])
+
+    foreground = bd.Database("foreground")
+    foreground.write(
+        {
+            ("foreground", "D"): {
+                "name": "D",
+                "type": "process",
+                "exchanges": [
+                    {"type": "production", "amount": 1, "input": ("foreground", "D")},
+                    {"type": "technosphere", "amount": 1, "input": ("background", "product b2")},
+                    {"type": "technosphere", "amount": 1, "input": ("background", "C")},
+                ],
+            }
+        }
+    )
+    report = background.process_for_demand({("foreground", "D"): 1})
+    assert (report.allocated, report.cached, report.remaining) == (1, 1, 0)
+    assert readonly_parents(background) == {"A", "B"}
+
+    lca = bc.LCA({bd.get_node(code="D"): 1})
+    lca.lci()
+    assert lca.inventory.sum() == pytest.approx(3 + 2)
+
+
+def test_process_for_demand_cache_reset(background):
+    background.process_for_demand([("background", "C")])
+    background.metadata["default_allocation"] = "equal"
+    report = background.process_for_demand([("background", "C")])
+    assert (report.allocated, report.cached) == (1, 0)
+    assert bd.get_node(code="a1")["mf_strategy_label"] == "equal_allocation"
@@ -0,0 +1,127 @@
+import tracemalloc
+
+import bw2data as bd
+import pytest
+from bw2data.tests import bw2test
+
+from multifunctional import MultifunctionalDatabase, check_property_for_allocation
+from multifunctional.synthetic import SyntheticInventory, write_synthetic_database
+
+
+def test_synthetic_deterministic():
+    first = SyntheticInventory(processes=20, seed=1).data()
+    assert first == SyntheticInventory(processes=20, seed=1).data()
+    assert first != SyntheticInventory(processes=20, seed=2).data()
+
+
+def test_synthetic_prefix_stable():
+    small = SyntheticInventory(processes=10).data()
+    large = SyntheticInventory(processes=20).data()
+    assert all(large[key] == value for key, value in small.items())
+
+
+def test_synthetic_covers_fixture_cases():
+    inventory = SyntheticInventory(processes=200, missing_properties=0.1, nonnumeric_properties=0.1)
+    datasets = list(inventory.datasets())
+    functional = [
+        exc for ds in datasets for exc in ds.get("exchanges", []) if exc.get("functional")
+    ]
+    properties = [
+        value
+        for ds in datasets
+        for obj in [ds, *ds.get("exchanges", [])]
+        for value in obj.get("properties", {}).values()
+    ]
+    assert {ds.get("type") for ds in datasets} == {"emission", "product", "multifunctional", None}
+    assert any("input" not in exc for exc in functional)
+    assert any("desired_code" in exc for exc in functional)
+    assert any(isinstance(value, float) for value in properties)
+    assert any(not isinstance(value, float) for value in properties)
+    assert any(
+        exc["input"][1].startswith("process-")
+        for ds in datasets
+        for exc in ds.get("exchanges", [])
+        if exc["type"] == "technosphere"
+    )
+
+
+def test_synthetic_with_exchanges():
+    inventory = SyntheticInventory.with_exchanges(10_000)
+    count = sum(len(ds.get("exchanges", [])) for ds in inventory.datasets())
+    assert 9_000 < count <= 10_000
+
+
+def test_synthetic_streams():
+    inventory = SyntheticInventory(processes=20_000)
+    tracemalloc.start()
+    try:
+        for _ in inventory.datasets():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1e6
+
+
+@bw2test
+def test_synthetic_write_and_process():
+    inventory = SyntheticInventory(processes=30, database="synthetic")
+    db = MultifunctionalDatabase("synthetic")
+    db.register(default_allocation="price")
+    db.write(inventory.data())
+
+    parents = [node for node in db if node["type"] == "multifunctional"]
+    assert parents
+    readonly = [node for node in db if node["type"] == "readonly_process"]
+    assert len(readonly) == sum(len(list(node.functional_edges())) for node in parents)
+    # Internal links to generated codes resolve after allocation
+    for node in db:
+        for exc in node.technosphere():
+            assert exc.input
+
+
+@bw2test
+def test_write_synthetic_database_matches_write():
+    inventory = SyntheticInventory(processes=30, database="streamed", simapro=True)
+    write_synthetic_database(inventory)
+
+    expected = MultifunctionalDatabase("written")
+    expected.write(
+        SyntheticInventory(processes=30, database="written", simapro=True).data(), process=False
+    )
+
+    assert len(bd.Database("streamed")) == len(expected)
+    assert bd.databases["streamed"]["number"] == len(expected)
+    assert bd.databases["streamed"]["simapro_project"] == "synthetic"
+    streamed = sorted((node["code"], node["type"]) for node in bd.Database("streamed"))
+    assert streamed == sorted((node["code"], node["type"]) for node in expected)
+
+
+@bw2test
+def test_write_synthetic_database_replaces_and_indexes():
+    write_synthetic_database(SyntheticInventory(processes=30))
+    db = write_synthetic_database(SyntheticInventory(processes=10), searchable=True)
+    assert len(db) == bd.databases["synthetic"]["number"]
+    assert len(db) == len(SyntheticInventory(processes=10).data())
+    assert db.search("process")
+    assert "GLO" in bd.geomapping
+
+
+@bw2test
+def test_write_synthetic_database_process_simapro():
+    inventory = SyntheticInventory(
+        processes=10, functional_edges={2: 1}, product_nodes=0, simapro=True
+    )
+    db = write_synthetic_database(inventory, process=True)
+    readonly = [node for node in db if node["type"] == "readonly_process"]
+    assert len(readonly) == 20
+    assert all(node["name"].startswith("product ") for node in readonly)
+
+
+@bw2test
+def test_write_synthetic_database_property_problems():
+    inventory = SyntheticInventory(processes=50, missing_properties=0.2, nonnumeric_properties=0.2)
+    write_synthetic_database(inventory)
+    assert check_property_for_allocation("synthetic", "price") is not True
+    with pytest.raises((KeyError, ValueError, TypeError)):
+        bd.Database("synthetic").process()